@@ -1,6 +1,12 @@
 from django.contrib import admin
 
-from .models import Register, Debt, GroupTransaction, IndividualsTransaction
+from .models import (
+    Register,
+    Debt,
+    GroupTransaction,
+    IndividualsTransaction,
+    OutgoingEmail,
+)
 
 
 class DebtInline(admin.StackedInline):
@@ -22,7 +28,10 @@ class IndividualsTransactionInline(admin.StackedInline):
 
 class GroupTransactionAdmin(admin.ModelAdmin):
     fieldsets = [
-        (None, {"fields": ["name", "init_date", "is_settled", "settle_date"]}),
+        (
+            None,
+            {"fields": ["name", "register", "init_date", "is_settled", "settle_date"]},
+        ),
     ]
     inlines = [IndividualsTransactionInline]
 
@@ -31,3 +40,4 @@ admin.site.register(Register, RegisterAdmin)
 admin.site.register(Debt)
 admin.site.register(GroupTransaction, GroupTransactionAdmin)
 admin.site.register(IndividualsTransaction)
+admin.site.register(OutgoingEmail)
@@ -0,0 +1,351 @@
+"""
+A JSON API over the same data as the HTML views, for clients that poll
+registers. Amounts are strings in zloty, just like on the pages and in
+imported and exported files. Every GET response carries an ETag
+and a request with a matching If-None-Match gets an empty 304.
+"""
+
+import hashlib
+import json
+import typing
+from django.db.models import Count, Prefetch, Q
+from django.http import Http404, HttpRequest, JsonResponse
+from django.utils.cache import get_conditional_response
+from django.views.generic import View
+
+from .caching import load_register_page
+from .errors import BadGroszeException, ImportFormatException, VoteConflictException
+from .importing import create_transactions, validate_row
+from .models import Debt, GroupTransaction, IndividualsTransaction, Register
+from .routing import reads_from_replica
+from .settlement import cast_vote
+from .utils import get_membership, gr_to_zl, parse_cursor
+
+API_PAGE_SIZE = 50
+API_MAX_BATCH = 100
+
+
+def json_response(data: dict, status: int = 200, etag: str = None) -> JsonResponse:
+    response = JsonResponse(
+        data,
+        status=status,
+        json_dumps_params={"separators": (",", ":"), "ensure_ascii": False},
+    )
+    if etag is not None:
+        response["ETag"] = etag
+    return response
+
+
+def api_error(message: str, status: int) -> JsonResponse:
+    return json_response({"error": message}, status)
+
+
+def conditional_json(
+    request: HttpRequest, etag: str, build: typing.Callable[[], dict]
+) -> JsonResponse:
+    """
+    Answer with a 304 if the client already has the version of the data
+    identified by etag, and only build the data otherwise.
+    """
+    etag = f'"{etag}"'
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
+    return json_response(build(), etag=etag)
+
+
+def read_json_body(request: HttpRequest) -> typing.Optional[dict]:
+    try:
+        data = json.loads(request.body)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def api_login_required(cls):
+    cls._api_login_required__original_dispatch = cls.dispatch
+
+    def new_dispatch(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return api_error("Not logged in", 401)
+        return cls._api_login_required__original_dispatch(
+            self, request, *args, **kwargs
+        )
+
+    cls.dispatch = new_dispatch
+    return cls
+
+
+def api_register_member(cls):
+    """
+    The API counterpart of check_if_can_be_viewed, which answers
+    with JSON errors instead of error pages.
+    """
+    cls._api_register_member__original_dispatch = cls.dispatch
+
+    def new_dispatch(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return api_error("Not logged in", 401)
+        debt = get_membership(kwargs["register_id"], request.user.pk)
+        if debt is None:
+            if not Register.objects.filter(pk=kwargs["register_id"]).exists():
+                return api_error("No such register", 404)
+            return api_error("Not a member of this register", 403)
+        register = debt.register
+        if not register.all_accepted:
+            return api_error("Not every member has accepted the invitation", 403)
+        kwargs.update(
+            {
+                "api_register_member__register": register,
+                "api_register_member__debt": debt,
+            }
+        )
+        return cls._api_register_member__original_dispatch(
+            self, request, *args, **kwargs
+        )
+
+    cls.dispatch = new_dispatch
+    return cls
+
+
+def transaction_summary(group_transaction: GroupTransaction) -> dict:
+    return {
+        "id": group_transaction.pk,
+        "name": group_transaction.name,
+        "init_date": group_transaction.init_date.isoformat(),
+        "is_settled": group_transaction.is_settled,
+        "settle_date": (
+            group_transaction.settle_date.isoformat()
+            if group_transaction.settle_date
+            else None
+        ),
+    }
+
+
+def transaction_details(group_transaction: GroupTransaction) -> dict:
+    indivs = []
+    for indiv in group_transaction.individualstransaction_set.all():
+        if indiv.balance_before is not None:
+            balance_before = indiv.balance_before
+        else:
+            balance_before = indiv.debt.balance
+        indivs.append(
+            {
+                "username": indiv.debt.user.username,
+                "amount": gr_to_zl(indiv.amount),
+                "balance_before": gr_to_zl(balance_before),
+                "balance_after": gr_to_zl(balance_before + indiv.amount),
+                "supports": indiv.supports,
+                "wants_remove": indiv.wants_remove,
+            }
+        )
+    return {
+        **transaction_summary(group_transaction),
+        "support_count": group_transaction.support_count,
+        "remove_count": group_transaction.remove_count,
+        "member_count": group_transaction.member_count,
+        "indivs": indivs,
+    }
+
+
+@reads_from_replica
+@api_login_required
+class ApiRegistersView(View):
+    """
+    The data of UserspaceView: every register of the user along with
+    whether they and the rest of its members have accepted it.
+    """
+
+    http_method_names = ["get", "options"]
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        registers = [
+            {
+                "id": debt.register.pk,
+                "name": debt.register.name,
+                "all_accepted": debt.register.all_accepted,
+                "accepted": debt.accepted,
+                "accepted_count": debt.accepted_count,
+                "member_count": debt.member_count,
+            }
+            for debt in Debt.objects.filter(user=request.user.pk)
+            .select_related("register")
+            .annotate(
+                accepted_count=Count(
+                    "register__debt", filter=Q(register__debt__accepted=True)
+                ),
+                member_count=Count("register__debt"),
+            )
+            .order_by("register__name")
+        ]
+        # there's no single version covering all of a user's registers,
+        # so the tag is a hash of the (small) response instead
+        etag = hashlib.sha256(
+            json.dumps(registers, sort_keys=True).encode()
+        ).hexdigest()[:32]
+        return conditional_json(request, etag, lambda: {"registers": registers})
+
+
+@reads_from_replica
+@api_register_member
+class ApiRegisterView(View):
+    """
+    The data of RegisterView: balances of the members and a page
+    of the transaction history, paginated with the same cursors.
+    """
+
+    http_method_names = ["get", "options"]
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        register = kwargs["api_register_member__register"]
+        after = parse_cursor(request.GET.get("after"))
+        before = parse_cursor(request.GET.get("before"))
+
+        def build():
+            page = load_register_page(register, after, before, API_PAGE_SIZE)
+            return {
+                "id": register.pk,
+                "name": register.name,
+                "debts": page["debts"],
+                "transactions": [
+                    transaction_summary(group_transaction)
+                    for group_transaction in page["transactions"]
+                ],
+                "older": page["older"],
+                "newer": page["newer"],
+            }
+
+        # every change to what's shown here bumps one of the register's versions
+        etag = (
+            f"register-{register.pk}-v{register.version}"
+            f".m{register.membership_version}-{after}-{before}"
+        )
+        return conditional_json(request, etag, build)
+
+
+@reads_from_replica
+@api_register_member
+class ApiTransactionsView(View):
+    """
+    GET: the data of TransactionVoteView for up to API_MAX_BATCH
+    transactions at once, chosen with ?ids=1,2,3.
+    POST: create up to API_MAX_BATCH transactions at once out of
+    {"transactions": [{"name": ..., "amounts": {username: amount}}]}.
+    Either all of them are valid and get created, or none are.
+    """
+
+    http_method_names = ["get", "post", "options"]
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        register = kwargs["api_register_member__register"]
+        try:
+            ids = [int(i) for i in request.GET.get("ids", "").split(",") if i]
+        except ValueError:
+            return api_error("ids should be a comma separated list of numbers", 400)
+        if not ids or len(ids) > API_MAX_BATCH:
+            return api_error(f"Ask for between 1 and {API_MAX_BATCH} ids", 400)
+        group_transactions = GroupTransaction.objects.filter(
+            register=register, pk__in=ids
+        ).order_by("pk")
+        # votes bump a transaction's version, settling bumps the register's,
+        # which changes the balances shown, and renaming a member bumps
+        # its membership version
+        versions = group_transactions.values_list("pk", "version")
+        etag = (
+            f"transactions-{register.pk}-v{register.version}"
+            f".m{register.membership_version}-"
+        ) + ".".join(f"{pk}:{version}" for pk, version in versions)
+
+        def build():
+            indivs = IndividualsTransaction.objects.select_related(
+                "debt__user"
+            ).order_by("debt__user__username")
+            return {
+                "transactions": [
+                    transaction_details(group_transaction)
+                    for group_transaction in group_transactions.prefetch_related(
+                        Prefetch("individualstransaction_set", queryset=indivs)
+                    )
+                ]
+            }
+
+        return conditional_json(request, etag, build)
+
+    def post(self, request: HttpRequest, *args, **kwargs):
+        register = kwargs["api_register_member__register"]
+        data = read_json_body(request)
+        if data is None or not isinstance(data.get("transactions"), list):
+            return api_error('Expected {"transactions": [...]}', 400)
+        if not 0 < len(data["transactions"]) <= API_MAX_BATCH:
+            return api_error(
+                f"Send between 1 and {API_MAX_BATCH} transactions at once", 400
+            )
+        debt_ids = dict(
+            Debt.objects.filter(register=register).values_list("user__username", "pk")
+        )
+        valid = []
+        errors = []
+        for index, item in enumerate(data["transactions"]):
+            try:
+                name = str(item["name"])
+                amounts = {
+                    username: str(amount)
+                    for username, amount in item["amounts"].items()
+                }
+                valid.append((name.strip(), validate_row(name, amounts, debt_ids)))
+            except (KeyError, TypeError, AttributeError):
+                errors.append({"index": index, "error": "Malformed transaction"})
+            except (ImportFormatException, BadGroszeException) as error:
+                errors.append({"index": index, "error": str(error)})
+        if errors:
+            return json_response({"errors": errors}, 422)
+        group_transactions = create_transactions(register, valid, debt_ids.values())
+        return json_response(
+            {"ids": [group_transaction.pk for group_transaction in group_transactions]},
+            201,
+        )
+
+
+@api_register_member
+class ApiVotesView(View):
+    """
+    Cast up to API_MAX_BATCH votes of the user at once, out of
+    {"votes": [{"transaction": id, "supports": bool, "wants_remove": bool}]}.
+    Every vote is cast on its own, and its outcome is reported
+    the same way the voting engine reports it, or as "conflict"
+    when it should be retried later.
+    """
+
+    http_method_names = ["post", "options"]
+
+    def post(self, request: HttpRequest, *args, **kwargs):
+        register = kwargs["api_register_member__register"]
+        data = read_json_body(request)
+        if data is None or not isinstance(data.get("votes"), list):
+            return api_error('Expected {"votes": [...]}', 400)
+        if not 0 < len(data["votes"]) <= API_MAX_BATCH:
+            return api_error(f"Send between 1 and {API_MAX_BATCH} votes at once", 400)
+        try:
+            votes = [
+                (int(vote["transaction"]), vote["supports"], vote["wants_remove"])
+                for vote in data["votes"]
+            ]
+        except (KeyError, TypeError, ValueError):
+            return api_error("Malformed vote", 400)
+        if not all(
+            isinstance(supports, bool) and isinstance(wants_remove, bool)
+            for _, supports, wants_remove in votes
+        ):
+            return api_error("supports and wants_remove should be booleans", 400)
+        results = []
+        for group_transaction_id, supports, wants_remove in votes:
+            try:
+                outcome = cast_vote(
+                    register, group_transaction_id, request.user, supports, wants_remove
+                ).outcome
+            except Http404:
+                outcome = "not_found"
+            except VoteConflictException:
+                outcome = "conflict"  # can be retried later
+            results.append({"transaction": group_transaction_id, "outcome": outcome})
+        return json_response({"results": results})
@@ -0,0 +1,150 @@
+import contextlib
+import datetime
+import math
+import os
+import random
+import tempfile
+import typing
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+
+from .models import Debt, GroupTransaction, IndividualsTransaction, Register
+
+
+@contextlib.contextmanager
+def throwaway_database():
+    """
+    Run the enclosed code against a freshly created, file-backed test database
+    so that benchmarks never touch real data. A file is used instead of
+    the usual in-memory test database so that worker threads can share it.
+    """
+    test_settings = connection.settings_dict.setdefault("TEST", {})
+    old_test_name = test_settings.get("NAME")
+    fd, path = tempfile.mkstemp(prefix="rejestrapp-bench-", suffix=".sqlite3")
+    os.close(fd)
+    if connection.vendor == "sqlite":
+        test_settings["NAME"] = path
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        test_settings["NAME"] = old_test_name
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def make_register(
+    member_count: int, name: str = "bench"
+) -> typing.Tuple[Register, typing.List[User]]:
+    """
+    Create an accepted register with member_count members using bulk inserts.
+    The users get unusable passwords, so creating thousands of them is cheap.
+    """
+    users = User.objects.bulk_create(
+        User(username=f"{name}_{i}") for i in range(member_count)
+    )
+    return add_register(users, name), users
+
+
+def add_register(
+    users: typing.Sequence[User], name: str = "bench", accepted: bool = True
+) -> Register:
+    """
+    Create a register of already existing users. When accepted is False
+    none of them has accepted the invitation yet.
+    """
+    register = Register.objects.create(name=name, all_accepted=accepted)
+    Debt.objects.bulk_create(
+        Debt(user=user, register=register, accepted=accepted) for user in users
+    )
+    return register
+
+
+def make_history(
+    register: Register,
+    count: int,
+    pending_share: float,
+    rng: random.Random,
+    batch_size: int = 1000,
+) -> None:
+    """
+    Fill register with count transactions, one a day, each moving a random
+    amount from one random member to another. The newest pending_share
+    of them are still waiting for votes, the rest are settled.
+    The balances of the members aren't updated to match.
+    """
+    debt_ids = list(Debt.objects.filter(register=register).values_list("pk", flat=True))
+    settled_count = count - round(count * pending_share)
+    started = timezone.now() - datetime.timedelta(days=count)
+    group_transactions = GroupTransaction.objects.bulk_create(
+        (
+            GroupTransaction(
+                name=f"history_{i}",
+                init_date=started + datetime.timedelta(days=i),
+                register=register,
+                is_settled=i < settled_count,
+                settle_date=(
+                    started + datetime.timedelta(days=i, hours=1)
+                    if i < settled_count
+                    else None
+                ),
+                member_count=len(debt_ids),
+                support_count=len(debt_ids) if i < settled_count else 0,
+            )
+            for i in range(count)
+        ),
+        batch_size=batch_size,
+    )
+
+    def indivs():
+        for group_transaction in group_transactions:
+            amount = rng.randint(1, 100000)
+            payer, payee = (
+                rng.sample(debt_ids, 2) if len(debt_ids) > 1 else (None, None)
+            )
+            for debt_id in debt_ids:
+                yield IndividualsTransaction(
+                    debt_id=debt_id,
+                    group_transaction=group_transaction,
+                    amount=(
+                        -amount
+                        if debt_id == payer
+                        else amount if debt_id == payee else 0
+                    ),
+                    supports=group_transaction.is_settled,
+                    balance_before=0 if group_transaction.is_settled else None,
+                )
+
+    IndividualsTransaction.objects.bulk_create(indivs(), batch_size=batch_size)
+
+
+def make_transaction(
+    register: Register, amounts: typing.Dict[int, int], name: str = "bench"
+) -> GroupTransaction:
+    """
+    Create a pending transaction in register. amounts maps user ids
+    to amounts in grosze and should add up to zero.
+    """
+    debts = Debt.objects.filter(register=register)
+    group_transaction = GroupTransaction.objects.create(
+        name=name, init_date=timezone.now(), register=register, member_count=len(debts)
+    )
+    IndividualsTransaction.objects.bulk_create(
+        IndividualsTransaction(
+            debt=debt,
+            group_transaction=group_transaction,
+            amount=amounts.get(debt.user_id, 0),
+        )
+        for debt in debts
+    )
+    return group_transaction
+
+
+def percentile(values: typing.Sequence[float], fraction: float) -> float:
+    """
+    The nearest-rank percentile of values, e.g. fraction=0.95 for p95.
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
@@ -0,0 +1,255 @@
+import collections
+import contextlib
+import contextvars
+import os
+import threading
+import typing
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Debt, GroupTransaction, Register
+from .utils import (
+    generate_new_easy_transaction_form_class,
+    generate_new_itemized_transaction_form_class,
+    generate_new_transaction_form_class,
+    gr_to_zl,
+    transaction_history_page,
+)
+
+REGISTER_PAGES_CACHE = "register_pages"
+
+
+def register_pages_cache():
+    return caches[REGISTER_PAGES_CACHE]
+
+
+def register_page_cache_key(
+    register: Register,
+    after: typing.Optional[int],
+    before: typing.Optional[int],
+    page_size: int,
+) -> str:
+    """
+    Pages are cached under the register's versions, so entries of older
+    versions simply stop being read and get evicted by the LRU backend.
+    The membership version is there for the usernames shown on the page.
+    """
+    return (
+        f"register:{register.pk}:v{register.version}"
+        f".m{register.membership_version}:{after}:{before}:{page_size}"
+    )
+
+
+def bump_register_version(register: Register) -> None:
+    """
+    Invalidate every cached page of a register. Has to be called by every write
+    that changes what RegisterView shows, inside the same database transaction.
+    """
+    Register.objects.filter(pk=register.pk).update(version=F("version") + 1)
+
+
+def load_register_page(
+    register: Register,
+    after: typing.Optional[int],
+    before: typing.Optional[int],
+    page_size: int,
+) -> dict:
+    """
+    The balances of a register's members and a page of its transaction
+    history, read from the cache when this version of the page is in it.
+    """
+    page_cache = register_pages_cache()
+    cache_key = register_page_cache_key(register, after, before, page_size)
+    page = page_cache.get(cache_key)
+    if page is None:
+        transactions, older, newer = transaction_history_page(
+            GroupTransaction.objects.filter(register=register),
+            after,
+            before,
+            page_size,
+        )
+        debts_for_display = []
+        for debt in (
+            register.debt_set.all().select_related("user").order_by("user__username")
+        ):
+            debts_for_display.append(
+                {"name": debt.user.username, "balance": gr_to_zl(debt.balance)}
+            )
+        page = {
+            "debts": debts_for_display,
+            "transactions": transactions,
+            "older": older,
+            "newer": newer,
+        }
+        page_cache.set(cache_key, page)
+    return page
+
+
+FORM_CLASS_CACHE_SIZE = 256
+
+
+class FormClassCache:
+    """
+    A thread-safe LRU of the dynamically generated transaction form classes,
+    so that their fields aren't rebuilt on every request. Classes are keyed
+    by the register's membership version, so a change of members makes
+    the register's old classes unreachable until they're evicted.
+    """
+
+    def __init__(self, maxsize: int = FORM_CLASS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._classes: collections.OrderedDict = collections.OrderedDict()
+        self._reset_stats()
+        os.register_at_fork(after_in_child=self._reset_stats)
+
+    def _reset_stats(self) -> None:
+        # a forked worker keeps the classes, but counts from zero, since its
+        # parent still reports its own counts, and locks with a lock of its own
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(
+        self,
+        register: Register,
+        kind: str,
+        generate: typing.Callable[[typing.Iterable[User]], type],
+    ) -> type:
+        key = (kind, register.pk, register.membership_version)
+        with self._lock:
+            form_class = self._classes.get(key)
+            if form_class is not None:
+                self._classes.move_to_end(key)
+                self.hits += 1
+                return form_class
+            self.misses += 1
+        # generated outside of the lock, a race only means
+        # the same class gets built twice
+        form_class = generate(register.users.all().order_by("username"))
+        with self._lock:
+            self._classes[key] = form_class
+            self._classes.move_to_end(key)
+            while len(self._classes) > self.maxsize:
+                self._classes.popitem(last=False)
+                self.evictions += 1
+        return form_class
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._classes),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def forget(self, register_ids: typing.Iterable[int]) -> None:
+        register_ids = set(register_ids)
+        with self._lock:
+            for key in [key for key in self._classes if key[1] in register_ids]:
+                del self._classes[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._classes.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+form_class_cache = FormClassCache()
+
+
+def new_transaction_form_class(register: Register) -> type:
+    return form_class_cache.get(
+        register, "transaction", generate_new_transaction_form_class
+    )
+
+
+def new_easy_transaction_form_class(register: Register) -> type:
+    return form_class_cache.get(
+        register, "easy_transaction", generate_new_easy_transaction_form_class
+    )
+
+
+def new_itemized_transaction_form_class(register: Register) -> type:
+    return form_class_cache.get(
+        register, "itemized_transaction", generate_new_itemized_transaction_form_class
+    )
+
+
+_deferred_membership_bumps: contextvars.ContextVar[typing.Optional[set]] = (
+    contextvars.ContextVar("deferred_membership_bumps", default=None)
+)
+
+
+def bump_membership_version(register_ids: typing.Iterable[int]) -> None:
+    """
+    Invalidate the cached form classes of registers. Other processes
+    see the new version, this one also drops its entries right away.
+    """
+    deferred = _deferred_membership_bumps.get()
+    if deferred is not None:
+        deferred.update(register_ids)
+        return
+    register_ids = list(register_ids)
+    Register.objects.filter(pk__in=register_ids).update(
+        membership_version=F("membership_version") + 1
+    )
+    form_class_cache.forget(register_ids)
+
+
+@contextlib.contextmanager
+def deferred_membership_bumps():
+    """
+    Gather the membership changes of the enclosed code, which would bump
+    the version once per changed Debt, into a single bump at its end.
+    """
+    deferred: set = set()
+    token = _deferred_membership_bumps.set(deferred)
+    try:
+        yield
+    finally:
+        _deferred_membership_bumps.reset(token)
+        if deferred:
+            bump_membership_version(deferred)
+
+
+@receiver(post_save, sender=Debt)
+def _debt_created(sender, instance, created, **kwargs):
+    if created:
+        bump_membership_version([instance.register_id])
+
+
+@receiver(post_delete, sender=Debt)
+def _debt_deleted(sender, instance, **kwargs):
+    bump_membership_version([instance.register_id])
+
+
+@receiver(m2m_changed, sender=Register.users.through)
+def _register_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        bump_membership_version([instance.pk])
+    elif action == "post_clear":
+        bump_membership_version(
+            Debt.objects.filter(user=instance).values_list("register_id", flat=True)
+        )
+    else:
+        bump_membership_version(pk_set)
+
+
+@receiver(post_save, sender=User)
+def _user_saved(sender, instance, created, update_fields, **kwargs):
+    # logging in saves only last_login, which doesn't show up in the forms
+    if created or (update_fields is not None and "username" not in update_fields):
+        return
+    bump_membership_version(
+        Debt.objects.filter(user=instance).values_list("register_id", flat=True)
+    )
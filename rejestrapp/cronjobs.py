@@ -1,11 +1,67 @@
+import logging
+import time
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from rejestrapp.metrics import cronjob_duration
 from rejestrapp.models import SignupToken
 
+logger = logging.getLogger(__name__)
 
-def delete_unfinished_users():
-    for token in SignupToken.objects.all():
-        User.objects.filter(email=token.email).delete()
-        token.delete()
+CLEANUP_CHUNK_SIZE = 500
+
+
+def delete_unfinished_users() -> dict:
+    """
+    Delete expired signup tokens along with the never activated accounts
+    they were issued for, CLEANUP_CHUNK_SIZE tokens per transaction.
+    """
+    now = timezone.now()
+    tokens_deleted = 0
+    users_deleted = 0
+    while True:
+        with transaction.atomic():
+            chunk = list(
+                SignupToken.objects.filter(expires_at__lte=now)
+                .order_by("expires_at")
+                .values_list("pk", "email")[:CLEANUP_CHUNK_SIZE]
+            )
+            if not chunk:
+                break
+            _, deleted_per_model = User.objects.filter(
+                email__in=[email for _, email in chunk], is_active=False
+            ).delete()
+            users_deleted += deleted_per_model.get(User._meta.label, 0)
+            tokens_deleted += SignupToken.objects.filter(
+                pk__in=[pk for pk, _ in chunk]
+            ).delete()[0]
+    return {"tokens_deleted": tokens_deleted, "users_deleted": users_deleted}
+
+
+def delete_expired_signup(username: str, email: str) -> None:
+    """
+    Delete the expired signup holding username or email right away,
+    so that signing up again doesn't have to wait for delete_unfinished_users.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(
+            SignupToken.objects.filter(expires_at__lte=now)
+            .filter(
+                Q(email=email.lower())
+                | Q(
+                    email__in=User.objects.filter(
+                        username=username, is_active=False
+                    ).values("email")
+                )
+            )
+            .values_list("email", flat=True)
+        )
+        if not emails:
+            return
+        User.objects.filter(email__in=emails, is_active=False).delete()
+        SignupToken.objects.filter(email__in=emails).delete()
 
 
 def do_cronjobs():
@@ -13,5 +69,13 @@ def do_cronjobs():
         delete_unfinished_users,
     ]
 
+    reports = {}
     for job in cronjobs:
-        job()
+        started = time.perf_counter()
+        report = job() or {}
+        duration = time.perf_counter() - started
+        cronjob_duration.observe(duration, job=job.__name__)
+        report["duration_s"] = round(duration, 3)
+        logger.info("cron job %s finished: %s", job.__name__, report)
+        reports[job.__name__] = report
+    return reports
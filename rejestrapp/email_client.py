@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+import typing
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .instrumentation import record_timing
+
+# the provider accepts at most this many messages in one bulk request
+BULK_MAX_MESSAGES = 500
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class EmailClient:
+    """
+    A client for the email provider's API that keeps its connections alive
+    between messages. Requests have bounded connect and read timeouts.
+    Failing to connect, as well as 429 and 503 responses (after which the
+    message certainly wasn't accepted), is retried with a jittered
+    exponential backoff. Errors after the request was sent are not retried
+    here, the outbox takes care of those. Counters of requests, errors and
+    latencies are available through stats().
+    """
+
+    def __init__(
+        self,
+        url: str,
+        bulk_url: str,
+        api_key: str,
+        pool_size: int = 4,
+        timeout: typing.Tuple[float, float] = (3.05, 10.0),
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+    ):
+        self.url = url
+        self.bulk_url = bulk_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "Content-Type": "application/json",
+                "X-Requested-With": "XMLHttpRequest",
+                "User-Agent": "RejestrSkladek",
+                "Authorization": f"Bearer {api_key}",
+            }
+        )
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            status_forcelist=(429, 503),
+            allowed_methods=frozenset({"POST"}),
+            backoff_factor=backoff_factor,
+            backoff_jitter=backoff_factor,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+        self._latency_sum = 0.0
+        self._latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def send(self, message: dict) -> requests.Response:
+        return self._post(self.url, message)
+
+    def send_bulk(self, messages: typing.List[dict]) -> requests.Response:
+        """
+        Send up to BULK_MAX_MESSAGES messages with a single request
+        to the bulk endpoint.
+        """
+        if len(messages) > BULK_MAX_MESSAGES:
+            raise ValueError(
+                f"at most {BULK_MAX_MESSAGES} messages can be sent at once"
+            )
+        return self._post(self.bulk_url, messages)
+
+    def _post(self, url: str, payload) -> requests.Response:
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = self.session.post(url, json=payload, timeout=self.timeout)
+            failed = not response.ok
+            return response
+        finally:
+            latency = time.perf_counter() - started
+            self._record(latency, failed)
+            record_timing("email", latency)
+
+    def _record(self, latency: float, failed: bool) -> None:
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and latency > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        with self._stats_lock:
+            self._requests += 1
+            self._errors += failed
+            self._latency_sum += latency
+            self._latency_buckets[bucket] += 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "requests": self._requests,
+                "errors": self._errors,
+                "latency_sum": self._latency_sum,
+                # non-cumulative counts, the last one is for latencies
+                # above the highest bucket
+                "latency_buckets": dict(
+                    zip([*LATENCY_BUCKETS, float("inf")], self._latency_buckets)
+                ),
+            }
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_client: typing.Optional[EmailClient] = None
+_client_lock = threading.Lock()
+
+
+def get_email_client() -> EmailClient:
+    """The process-wide client, created from settings on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = EmailClient(
+                settings.EMAIL_API_URL,
+                settings.EMAIL_API_BULK_URL,
+                settings.EMAIL_API_KEY,
+            )
+        return _client
+
+
+def _forget_email_client() -> None:
+    # a forked worker creates a client of its own instead of sharing
+    # the parent's connections and reporting the parent's counts again
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_email_client)
+
+
+@receiver(setting_changed)
+def reset_email_client(*, setting, **kwargs):
+    global _client
+    if setting.startswith("EMAIL_API"):
+        with _client_lock:
+            if _client is not None:
+                _client.close()
+            _client = None
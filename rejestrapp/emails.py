@@ -0,0 +1,192 @@
+import datetime
+import random
+import requests
+import typing
+from django.conf import settings
+from django.utils import timezone
+
+from .email_client import BULK_MAX_MESSAGES, get_email_client
+from .models import OutgoingEmail
+
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 30  # in seconds, doubled after every failed attempt
+OUTBOX_BACKOFF_MAX = 6 * 60 * 60
+# how long a worker owns the emails it has picked up
+OUTBOX_LEASE = datetime.timedelta(minutes=5)
+
+
+def enqueue_email(
+    to_email: str, to_name: str, subject: str, html: str
+) -> OutgoingEmail:
+    now = timezone.now()
+    return OutgoingEmail.objects.create(
+        to_email=to_email,
+        to_name=to_name,
+        subject=subject,
+        html=html,
+        created_at=now,
+        next_attempt_at=now,
+    )
+
+
+def email_api_message(email: OutgoingEmail) -> dict:
+    return {
+        "from": {
+            "email": settings.EMAIL_API_EMAIL_ADDRESS,
+            "name": "Rejestr Składek",
+        },
+        "to": [{"email": email.to_email, "name": email.to_name}],
+        "subject": email.subject,
+        "html": email.html,
+    }
+
+
+def send_email(email: OutgoingEmail) -> requests.Response:
+    return get_email_client().send(email_api_message(email))
+
+
+def retry_delay(attempts: int) -> datetime.timedelta:
+    """Exponential backoff with full jitter."""
+    ceiling = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+    return datetime.timedelta(seconds=random.uniform(ceiling / 2, ceiling))
+
+
+def is_retryable(status_code: int) -> bool:
+    # other client errors mean the message itself is wrong, retrying won't help
+    return status_code >= 500 or status_code in (408, 429)
+
+
+def claim_due_emails(batch_size: int) -> typing.List[OutgoingEmail]:
+    """
+    Pick up to batch_size due emails and lease them to this worker by moving
+    their next attempt into the future, so that concurrent workers skip them.
+    """
+    now = timezone.now()
+    due = OutgoingEmail.objects.filter(
+        status=OutgoingEmail.Status.PENDING, next_attempt_at__lte=now
+    ).order_by("next_attempt_at")[:batch_size]
+    claimed = []
+    for email in due:
+        leased = OutgoingEmail.objects.filter(
+            pk=email.pk, next_attempt_at=email.next_attempt_at
+        ).update(next_attempt_at=now + OUTBOX_LEASE)
+        if leased == 1:
+            claimed.append(email)
+    return claimed
+
+
+def send_outcome(
+    send: typing.Callable[[], requests.Response],
+) -> typing.Tuple[typing.Optional[str], bool]:
+    """Returns the error (None on success) and whether it's worth retrying."""
+    try:
+        response = send()
+    except requests.RequestException as exception:
+        return repr(exception), True
+    if response.ok:
+        return None, True
+    return f"HTTP {response.status_code}", is_retryable(response.status_code)
+
+
+def bulk_message_errors(response: requests.Response) -> typing.Dict[int, str]:
+    """
+    The errors of single messages of a bulk request by their index.
+    The provider reports them under "errors", keyed by the index of
+    the message followed by the field, e.g. "3.to.0.email".
+    """
+    try:
+        errors = response.json().get("errors")
+    except (ValueError, AttributeError):
+        return {}
+    if not isinstance(errors, dict):
+        return {}
+    by_index = {}
+    for key, messages in errors.items():
+        index, _, field = str(key).partition(".")
+        if not index.isdigit():
+            continue
+        message = messages[0] if isinstance(messages, list) and messages else messages
+        by_index.setdefault(int(index), f"{field}: {message}")
+    return by_index
+
+
+def bulk_send_outcomes(
+    send: typing.Callable[[], requests.Response], count: int
+) -> typing.List[typing.Tuple[typing.Optional[str], bool]]:
+    """
+    The outcome of each of the count messages of a bulk request, as returned
+    by send_outcome. Messages rejected on their own are not worth retrying.
+    When the provider refused the whole request because of them
+    the other messages weren't sent, but they can be retried.
+    """
+    try:
+        response = send()
+    except requests.RequestException as exception:
+        return [(repr(exception), True)] * count
+    error = None if response.ok else f"HTTP {response.status_code}"
+    errors = (
+        bulk_message_errors(response)
+        if response.ok or response.status_code == 422
+        else {}
+    )
+    if not errors:
+        return [(error, error is None or is_retryable(response.status_code))] * count
+    return [
+        (
+            (f"HTTP {response.status_code}: {errors[i]}", False)
+            if i in errors
+            else (error, True)
+        )
+        for i in range(count)
+    ]
+
+
+def record_outcome(
+    email: OutgoingEmail, error: typing.Optional[str], retryable: bool, counts: dict
+) -> None:
+    email.attempts += 1
+    now = timezone.now()
+    if error is None:
+        email.status = OutgoingEmail.Status.SENT
+        email.sent_at = now
+        email.last_error = ""
+        counts["sent"] += 1
+    elif retryable and email.attempts < OUTBOX_MAX_ATTEMPTS:
+        email.last_error = error
+        email.next_attempt_at = now + retry_delay(email.attempts)
+        counts["retried"] += 1
+    else:
+        email.last_error = error
+        email.status = OutgoingEmail.Status.DEAD
+        counts["dead"] += 1
+
+
+def drain_outbox(batch_size: int, bulk: bool = False) -> dict:
+    """
+    Send one batch of due emails, one by one or all at once through
+    the provider's bulk endpoint. Failed ones are retried later with
+    an exponential backoff, and after OUTBOX_MAX_ATTEMPTS attempts
+    (or an error that can't be fixed by retrying) they are dead-lettered.
+    Returns how many emails ended up in each of those states.
+    """
+    counts = {"sent": 0, "retried": 0, "dead": 0}
+    emails = claim_due_emails(batch_size)
+    if bulk:
+        for start in range(0, len(emails), BULK_MAX_MESSAGES):
+            chunk = emails[start : start + BULK_MAX_MESSAGES]
+            outcomes = bulk_send_outcomes(
+                lambda: get_email_client().send_bulk(
+                    [email_api_message(email) for email in chunk]
+                ),
+                len(chunk),
+            )
+            for email, (error, retryable) in zip(chunk, outcomes):
+                record_outcome(email, error, retryable, counts)
+    else:
+        for email in emails:
+            error, retryable = send_outcome(lambda: send_email(email))
+            record_outcome(email, error, retryable, counts)
+    OutgoingEmail.objects.bulk_update(
+        emails, ["status", "attempts", "last_error", "next_attempt_at", "sent_at"]
+    )
+    return counts
@@ -1,2 +1,18 @@
 class BadGroszeException(Exception):
     pass
+
+
+class VoteConflictException(Exception):
+    pass
+
+
+class StalePlanException(Exception):
+    pass
+
+
+class ImportFormatException(Exception):
+    pass
+
+
+class ItemsFormatException(Exception):
+    pass
@@ -0,0 +1,76 @@
+import csv
+import json
+import typing
+
+from .models import IndividualsTransaction, Register
+from .utils import gr_to_zl
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_COLUMNS = [
+    "transaction_id",
+    "transaction_name",
+    "init_date",
+    "is_settled",
+    "settle_date",
+    "username",
+    "amount",
+    "balance_before",
+]
+
+
+def export_rows(register: Register) -> typing.Iterator[dict]:
+    """
+    Every indiv of a register, oldest transactions first, read from
+    the database EXPORT_CHUNK_SIZE rows at a time.
+    """
+    rows = (
+        IndividualsTransaction.objects.filter(group_transaction__register=register)
+        .order_by(
+            "group_transaction__init_date", "group_transaction_id", "debt__user_id"
+        )
+        .values_list(
+            "group_transaction_id",
+            "group_transaction__name",
+            "group_transaction__init_date",
+            "group_transaction__is_settled",
+            "group_transaction__settle_date",
+            "debt__user__username",
+            "amount",
+            "balance_before",
+        )
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    )
+    for row in rows:
+        values = dict(zip(EXPORT_COLUMNS, row))
+        values["init_date"] = values["init_date"].isoformat()
+        if values["settle_date"] is not None:
+            values["settle_date"] = values["settle_date"].isoformat()
+        values["amount"] = gr_to_zl(values["amount"])
+        if values["balance_before"] is not None:
+            values["balance_before"] = gr_to_zl(values["balance_before"])
+        yield values
+
+
+class _Echo:
+    """A file-like object that hands back what's written to it."""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def csv_lines(rows: typing.Iterable[dict]) -> typing.Iterator[str]:
+    writer = csv.DictWriter(_Echo(), fieldnames=EXPORT_COLUMNS)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def jsonl_lines(rows: typing.Iterable[dict]) -> typing.Iterator[str]:
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+
+EXPORT_FORMATS = {
+    "csv": (csv_lines, "text/csv"),
+    "jsonl": (jsonl_lines, "application/jsonl"),
+}
@@ -59,6 +59,36 @@ class NewEasyTransactionFormBase(forms.Form):
     )
 
 
+class NewItemizedTransactionFormBase(NewEasyTransactionFormBase):
+    """
+    This class is used as a base for dynamically creating itemized
+    transaction form classes, where members pay for what they consumed.
+    Code that derives form classes from it should add fields
+    for the contributions of users.
+    """
+
+    items = forms.CharField(
+        label="Pozycje",
+        widget=forms.Textarea,
+        help_text=(
+            "Jedna pozycja w linii: nazwa; cena; kto z niej korzystał "
+            "(nazwy użytkowników po przecinku, puste oznacza wszystkich)"
+        ),
+        required=True,
+    )
+
+
+class ImportTransactionsForm(forms.Form):
+    """
+    Form for uploading a file with transactions to import into a register.
+    """
+
+    file = forms.FileField(label="Plik", required=True)
+    file_format = forms.ChoiceField(
+        label="Format", choices=[("csv", "CSV"), ("jsonl", "JSON lines")]
+    )
+
+
 class TransactionVoteForm(forms.Form):
     """
     Form for voting on a transaction.
@@ -0,0 +1,193 @@
+import csv
+import json
+import typing
+from django.db import transaction
+from django.utils import timezone
+
+from .caching import bump_register_version
+from .errors import BadGroszeException, ImportFormatException
+from .models import Debt, GroupTransaction, IndividualsTransaction, Register
+from .utils import zl_to_gr
+
+IMPORT_BATCH_SIZE = 500  # transactions per batch of inserts
+IMPORT_MAX_REPORTED_ERRORS = 100
+
+# (line number, transaction name, username -> amount in zloty or None
+# when the line couldn't be parsed)
+ImportRow = typing.Tuple[int, str, typing.Optional[typing.Dict[str, str]]]
+
+
+def csv_rows(lines: typing.Iterable[str]) -> typing.Iterator[ImportRow]:
+    """
+    Rows of a CSV file whose header is "name" followed by usernames,
+    and whose every line is a transaction's name and its amounts.
+    """
+    reader = csv.reader(lines)
+    try:
+        header = next(reader, None)
+        if not header or header[0].strip() != "name":
+            raise ImportFormatException('The first column should be called "name"')
+        usernames = [username.strip() for username in header[1:]]
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != len(header):
+                yield reader.line_num, row[0], None
+            else:
+                yield reader.line_num, row[0], dict(zip(usernames, row[1:]))
+    except csv.Error as error:
+        raise ImportFormatException(f"Line {reader.line_num}: {error}")
+
+
+def jsonl_rows(lines: typing.Iterable[str]) -> typing.Iterator[ImportRow]:
+    """
+    Rows of a JSON lines file where every line looks like
+    {"name": "Pizza", "amounts": {"username": "-12.50", ...}}.
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+            amounts = {
+                username: str(amount) for username, amount in data["amounts"].items()
+            }
+            yield line_number, str(data["name"]), amounts
+        except (ValueError, KeyError, TypeError, AttributeError):
+            yield line_number, "", None
+
+
+ROW_READERS = {"csv": csv_rows, "jsonl": jsonl_rows}
+
+
+def validate_row(
+    name: str,
+    amounts: typing.Optional[typing.Dict[str, str]],
+    debt_ids: typing.Mapping[str, int],
+) -> typing.Dict[int, int]:
+    """
+    Check a row the same way the new transaction form would and
+    return the amounts in grosze keyed by debt id.
+    """
+    if amounts is None:
+        raise ImportFormatException("Malformed line")
+    if not name.strip() or len(name) > 128:
+        raise ImportFormatException("Missing or too long transaction name")
+    amounts_by_debt = {}
+    for username, amount in amounts.items():
+        if username not in debt_ids:
+            raise ImportFormatException(f"{username!r} is not a member")
+        if amount.strip():
+            amounts_by_debt[debt_ids[username]] = zl_to_gr(amount)
+    if sum(amounts_by_debt.values()) != 0:
+        raise ImportFormatException("The amounts don't add up to zero")
+    return amounts_by_debt
+
+
+def create_transactions(
+    register: Register,
+    transactions: typing.Sequence[typing.Tuple[str, typing.Dict[int, int]]],
+    debt_ids: typing.Iterable[int],
+    batch_size: int = IMPORT_BATCH_SIZE,
+) -> typing.List[GroupTransaction]:
+    """
+    Create pending transactions out of (name, amounts by debt id) pairs
+    with one bulk insert of transactions and one of their indivs.
+    Members missing from the amounts get an indiv of 0.
+    """
+    debt_ids = list(debt_ids)
+    now = timezone.now()
+    with transaction.atomic():
+        group_transactions = GroupTransaction.objects.bulk_create(
+            GroupTransaction(
+                name=name,
+                init_date=now,
+                register=register,
+                member_count=len(debt_ids),
+            )
+            for name, _ in transactions
+        )
+        IndividualsTransaction.objects.bulk_create(
+            (
+                IndividualsTransaction(
+                    debt_id=debt_id,
+                    group_transaction=group_transaction,
+                    amount=amounts.get(debt_id, 0),
+                )
+                for (_, amounts), group_transaction in zip(
+                    transactions, group_transactions
+                )
+                for debt_id in debt_ids
+            ),
+            batch_size=batch_size,
+        )
+        bump_register_version(register)
+    return group_transactions
+
+
+def valid_rows(
+    rows: typing.Iterable[ImportRow],
+    debt_ids: typing.Mapping[str, int],
+    report: typing.Optional[dict] = None,
+) -> typing.Iterator[typing.Tuple[str, typing.Dict[int, int]]]:
+    """
+    (name, amounts by debt id) pairs of the valid rows. Invalid rows are
+    counted in the report, if there is one, along with their line numbers
+    (up to IMPORT_MAX_REPORTED_ERRORS of them).
+    """
+    for line_number, name, amounts in rows:
+        try:
+            amounts_by_debt = validate_row(name, amounts, debt_ids)
+        except (ImportFormatException, BadGroszeException) as error:
+            if report is not None:
+                report["skipped"] += 1
+                if len(report["errors"]) < IMPORT_MAX_REPORTED_ERRORS:
+                    report["errors"].append((line_number, str(error)))
+            continue
+        yield name.strip(), amounts_by_debt
+
+
+def rewinding(
+    read_rows: typing.Callable[[typing.TextIO], typing.Iterator[ImportRow]],
+    file: typing.TextIO,
+) -> typing.Callable[[], typing.Iterator[ImportRow]]:
+    """Read the rows of a seekable file from its beginning on every call."""
+
+    def rows():
+        file.seek(0)
+        return read_rows(file)
+
+    return rows
+
+
+def import_transactions(
+    register: Register,
+    read_rows: typing.Callable[[], typing.Iterable[ImportRow]],
+    batch_size: int = IMPORT_BATCH_SIZE,
+) -> dict:
+    """
+    Create a pending transaction for every valid row. The rows are read
+    twice: first only to check that the whole file can be read and to report
+    the invalid rows, so that nothing is written when it can't, and then to
+    write the valid ones batch_size at a time, each batch in a transaction
+    of its own with one bulk insert of transactions and one of their indivs.
+    That way neither memory use nor how long the database stays locked
+    for writing depends on the number of rows.
+    """
+    debt_ids = dict(
+        Debt.objects.filter(register=register).values_list("user__username", "pk")
+    )
+    report: dict = {"imported": 0, "skipped": 0, "errors": []}
+    for _ in valid_rows(read_rows(), debt_ids, report):
+        pass
+    batch: typing.List[typing.Tuple[str, typing.Dict[int, int]]] = []
+    for row in valid_rows(read_rows(), debt_ids):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            create_transactions(register, batch, debt_ids.values(), batch_size)
+            report["imported"] += len(batch)
+            batch.clear()
+    if batch:
+        create_transactions(register, batch, debt_ids.values(), batch_size)
+        report["imported"] += len(batch)
+    return report
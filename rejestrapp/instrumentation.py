@@ -0,0 +1,173 @@
+"""
+Per-request timings: how many queries a request made and how long they
+took, how long its templates took to render, how long it waited for
+the email provider and how long it took altogether. A sample of requests,
+REQUEST_INSTRUMENTATION_SAMPLE_RATE of them, gets measured. Their timings
+are sent back in a Server-Timing header, which browsers show
+in their developer tools, and logged as JSON by rejestrapp.instrumentation.
+"""
+
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import time
+import typing
+from django.conf import settings
+from django.db import connections
+from django.template.backends.django import DjangoTemplates, Template
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.renders = 0
+        self.templates = 0.0
+        # other waits, in seconds, by name
+        self.other: typing.DefaultDict[str, float] = collections.defaultdict(float)
+
+    def count_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db += time.perf_counter() - started
+
+
+_current: contextvars.ContextVar[typing.Optional[RequestTimings]] = (
+    contextvars.ContextVar("request_timings", default=None)
+)
+# the timings whose count_query wraps the connections, if any
+_counting: contextvars.ContextVar[typing.Optional[RequestTimings]] = (
+    contextvars.ContextVar("counting_timings", default=None)
+)
+
+
+@contextlib.contextmanager
+def counting_queries() -> typing.Iterator[RequestTimings]:
+    """
+    Count the queries made within the block, and the time they took,
+    into the timings it yields. Nested blocks yield the timings of the
+    outermost one, so that the connections are wrapped once per request
+    however many middlewares want to know about its queries.
+    """
+    timings = _counting.get()
+    if timings is not None:
+        yield timings
+        return
+    timings = RequestTimings()
+    token = _counting.set(timings)
+    try:
+        with contextlib.ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(
+                    connections[alias].execute_wrapper(timings.count_query)
+                )
+            yield timings
+    finally:
+        _counting.reset(token)
+
+
+def record_timing(name: str, seconds: float) -> None:
+    """
+    Add seconds spent waiting for name to the timings of the current
+    request, if it's being measured.
+    """
+    timings = _current.get()
+    if timings is not None:
+        timings.other[name] += seconds
+
+
+class InstrumentedTemplate(Template):
+    def render(self, context=None, request=None):
+        timings = _current.get()
+        if timings is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timings.renders += 1
+            timings.templates += time.perf_counter() - started
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """
+    The usual template backend, except that its templates
+    add their render times to the timings of the current request.
+    Templates included by other templates count towards their parents.
+    """
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        # the parent turns TemplateDoesNotExist into the backend-agnostic one
+        return InstrumentedTemplate(super().get_template(template_name).template, self)
+
+
+def server_timing(timings: RequestTimings, total: float) -> str:
+    metrics = [
+        f'db;dur={timings.db * 1000:.1f};desc="{timings.queries} queries"',
+        f'tpl;dur={timings.templates * 1000:.1f};desc="{timings.renders} renders"',
+    ]
+    metrics += [
+        f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.other.items()
+    ]
+    metrics.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(metrics)
+
+
+class RequestInstrumentationMiddleware:
+    """
+    Measure a sample of requests. Requests left out of the sample aren't
+    slowed down by anything besides a call to random(). Should come first,
+    so that the time spent in other middleware is counted as well.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sample_rate = settings.REQUEST_INSTRUMENTATION_SAMPLE_RATE
+        if sample_rate <= 0 or random.random() >= sample_rate:
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        with counting_queries() as timings:
+            token = _current.set(timings)
+            try:
+                response = self.get_response(request)
+            finally:
+                total = time.perf_counter() - started
+                _current.reset(token)
+
+        response["Server-Timing"] = server_timing(timings, total)
+        match = request.resolver_match
+        logger.info(
+            json.dumps(
+                {
+                    "method": request.method,
+                    "path": request.path,
+                    "view": match.view_name if match is not None else None,
+                    "status": response.status_code,
+                    "total_ms": round(total * 1000, 3),
+                    "db_queries": timings.queries,
+                    "db_ms": round(timings.db * 1000, 3),
+                    "template_renders": timings.renders,
+                    "template_ms": round(timings.templates * 1000, 3),
+                    **{
+                        f"{name}_ms": round(seconds * 1000, 3)
+                        for name, seconds in timings.other.items()
+                    },
+                },
+                separators=(",", ":"),
+            )
+        )
+        return response
@@ -0,0 +1,80 @@
+import heapq
+import typing
+
+from .errors import BadGroszeException, ItemsFormatException
+from .utils import zl_to_gr
+
+ITEMS_MAX_LINES = 1000
+
+
+class Item(typing.NamedTuple):
+    price: int  # w groszach
+    consumers: typing.FrozenSet[int]  # user ids
+
+
+def parse_items(text: str, user_ids: typing.Mapping[str, int]) -> typing.List[Item]:
+    """
+    Items written one per line as "name; price; username, username".
+    Leaving out the usernames means that everyone consumed the item.
+    """
+    everyone = frozenset(user_ids.values())
+    items = []
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        raise ItemsFormatException("Nie podano żadnej pozycji")
+    if len(lines) > ITEMS_MAX_LINES:
+        raise ItemsFormatException(f"Można podać najwyżej {ITEMS_MAX_LINES} pozycji")
+    for line_number, line in enumerate(lines, start=1):
+        parts = line.split(";")
+        if len(parts) not in (2, 3):
+            raise ItemsFormatException(f"Pozycja nr {line_number} jest niepoprawna")
+        try:
+            price = zl_to_gr(parts[1])
+        except BadGroszeException:
+            raise ItemsFormatException(f"Zła cena w pozycji nr {line_number}")
+        if price < 0:
+            raise ItemsFormatException(f"Ujemna cena w pozycji nr {line_number}")
+        usernames = [u.strip() for u in parts[2].split(",")] if len(parts) == 3 else []
+        usernames = [username for username in usernames if username]
+        unknown = [username for username in usernames if username not in user_ids]
+        if unknown:
+            raise ItemsFormatException(
+                f"{unknown[0]} z pozycji nr {line_number} nie jest członkiem rejestru"
+            )
+        consumers = frozenset(user_ids[username] for username in usernames)
+        items.append(Item(price, consumers or everyone))
+    return items
+
+
+def split_items(
+    items: typing.Iterable[Item], contributions: typing.Mapping[int, int]
+) -> typing.Dict[int, int]:
+    """
+    Every member's balance change: the sum of their shares of the items
+    they consumed minus their contribution. Items with the same consumers
+    are priced together first, so a receipt is split in a single pass
+    over its items plus one pass per distinct group of consumers.
+    Each group's price is divided evenly and the grosze that don't divide
+    go, one each, to the group's members who have been given the fewest
+    of them so far (lowest user id first), so the result is deterministic.
+    The items' consumers have to be keys of contributions.
+    """
+    group_prices: typing.Dict[typing.FrozenSet[int], int] = {}
+    for item in items:
+        group_prices[item.consumers] = group_prices.get(item.consumers, 0) + item.price
+    changes = {
+        user_id: -contribution for user_id, contribution in contributions.items()
+    }
+    extra_grosze = dict.fromkeys(contributions, 0)
+    for consumers, price in sorted(
+        group_prices.items(), key=lambda group: sorted(group[0])
+    ):
+        share, leftover = divmod(price, len(consumers))
+        for user_id in consumers:
+            changes[user_id] += share
+        for user_id in heapq.nsmallest(
+            leftover, consumers, key=lambda u: (extra_grosze[u], u)
+        ):
+            changes[user_id] += 1
+            extra_grosze[user_id] += 1
+    return changes
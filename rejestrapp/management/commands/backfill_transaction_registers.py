@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from rejestrapp.settlement import backfill_transaction_registers
+
+
+class Command(BaseCommand):
+    help = (
+        "Set the register of transactions that don't have one yet, "
+        "based on the debts of their indivs."
+    )
+
+    def handle(self, *args, **options):
+        updated = backfill_transaction_registers()
+        self.stdout.write(f"Set the register of {updated} transactions")
@@ -0,0 +1,127 @@
+import json
+import queue
+import random
+import statistics
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Sum
+
+from rejestrapp.benchmarking import (
+    make_register,
+    make_transaction,
+    percentile,
+    throwaway_database,
+)
+from rejestrapp.models import Debt, GroupTransaction, IndividualsTransaction
+from rejestrapp.settlement import VOTE_SETTLED, cast_vote
+
+
+class Command(BaseCommand):
+    help = (
+        "Fire concurrent votes at the voting engine in a throwaway database, "
+        "report throughput and lock wait times and check that every transaction "
+        "was settled exactly once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, default=10)
+        parser.add_argument("--transactions", type=int, default=30)
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        with throwaway_database():
+            report = self.run(
+                rng, options["members"], options["transactions"], options["threads"]
+            )
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def run(self, rng, member_count, transaction_count, thread_count):
+        register, users = make_register(member_count)
+        expected_balances = {user.pk: 0 for user in users}
+        votes = []
+        for i in range(transaction_count):
+            amounts = {user.pk: rng.randint(-5000, 5000) for user in users[1:]}
+            amounts[users[0].pk] = -sum(amounts.values())
+            for user_id, amount in amounts.items():
+                expected_balances[user_id] += amount
+            group_transaction = make_transaction(register, amounts, f"bench_{i}")
+            votes.extend((group_transaction.pk, user) for user in users)
+        rng.shuffle(votes)
+        connection.close()
+
+        work: queue.Queue = queue.Queue()
+        for vote in votes:
+            work.put(vote)
+        results = []
+        errors = []
+        results_lock = threading.Lock()
+
+        def worker():
+            try:
+                while True:
+                    try:
+                        group_transaction_id, user = work.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        result = cast_vote(
+                            register, group_transaction_id, user, True, False
+                        )
+                    except Exception as error:
+                        with results_lock:
+                            errors.append(repr(error))
+                        continue
+                    with results_lock:
+                        results.append(result)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        settle_count = sum(1 for result in results if result.outcome == VOTE_SETTLED)
+        self.check_applied_exactly_once(
+            transaction_count, settle_count, expected_balances, errors
+        )
+        lock_waits = sorted(result.lock_wait for result in results)
+        return {
+            "members": member_count,
+            "transactions": transaction_count,
+            "threads": thread_count,
+            "votes": len(votes),
+            "elapsed_s": round(elapsed, 4),
+            "votes_per_s": round(len(votes) / elapsed, 1),
+            "retried_votes": sum(1 for result in results if result.attempts > 1),
+            "max_attempts": max(result.attempts for result in results),
+            "lock_wait_mean_ms": round(statistics.fmean(lock_waits) * 1000, 3),
+            "lock_wait_p95_ms": round(percentile(lock_waits, 0.95) * 1000, 3),
+            "lock_wait_max_ms": round(lock_waits[-1] * 1000, 3),
+        }
+
+    def check_applied_exactly_once(
+        self, transaction_count, settle_count, expected_balances, errors
+    ):
+        if errors:
+            raise CommandError(f"{len(errors)} votes failed, first: {errors[0]}")
+        if settle_count != transaction_count:
+            raise CommandError(
+                f"{settle_count} settling votes for {transaction_count} transactions"
+            )
+        if GroupTransaction.objects.filter(is_settled=False).exists():
+            raise CommandError("Some transactions were never settled")
+        if IndividualsTransaction.objects.filter(balance_before=None).exists():
+            raise CommandError("Some indivs are missing their balance snapshot")
+        balances = dict(Debt.objects.values_list("user_id", "balance"))
+        if balances != expected_balances:
+            raise CommandError("Balances don't match the settled amounts")
+        if Debt.objects.aggregate(total=Sum("balance"))["total"] != 0:
+            raise CommandError("Balances don't add up to zero")
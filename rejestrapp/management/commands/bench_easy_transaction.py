@@ -0,0 +1,117 @@
+import json
+import random
+import statistics
+import time
+from django.db import connection
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+
+from rejestrapp.benchmarking import make_register, throwaway_database
+from rejestrapp.models import Debt, GroupTransaction
+from rejestrapp.views import NewEasyTransactionView
+
+
+class Command(BaseCommand):
+    help = (
+        "Time POSTs to the simplified transaction view on registers "
+        "of growing size in a throwaway database, next to the previous "
+        "per-member scan and INSERT, and report their query counts."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        # a form with a field per member goes over Django's default
+        # limit of 1000 fields on the largest registers
+        with throwaway_database(), override_settings(
+            DATA_UPLOAD_MAX_NUMBER_FIELDS=None
+        ):
+            report = [self.run(size, options["repeat"]) for size in options["sizes"]]
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def run(self, size, repeat):
+        register, users = make_register(size, name=f"bench_{size}")
+        # the first member paid for everything
+        contributions = {user.pk: 0 for user in users}
+        contributions[users[0].pk] = 1000 * size + 7
+        data = {
+            f"value_for_{user_id}": f"{amount / 100:.2f}"
+            for user_id, amount in contributions.items()
+        }
+        data.update(
+            {
+                "transaction_name": "bench",
+                "expense": f"{sum(contributions.values()) / 100:.2f}",
+            }
+        )
+        view = NewEasyTransactionView.as_view()
+        factory = RequestFactory()
+
+        def post():
+            request = factory.post("/", data)
+            request.user = users[0]
+            response = view(request, register_id=register.pk)
+            assert response.status_code == 302, response.status_code
+
+        def legacy():
+            self.legacy_split_and_insert(register, contributions)
+
+        view_ms, view_queries = self.time(post, repeat)
+        legacy_ms, legacy_queries = self.time(legacy, repeat)
+        return {
+            "members": size,
+            "view_median_ms": view_ms,
+            "view_queries": view_queries,
+            "legacy_split_and_insert_median_ms": legacy_ms,
+            "legacy_split_and_insert_queries": legacy_queries,
+        }
+
+    def legacy_split_and_insert(self, register, contributions):
+        """
+        The split and inserts as NewEasyTransactionView did them before:
+        a linear scan for every member's amount and an INSERT per member.
+        """
+        expense = sum(contributions.values())
+        users_with_changes = []
+        divided_expense = expense // len(contributions)
+        for u, c in contributions.items():
+            users_with_changes.append([u, divided_expense - c])
+        leftover = expense - divided_expense * len(contributions)
+        for charged in random.sample(users_with_changes, leftover):
+            charged[1] += 1
+        debts = Debt.objects.filter(register=register).select_related("user")
+        group_transaction = GroupTransaction.objects.create(
+            name="bench",
+            init_date=timezone.now(),
+            register=register,
+            member_count=len(debts),
+        )
+        for debt in debts:
+            group_transaction.debts.add(
+                debt,
+                through_defaults={
+                    "amount": next(
+                        uc for uc in users_with_changes if uc[0] == debt.user.pk
+                    )[1]
+                },
+            )
+
+    def time(self, request, repeat):
+        timings = []
+        query_count = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal query_count
+            query_count += 1
+            return execute(sql, params, many, context)
+
+        for _ in range(repeat):
+            query_count = 0
+            with connection.execute_wrapper(count_queries):
+                started = time.perf_counter()
+                request()
+                timings.append(time.perf_counter() - started)
+        return round(statistics.median(timings) * 1000, 3), query_count
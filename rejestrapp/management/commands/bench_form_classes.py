@@ -0,0 +1,56 @@
+import json
+import statistics
+import time
+from django.core.management.base import BaseCommand
+
+from rejestrapp.benchmarking import make_register, throwaway_database
+from rejestrapp.caching import FormClassCache
+from rejestrapp.models import Register
+from rejestrapp.utils import generate_new_transaction_form_class
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare building the new transaction form class on every request "
+        "with taking it from the form class cache, in a throwaway database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+        parser.add_argument("--repeat", type=int, default=50)
+
+    def handle(self, *args, **options):
+        with throwaway_database():
+            report = [self.run(size, options["repeat"]) for size in options["sizes"]]
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def run(self, size, repeat):
+        register, _ = make_register(size, name=f"bench_{size}")
+        register = Register.objects.get(pk=register.pk)
+        cache = FormClassCache()
+
+        def uncached():
+            generate_new_transaction_form_class(
+                register.users.all().order_by("username")
+            )()
+
+        def cached():
+            cache.get(register, "transaction", generate_new_transaction_form_class)()
+
+        uncached_ms = self.time(uncached, repeat)
+        cached_ms = self.time(cached, repeat)
+        return {
+            "members": size,
+            "uncached_median_ms": uncached_ms,
+            "cached_median_ms": cached_ms,
+            "saving_per_request_ms": round(uncached_ms - cached_ms, 3),
+            "cache": cache.stats(),
+        }
+
+    def time(self, request, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            request()
+            timings.append(time.perf_counter() - started)
+        return round(statistics.median(timings) * 1000, 3)
@@ -0,0 +1,58 @@
+import json
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+
+from rejestrapp.itemized import Item, split_items
+
+
+class Command(BaseCommand):
+    help = "Time the itemized split of random receipts on registers " "of growing size."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 1000])
+        parser.add_argument("--items", type=int, default=500)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        report = []
+        for size in options["members"]:
+            members = list(range(size))
+            timings = []
+            for _ in range(options["repeat"]):
+                items = self.random_receipt(rng, members, options["items"])
+                contributions = dict.fromkeys(members, 0)
+                contributions[0] = sum(item.price for item in items)
+                started = time.perf_counter()
+                changes = split_items(items, contributions)
+                timings.append(time.perf_counter() - started)
+                assert sum(changes.values()) == 0
+            report.append(
+                {
+                    "members": size,
+                    "items": options["items"],
+                    "median_ms": round(statistics.median(timings) * 1000, 3),
+                    "max_ms": round(max(timings) * 1000, 3),
+                }
+            )
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def random_receipt(self, rng, members, item_count):
+        """
+        Every fifth item is shared by everyone, the rest by a few members.
+        """
+        everyone = frozenset(members)
+        return [
+            Item(
+                rng.randint(1, 20000),
+                (
+                    everyone
+                    if i % 5 == 0
+                    else frozenset(rng.sample(members, min(len(members), 4)))
+                ),
+            )
+            for i in range(item_count)
+        ]
@@ -0,0 +1,52 @@
+import json
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+
+from rejestrapp.settle_up import plan_transfers
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the settle-up planner on random registers of growing size "
+        "and report how many transfers it plans."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000]
+        )
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        report = []
+        for size in options["sizes"]:
+            timings = []
+            transfer_counts = []
+            for _ in range(options["repeat"]):
+                balances = self.random_balances(rng, size)
+                started = time.perf_counter()
+                transfers = plan_transfers(balances)
+                timings.append(time.perf_counter() - started)
+                transfer_counts.append(len(transfers))
+            report.append(
+                {
+                    "members": size,
+                    "median_ms": round(statistics.median(timings) * 1000, 3),
+                    "max_ms": round(max(timings) * 1000, 3),
+                    "mean_transfers": statistics.fmean(transfer_counts),
+                    # n - 1 transfers always suffice
+                    "transfers_per_member": round(
+                        statistics.fmean(transfer_counts) / size, 3
+                    ),
+                }
+            )
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def random_balances(self, rng, size):
+        balances = {user_id: rng.randint(-50000, 50000) for user_id in range(size)}
+        balances[0] -= sum(balances.values())
+        return balances
@@ -0,0 +1,132 @@
+import json
+import random
+import threading
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, transaction
+
+from rejestrapp.benchmarking import make_register, make_transaction, throwaway_database
+from rejestrapp.importing import create_transactions
+from rejestrapp.models import Debt, GroupTransaction
+from rejestrapp.utils import transaction_history_page
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare mixed read and write throughput of SQLite with its defaults "
+        "and with the pragmas and transaction mode from the settings, "
+        "each in a throwaway database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, default=20)
+        parser.add_argument("--readers", type=int, default=8)
+        parser.add_argument("--writers", type=int, default=4)
+        parser.add_argument("--seconds", type=float, default=5.0)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("This benchmark is only meant for SQLite")
+        tuned_options = settings.DATABASES["default"].get("OPTIONS", {})
+        report = {}
+        for name, database_options in [("defaults", {}), ("tuned", tuned_options)]:
+            old_options = connection.settings_dict.get("OPTIONS", {})
+            connection.settings_dict["OPTIONS"] = dict(database_options)
+            connection.close()
+            try:
+                with throwaway_database():
+                    report[name] = self.run(options)
+            finally:
+                connection.settings_dict["OPTIONS"] = old_options
+                connection.close()
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def run(self, options):
+        rng = random.Random(options["seed"])
+        register, users = make_register(options["members"])
+        for i in range(50):
+            make_transaction(register, {}, f"seed_{i}")
+        debt_ids = list(
+            Debt.objects.filter(register=register).values_list("pk", flat=True)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            journal_mode = cursor.fetchone()[0]
+        connection.close()
+
+        counts = {"reads": 0, "writes": 0, "lock_errors": 0}
+        write_latencies = []
+        counts_lock = threading.Lock()
+        deadline = time.perf_counter() + options["seconds"]
+
+        def read():
+            transaction_history_page(
+                GroupTransaction.objects.filter(register=register), None, None, 20
+            )
+            list(Debt.objects.filter(register=register).values("user_id", "balance"))
+
+        def write():
+            # reads before it writes, like settling a transaction does
+            with transaction.atomic():
+                payer, payee = rng.sample(
+                    list(
+                        Debt.objects.filter(register=register).values_list(
+                            "pk", flat=True
+                        )
+                    ),
+                    2,
+                )
+                amount = rng.randint(1, 10000)
+                create_transactions(
+                    register, [("bench", {payer: -amount, payee: amount})], debt_ids
+                )
+
+        def worker(operation, counter):
+            try:
+                while time.perf_counter() < deadline:
+                    started = time.perf_counter()
+                    try:
+                        operation()
+                    except OperationalError as error:
+                        if "locked" not in str(error):
+                            raise
+                        with counts_lock:
+                            counts["lock_errors"] += 1
+                        continue
+                    with counts_lock:
+                        counts[counter] += 1
+                        if operation is write:
+                            write_latencies.append(time.perf_counter() - started)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=worker, args=(read, "reads"))
+            for _ in range(options["readers"])
+        ] + [
+            threading.Thread(target=worker, args=(write, "writes"))
+            for _ in range(options["writers"])
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return {
+            "journal_mode": journal_mode,
+            "reads_per_s": round(counts["reads"] / elapsed, 1),
+            "writes_per_s": round(counts["writes"] / elapsed, 1),
+            "lock_errors": counts["lock_errors"],
+            "write_p95_ms": (
+                round(
+                    sorted(write_latencies)[int(0.95 * (len(write_latencies) - 1))]
+                    * 1000,
+                    3,
+                )
+                if write_latencies
+                else None
+            ),
+        }
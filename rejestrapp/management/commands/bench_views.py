@@ -0,0 +1,243 @@
+import itertools
+import json
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from rejestrapp.benchmarking import (
+    add_register,
+    make_history,
+    make_register,
+    make_transaction,
+    percentile,
+    throwaway_database,
+)
+from rejestrapp.models import GroupTransaction
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill a throwaway database with registers of the given size, "
+        "request every page of a register in-process as one of its members "
+        "and report the p50 and p95 latency and the query count "
+        "of every view as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, default=20)
+        parser.add_argument(
+            "--registers",
+            type=int,
+            default=5,
+            help="Registers the measured user is a member of",
+        )
+        parser.add_argument(
+            "--transactions", type=int, default=500, help="Transactions per register"
+        )
+        parser.add_argument(
+            "--pending",
+            type=float,
+            default=0.1,
+            help="Share of the transactions still waiting for votes",
+        )
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument(
+            "--warmup",
+            type=int,
+            default=1,
+            help="Untimed requests made to every view before the timed ones",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options["members"] < 2:
+            raise CommandError("A register needs at least 2 members here")
+        if not 0 <= options["pending"] <= 1:
+            raise CommandError("--pending should be between 0 and 1")
+        # the test client's host, and a field per member on the largest
+        # registers goes over Django's default limit of 1000 fields
+        with throwaway_database(), override_settings(
+            ALLOWED_HOSTS=["testserver"], DATA_UPLOAD_MAX_NUMBER_FIELDS=None
+        ):
+            report = {
+                "parameters": {
+                    name: options[name]
+                    for name in [
+                        "members",
+                        "registers",
+                        "transactions",
+                        "pending",
+                        "repeat",
+                        "warmup",
+                        "seed",
+                    ]
+                },
+                "views": self.run(options),
+            }
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def run(self, options):
+        rng = random.Random(options["seed"])
+        register, users = make_register(options["members"])
+        make_history(register, options["transactions"], options["pending"], rng)
+        for i in range(1, options["registers"]):
+            make_history(
+                add_register(users, f"bench_{i}"),
+                options["transactions"],
+                options["pending"],
+                rng,
+            )
+        member = users[0]
+        pending_transaction = (
+            GroupTransaction.objects.filter(register=register, is_settled=False)
+            .order_by("-init_date")
+            .first()
+        )
+        if pending_transaction is None:
+            # there's always something to vote on
+            pending_transaction = make_transaction(register, {})
+        client = Client()
+        client.force_login(member)
+        register_kwargs = {"register_id": register.pk}
+        value_fields = {f"value_for_{user.pk}": "0" for user in users}
+        invited_registers = itertools.count()
+
+        def invited_register():
+            # a fresh invitation for every request, since answering it
+            # (or rejecting it, which deletes the register) uses it up
+            return {
+                "register_id": add_register(
+                    users, f"invite_{next(invited_registers)}", accepted=False
+                ).pk
+            }
+
+        def get(name, kwargs=None):
+            return lambda: (reverse(f"rejestrapp:{name}", kwargs=kwargs), None)
+
+        def post(name, kwargs, data):
+            return lambda: (
+                reverse(
+                    f"rejestrapp:{name}",
+                    kwargs=kwargs() if callable(kwargs) else kwargs,
+                ),
+                data() if callable(data) else data,
+            )
+
+        votes = itertools.cycle(["on", ""])
+        transaction_kwargs = {
+            "register_id": register.pk,
+            "group_transaction_id": pending_transaction.pk,
+        }
+        scenarios = [
+            ("userspace", "GET", get("userspace")),
+            ("register", "GET", get("register", register_kwargs)),
+            ("transaction_vote", "GET", get("transaction_vote", transaction_kwargs)),
+            (
+                "transaction_vote",
+                "POST",
+                post(
+                    "transaction_vote",
+                    transaction_kwargs,
+                    lambda: {"supports": next(votes)},
+                ),
+            ),
+            ("new_transaction", "GET", get("new_transaction", register_kwargs)),
+            (
+                "new_transaction",
+                "POST",
+                post(
+                    "new_transaction",
+                    register_kwargs,
+                    {
+                        **value_fields,
+                        f"value_for_{users[0].pk}": "-12.34",
+                        f"value_for_{users[1].pk}": "12.34",
+                        "transaction_name": "bench",
+                    },
+                ),
+            ),
+            (
+                "new_easy_transaction",
+                "GET",
+                get("new_easy_transaction", register_kwargs),
+            ),
+            (
+                "new_easy_transaction",
+                "POST",
+                post(
+                    "new_easy_transaction",
+                    register_kwargs,
+                    {
+                        **value_fields,
+                        f"value_for_{member.pk}": "12.34",
+                        "transaction_name": "bench",
+                        "expense": "12.34",
+                    },
+                ),
+            ),
+            (
+                "new_itemized_transaction",
+                "GET",
+                get("new_itemized_transaction", register_kwargs),
+            ),
+            (
+                "new_itemized_transaction",
+                "POST",
+                post(
+                    "new_itemized_transaction",
+                    register_kwargs,
+                    {
+                        **value_fields,
+                        f"value_for_{member.pk}": "12.34",
+                        "transaction_name": "bench",
+                        "expense": "12.34",
+                        "items": f"pizza; 10.00\nnapój; 2.34; {users[1].username}",
+                    },
+                ),
+            ),
+            ("invite", "GET", lambda: get("invite", invited_register())()),
+            ("invite_accept", "POST", post("invite_accept", invited_register, {})),
+            ("invite_reject", "POST", post("invite_reject", invited_register, {})),
+        ]
+        return {
+            f"{method} {name}": self.measure(client, method, prepare, options)
+            for name, method, prepare in scenarios
+        }
+
+    def measure(self, client, method, prepare, options):
+        timings = []
+        query_counts = []
+        query_count = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal query_count
+            query_count += 1
+            return execute(sql, params, many, context)
+
+        for i in range(options["warmup"] + options["repeat"]):
+            path, data = prepare()
+            query_count = 0
+            with connection.execute_wrapper(count_queries):
+                started = time.perf_counter()
+                if method == "GET":
+                    response = client.get(path, secure=True)
+                else:
+                    response = client.post(path, data, secure=True)
+                elapsed = time.perf_counter() - started
+            if response.status_code not in (200, 302):
+                raise CommandError(
+                    f"{method} {path} answered with {response.status_code}"
+                )
+            if i >= options["warmup"]:
+                timings.append(elapsed)
+                query_counts.append(query_count)
+        return {
+            "p50_ms": round(percentile(timings, 0.5) * 1000, 3),
+            "p95_ms": round(percentile(timings, 0.95) * 1000, 3),
+            "queries_p50": statistics.median_low(query_counts),
+            "queries_max": max(query_counts),
+        }
@@ -0,0 +1,54 @@
+import shutil
+import sys
+import tempfile
+from django.core.management.base import BaseCommand, CommandError
+
+from rejestrapp.errors import ImportFormatException
+from rejestrapp.importing import (
+    IMPORT_BATCH_SIZE,
+    ROW_READERS,
+    import_transactions,
+    rewinding,
+)
+from rejestrapp.models import Register
+
+
+class Command(BaseCommand):
+    help = (
+        "Import transactions into a register from a CSV or JSON lines file "
+        '("-" reads from the standard input). Every row becomes a pending '
+        "transaction."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("register_id", type=int)
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=sorted(ROW_READERS), default="csv")
+        parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            register = Register.objects.get(pk=options["register_id"])
+        except Register.DoesNotExist:
+            raise CommandError("There is no such register")
+        read_rows = ROW_READERS[options["format"]]
+        if options["path"] == "-":
+            # the rows are read twice, and the standard input can't be rewound
+            with tempfile.TemporaryFile("w+", encoding="utf-8", newline="") as file:
+                shutil.copyfileobj(sys.stdin, file)
+                report = self.run(register, read_rows, file, options["batch_size"])
+        else:
+            with open(options["path"], encoding="utf-8", newline="") as file:
+                report = self.run(register, read_rows, file, options["batch_size"])
+        for line_number, error in report["errors"]:
+            self.stderr.write(f"line {line_number}: {error}")
+        self.stdout.write(
+            f"Imported {report['imported']} transactions, "
+            f"skipped {report['skipped']} rows"
+        )
+
+    def run(self, register, read_rows, file, batch_size):
+        try:
+            return import_transactions(register, rewinding(read_rows, file), batch_size)
+        except ImportFormatException as error:
+            raise CommandError(str(error))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rejestrapp.settlement import recount_votes, vote_count_mismatches
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the support, remove and member counters of every transaction "
+        "from its indivs and fix the ones that don't match."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only verify the counters and fail if any of them are wrong.",
+        )
+
+    def handle(self, *args, **options):
+        if options["check"]:
+            mismatched = vote_count_mismatches().values_list("pk", flat=True)
+            if mismatched:
+                raise CommandError(
+                    "Wrong vote counters in transactions: "
+                    + ", ".join(str(pk) for pk in mismatched)
+                )
+            self.stdout.write("All vote counters are correct")
+        else:
+            corrected = recount_votes()
+            self.stdout.write(f"Corrected vote counters of {corrected} transactions")
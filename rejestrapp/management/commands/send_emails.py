@@ -0,0 +1,44 @@
+import time
+from django.core.management.base import BaseCommand
+
+from rejestrapp.emails import drain_outbox
+
+# for its collector of the email client's counts, which this worker
+# has to report, although it never answers a request
+from rejestrapp.metrics import registry  # noqa: F401
+
+
+class Command(BaseCommand):
+    help = "Send the emails waiting in the outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument(
+            "--bulk",
+            action="store_true",
+            help="Send every batch with a single request to the bulk endpoint.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep draining the outbox instead of sending a single batch.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5.0,
+            help="Seconds to wait after a batch that found nothing to send.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            counts = drain_outbox(options["batch_size"], options["bulk"])
+            if any(counts.values()):
+                self.stdout.write(
+                    f"sent: {counts['sent']}, retried: {counts['retried']}, "
+                    f"dead: {counts['dead']}"
+                )
+            if not options["loop"]:
+                return
+            if sum(counts.values()) < options["batch_size"]:
+                time.sleep(options["interval"])
@@ -0,0 +1,54 @@
+import os
+import sqlite3
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from rejestrapp.routing import PRIMARY_DATABASE
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the primary SQLite database into the replica's file "
+        "with SQLite's online backup, so that the two are kept in sync locally."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep copying instead of copying once.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait between copies, i.e. the replica's lag.",
+        )
+
+    def handle(self, *args, **options):
+        if settings.DATABASE_REPLICA is None:
+            raise CommandError("No replica configured, set DATABASE_REPLICA_NAME")
+        primary = connections[PRIMARY_DATABASE]
+        replica_name = connections[settings.DATABASE_REPLICA].settings_dict["NAME"]
+        if primary.vendor != "sqlite":
+            raise CommandError("Only SQLite databases can be synced this way")
+        if os.path.abspath(replica_name) == os.path.abspath(
+            primary.settings_dict["NAME"]
+        ):
+            raise CommandError("The replica is the primary's own file")
+        while True:
+            started = time.perf_counter()
+            primary.ensure_connection()
+            target = sqlite3.connect(replica_name)
+            try:
+                primary.connection.backup(target)
+            finally:
+                target.close()
+            self.stdout.write(
+                f"synced in {(time.perf_counter() - started) * 1000:.1f} ms"
+            )
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
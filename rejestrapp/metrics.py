@@ -0,0 +1,449 @@
+"""
+An in-process metrics registry exposed in the Prometheus text format
+by MetricsView. Every process counts on its own, under a lock, so that
+threads can share it. When METRICS_DIR is set, every process also writes
+its counts to a file of its own there every METRICS_FLUSH_SECONDS and
+on exit, including an exit on SIGTERM, and the view adds up the files of
+all processes, including finished ones like the cron jobs. Without it,
+the view only shows the counts of the process that answers it.
+"""
+
+import atexit
+import json
+import logging
+import math
+import os
+import signal
+import sys
+import threading
+import time
+import typing
+from django.conf import settings
+from django.db.models import Count
+from django.http import HttpRequest, HttpResponse, HttpResponseForbidden
+from django.views.generic import View
+
+from .caching import form_class_cache
+from .email_client import get_email_client
+from .instrumentation import counting_queries
+from .models import OutgoingEmail
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CRONJOB_BUCKETS = (0.1, 1.0, 10.0, 60.0, 300.0, 1800.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = typing.Tuple[str, ...]
+
+
+class Metric:
+    kind = ""
+
+    def __init__(
+        self,
+        registry: "MetricsRegistry",
+        name: str,
+        documentation: str,
+        labelnames: typing.Sequence[str] = (),
+    ):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def label_values(self, labels: typing.Mapping[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        self.registry.add(self.name, self.label_values(labels), amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(*args)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        self.registry.observe(self.name, self.label_values(labels), value)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: typing.Dict[str, Metric] = {}
+        self._collectors: typing.List[typing.Callable[[], typing.Iterable]] = []
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self) -> None:
+        # a forked worker starts from zero, its parent still reports its own
+        self._lock = threading.Lock()
+        # values of counters, and of histograms as their bucket counts
+        # (non-cumulative, the last one for values above the highest bucket)
+        # followed by their sum
+        self._values: typing.Dict[typing.Tuple[str, LabelValues], typing.Any] = {}
+        self._flusher: typing.Optional[threading.Thread] = None
+
+    def _after_fork(self) -> None:
+        self._reset()
+        if self._collectors:
+            self._start_flusher()
+
+    def counter(self, *args) -> Counter:
+        return self._define(Counter(self, *args))
+
+    def histogram(self, *args, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._define(Histogram(self, *args, buckets=buckets))
+
+    def _define(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def collector(self, collect: typing.Callable[[], typing.Iterable]):
+        """
+        Register a function returning (name, label values, value) of counters
+        kept elsewhere in the process, read whenever the registry is.
+        Their counts have to be flushed even by processes, like the send_emails
+        worker, that never count anything in the registry itself.
+        """
+        self._collectors.append(collect)
+        self._start_flusher()
+        return collect
+
+    def add(self, name: str, labels: LabelValues, amount: float) -> None:
+        with self._lock:
+            self._values[name, labels] = self._values.get((name, labels), 0) + amount
+        self._start_flusher()
+
+    def observe(self, name: str, labels: LabelValues, value: float) -> None:
+        buckets = self.metrics[name].buckets
+        bucket = 0
+        while bucket < len(buckets) and value > buckets[bucket]:
+            bucket += 1
+        with self._lock:
+            counts = self._values.get((name, labels))
+            if counts is None:
+                counts = self._values[name, labels] = [0] * (len(buckets) + 2)
+            counts[bucket] += 1
+            counts[-1] += value
+        self._start_flusher()
+
+    def snapshot(self) -> typing.List[list]:
+        """This process's values, as [name, label values, value] lists."""
+        with self._lock:
+            values = [
+                [name, list(labels), list(value) if isinstance(value, list) else value]
+                for (name, labels), value in self._values.items()
+            ]
+        for collect in self._collectors:
+            values += [[name, list(labels), value] for name, labels, value in collect()]
+        return values
+
+    def _path(self, directory, pid: int) -> str:
+        return os.path.join(directory, f"{pid}.json")
+
+    def flush(self) -> None:
+        directory = settings.METRICS_DIR
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        path = self._path(directory, os.getpid())
+        # written aside and renamed, so that readers never see half a file,
+        # aside for every thread, since the flusher and atexit may both write
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(self.snapshot(), file)
+        os.replace(temporary, path)
+
+    def _start_flusher(self) -> None:
+        if self._flusher is not None or not settings.METRICS_DIR:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(
+                target=self._flush_periodically, name="metrics-flusher", daemon=True
+            )
+        self._flusher.start()
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(settings.METRICS_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("couldn't write the metrics")
+
+    def collect(self) -> typing.Dict[typing.Tuple[str, LabelValues], typing.Any]:
+        """
+        The values of this process added up with those
+        of every other process that wrote them to METRICS_DIR.
+        """
+        snapshots = [self.snapshot()]
+        directory = settings.METRICS_DIR
+        if directory and os.path.isdir(directory):
+            own = self._path(directory, os.getpid())
+            for entry in os.scandir(directory):
+                if not entry.name.endswith(".json") or entry.path == own:
+                    continue
+                try:
+                    with open(entry.path) as file:
+                        snapshots.append(json.load(file))
+                except (OSError, ValueError):
+                    # a file being replaced, or garbage
+                    continue
+        totals: typing.Dict[typing.Tuple[str, LabelValues], typing.Any] = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot:
+                key = (name, tuple(labels))
+                if name not in self.metrics:
+                    continue
+                if isinstance(value, list):
+                    total = totals.setdefault(key, [0] * len(value))
+                    if len(total) != len(value):
+                        # written with other buckets by an older version
+                        continue
+                    for i, v in enumerate(value):
+                        total[i] += v
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(pairs: typing.Iterable[typing.Tuple[str, str]]) -> str:
+    pairs = list(pairs)
+    if not pairs:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs)
+        + "}"
+    )
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(
+    metrics: typing.Iterable[Metric],
+    values: typing.Mapping[typing.Tuple[str, LabelValues], typing.Any],
+    gauges: typing.Iterable[
+        typing.Tuple[str, str, typing.Sequence[typing.Tuple[dict, float]]]
+    ] = (),
+) -> str:
+    """
+    The Prometheus text format of values of metrics,
+    followed by gauges given as (name, documentation, [(labels, value)]).
+    """
+    by_name: typing.Dict[str, list] = {}
+    for (name, labels), value in sorted(values.items()):
+        by_name.setdefault(name, []).append((labels, value))
+    lines = []
+    for metric in metrics:
+        lines += [
+            f"# HELP {metric.name} {metric.documentation}",
+            f"# TYPE {metric.name} {metric.kind}",
+        ]
+        for labels, value in by_name.get(metric.name, []):
+            pairs = list(zip(metric.labelnames, labels))
+            if metric.kind == "counter":
+                lines.append(
+                    f"{metric.name}{format_labels(pairs)} {format_value(value)}"
+                )
+                continue
+            cumulative = 0
+            for bound, count in zip([*metric.buckets, math.inf], value):
+                cumulative += count
+                le = format_value(float(bound))
+                lines.append(
+                    f"{metric.name}_bucket{format_labels(pairs + [('le', le)])} "
+                    f"{cumulative}"
+                )
+            lines.append(
+                f"{metric.name}_sum{format_labels(pairs)} {format_value(value[-1])}"
+            )
+            lines.append(f"{metric.name}_count{format_labels(pairs)} {cumulative}")
+    for name, documentation, samples in gauges:
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+        for labels, value in samples:
+            lines.append(f"{name}{format_labels(labels.items())} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _exit_on_sigterm(signum, frame):
+    # the default action kills the process without running atexit,
+    # and so without flushing the metrics
+    sys.exit(128 + signum)
+
+
+def exit_on_sigterm() -> None:
+    """
+    Turn SIGTERM into a SystemExit, unless someone else handles it already.
+    Signal handlers can only be set from the main thread.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+
+registry = MetricsRegistry()
+atexit.register(registry.flush)
+if settings.METRICS_DIR:
+    exit_on_sigterm()
+
+request_duration = registry.histogram(
+    "rejestrapp_request_duration_seconds",
+    "Time spent answering requests, by URL name.",
+    ["view", "method", "status"],
+)
+db_queries = registry.counter(
+    "rejestrapp_db_queries_total",
+    "Database queries made while answering requests, by URL name.",
+    ["view"],
+)
+db_query_seconds = registry.counter(
+    "rejestrapp_db_query_seconds_total",
+    "Time spent on database queries while answering requests, by URL name.",
+    ["view"],
+)
+votes = registry.counter(
+    "rejestrapp_votes_total",
+    "Votes cast on transactions, by their outcome.",
+    ["outcome"],
+)
+settlement_duration = registry.histogram(
+    "rejestrapp_settlement_duration_seconds",
+    "Time spent applying settled transactions to the balances.",
+)
+cronjob_duration = registry.histogram(
+    "rejestrapp_cronjob_duration_seconds",
+    "Time spent on cron jobs, by job.",
+    ["job"],
+    buckets=CRONJOB_BUCKETS,
+)
+form_class_cache_lookups = registry.counter(
+    "rejestrapp_form_class_cache_lookups_total",
+    "Lookups of the cached form classes, by whether they were found.",
+    ["result"],
+)
+email_api_requests = registry.counter(
+    "rejestrapp_email_api_requests_total",
+    "Requests made to the email provider's API, by whether they failed.",
+    ["result"],
+)
+
+
+@registry.collector
+def _collect_form_class_cache():
+    stats = form_class_cache.stats()
+    yield form_class_cache_lookups.name, ("hit",), stats["hits"]
+    yield form_class_cache_lookups.name, ("miss",), stats["misses"]
+
+
+@registry.collector
+def _collect_email_client():
+    stats = get_email_client().stats()
+    yield email_api_requests.name, ("ok",), stats["requests"] - stats["errors"]
+    yield email_api_requests.name, ("error",), stats["errors"]
+
+
+def outbox_gauge():
+    """Read at scrape time, since the outbox is the same for every process."""
+    counts = dict(
+        OutgoingEmail.objects.values_list("status").annotate(count=Count("pk"))
+    )
+    return (
+        "rejestrapp_outbox_emails",
+        "Emails in the outbox, by status.",
+        [
+            ({"status": status}, counts.get(status, 0))
+            for status in OutgoingEmail.Status.values
+        ],
+    )
+
+
+HTTP_METHODS = frozenset(
+    ["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "TRACE", "CONNECT"]
+)
+
+
+def method_label(request: HttpRequest) -> str:
+    # any other method would make a new series, clients choose it
+    return request.method if request.method in HTTP_METHODS else "other"
+
+
+def url_name(request: HttpRequest) -> str:
+    match = request.resolver_match
+    if match is None:
+        return "unmatched"
+    if match.namespace != "rejestrapp":
+        return "other"
+    return match.url_name
+
+
+class MetricsMiddleware:
+    """
+    Count the time and the queries of every request. Should come first,
+    so that the time spent in other middleware is counted as well.
+    Every query of every request pays for a call through the wrapper
+    counting it, which RequestInstrumentationMiddleware shares.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        with counting_queries() as timings:
+            response = self.get_response(request)
+        view = url_name(request)
+        request_duration.observe(
+            time.perf_counter() - started,
+            view=view,
+            method=method_label(request),
+            status=f"{response.status_code // 100}xx",
+        )
+        db_queries.inc(timings.queries, view=view)
+        db_query_seconds.inc(timings.db, view=view)
+        return response
+
+
+def metrics_allowed(request: HttpRequest) -> bool:
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    # a request passed on by a proxy on this machine comes from localhost too,
+    # which is why no address is allowed unless METRICS_ALLOWED_ADDRESSES says so
+    return (
+        request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_ADDRESSES
+        and "HTTP_X_FORWARDED_FOR" not in request.META
+    )
+
+
+class MetricsView(View):
+    """
+    The metrics of every process, for staff and for scrapers
+    from METRICS_ALLOWED_ADDRESSES.
+    """
+
+    http_method_names = ["get", "options"]
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        if not metrics_allowed(request):
+            return HttpResponseForbidden()
+        text = render(registry.metrics.values(), registry.collect(), [outbox_gauge()])
+        return HttpResponse(text, content_type=CONTENT_TYPE)
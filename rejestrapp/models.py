@@ -1,11 +1,17 @@
+import datetime
 from django.contrib.auth.models import User
 from django.db import models
+from django.utils import timezone
 
 
 class Register(models.Model):
     name = models.CharField(max_length=128)
     users: models.ManyToManyField = models.ManyToManyField(User, through="Debt")
     all_accepted = models.BooleanField(db_default=False)
+    # bumped whenever the register's page changes, see caching.py
+    version = models.PositiveIntegerField(db_default=0)
+    # bumped whenever the members or their usernames change, see caching.py
+    membership_version = models.PositiveIntegerField(db_default=0)
 
     def __str__(self):
         return self.name + " - id: " + str(self.pk)
@@ -30,13 +36,35 @@ class Debt(models.Model):
 
 class GroupTransaction(models.Model):
     name = models.CharField(max_length=128)
+    # nullable only so that it can be backfilled on databases created before it
+    register = models.ForeignKey(
+        Register, on_delete=models.PROTECT, blank=True, null=True
+    )
     init_date = models.DateTimeField()
     is_settled = models.BooleanField(db_default=False)
     settle_date = models.DateTimeField(blank=True, null=True)
+    # bumped on every vote, used for optimistic locking
+    # on databases that don't support SELECT ... FOR UPDATE
+    version = models.PositiveIntegerField(db_default=0)
+    # denormalized tallies of the indivs, kept up to date by every vote
+    support_count = models.PositiveIntegerField(db_default=0)
+    remove_count = models.PositiveIntegerField(db_default=0)
+    member_count = models.PositiveIntegerField(db_default=0)
+    # recorded by settle_up.py, so that pending transfers aren't planned again
+    settles_up = models.BooleanField(db_default=False)
     debts: models.ManyToManyField = models.ManyToManyField(
         Debt, through="IndividualsTransaction"
     )
 
+    class Meta:
+        indexes = [
+            # matches the ordering of the transaction history in RegisterView
+            models.Index(
+                fields=["register", "is_settled", "-settle_date", "-init_date", "-id"],
+                name="transaction_history_idx",
+            )
+        ]
+
     def __str__(self):
         return f"{self.name} - {self.init_date}"
 
@@ -61,9 +89,53 @@ class IndividualsTransaction(models.Model):
         return f"{self.debt.user.username} {self.debt.register.name} {self.group_transaction.name}"
 
 
+SIGNUP_TOKEN_LIFETIME = datetime.timedelta(days=1)
+
+
+def signup_token_expiry():
+    return timezone.now() + SIGNUP_TOKEN_LIFETIME
+
+
 class SignupToken(models.Model):
     secret = models.CharField(primary_key=True, max_length=64)
     email = models.EmailField(unique=True, blank=False, null=False)
+    issued_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(default=signup_token_expiry)
+
+    class Meta:
+        indexes = [models.Index(fields=["expires_at"], name="signup_token_expiry_idx")]
 
     def __str__(self):
         return "Signup Token"
+
+
+class OutgoingEmail(models.Model):
+    """
+    An email waiting in the outbox to be sent by the send_emails command.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        SENT = "sent"
+        DEAD = "dead"  # gave up after too many failed attempts
+
+    to_email = models.EmailField()
+    to_name = models.CharField(max_length=150)
+    subject = models.CharField(max_length=256)
+    html = models.TextField()
+    status = models.CharField(
+        max_length=16, choices=Status.choices, db_default=Status.PENDING
+    )
+    attempts = models.PositiveIntegerField(db_default=0)
+    last_error = models.TextField(blank=True, db_default="")
+    created_at = models.DateTimeField()
+    next_attempt_at = models.DateTimeField()
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"], name="outbox_due_idx")
+        ]
+
+    def __str__(self):
+        return f'"{self.subject}" do {self.to_email} ({self.status})'
@@ -0,0 +1,246 @@
+"""
+Profiling single requests on demand. A staff member adds a X-Profile header
+or a ?profile query parameter to a request and it's run under cProfile.
+Its stats are saved to PROFILES_DIR along with a summary of the request
+and its stacks, sampled every PROFILES_SAMPLE_INTERVAL seconds meanwhile
+and collapsed into "frame;frame;frame samples" lines, which flamegraph.pl
+and speedscope read. The newest PROFILES_KEEP profiles are kept and listed
+on an admin page. Without PROFILES_DIR the middleware isn't installed at all.
+"""
+
+import cProfile
+import datetime
+import json
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+import types
+import typing
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import FileResponse, Http404, HttpRequest
+from django.shortcuts import render
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.generic import View
+
+PROFILE_HEADER = "HTTP_X_PROFILE"
+PROFILE_PARAMETER = "profile"
+PROFILE_FILES = {
+    "stats": ".prof",
+    "collapsed": ".collapsed",
+    "summary": ".json",
+}
+PROFILE_NAME = re.compile(r"^[0-9T]+-[a-z0-9_]+-[0-9a-f]+$")
+
+# cProfile can only profile one thing at a time in newer Pythons,
+# and one at a time is plenty on a production server anyway
+_profiling = threading.Lock()
+
+
+def frame_name(code: types.CodeType) -> str:
+    frame = (
+        f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+    )
+    # semicolons separate the frames and spaces the count
+    return frame.replace(";", ",").replace(" ", "_")
+
+
+def _profiled_request(get_response, request):
+    # the root of the sampled stacks
+    return get_response(request)
+
+
+class StackSampler:
+    """
+    Samples the stack of a thread every interval seconds in a thread of its
+    own. cProfile only knows which function called which, so the whole
+    stacks that flame graphs are made of are sampled alongside it.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: typing.Dict[str, int] = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame.f_code))
+                if frame.f_code is _profiled_request.__code__:
+                    break
+                frame = frame.f_back
+            else:
+                # not within the request yet, or anymore
+                continue
+            line = ";".join(reversed(stack))
+            self.stacks[line] = self.stacks.get(line, 0) + 1
+
+
+def profile_path(name: str, kind: str) -> str:
+    return os.path.join(settings.PROFILES_DIR, name + PROFILE_FILES[kind])
+
+
+def save_profile(
+    profile: cProfile.Profile,
+    stacks: typing.Dict[str, int],
+    request: HttpRequest,
+    status: int,
+    duration: float,
+) -> str:
+    match = request.resolver_match
+    started = timezone.now() - datetime.timedelta(seconds=duration)
+    name = "-".join(
+        [
+            started.strftime("%Y%m%dT%H%M%S"),
+            match.url_name if match is not None and match.url_name else "unmatched",
+            secrets.token_hex(4),
+        ]
+    )
+    os.makedirs(settings.PROFILES_DIR, exist_ok=True)
+    profile.dump_stats(profile_path(name, "stats"))
+    with open(profile_path(name, "collapsed"), "w") as file:
+        file.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+    with open(profile_path(name, "summary"), "w") as file:
+        json.dump(
+            {
+                "name": name,
+                "started": started.isoformat(),
+                "method": request.method,
+                "path": request.get_full_path(),
+                "user": request.user.get_username(),
+                "status": status,
+                "duration_ms": round(duration * 1000, 3),
+            },
+            file,
+        )
+    remove_old_profiles()
+    return name
+
+
+def recent_profiles() -> typing.List[dict]:
+    """Summaries of the saved profiles, the newest first."""
+    directory = settings.PROFILES_DIR
+    if not directory or not os.path.isdir(directory):
+        return []
+    summaries = []
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(PROFILE_FILES["summary"]):
+            continue
+        try:
+            with open(entry.path) as file:
+                summaries.append(json.load(file))
+        except (OSError, ValueError):
+            continue
+    return sorted(summaries, key=lambda summary: summary["name"], reverse=True)
+
+
+def remove_old_profiles() -> None:
+    for summary in recent_profiles()[settings.PROFILES_KEEP :]:
+        for kind in PROFILE_FILES:
+            try:
+                os.remove(profile_path(summary["name"], kind))
+            except FileNotFoundError:
+                pass
+
+
+def profiling_requested(request: HttpRequest) -> bool:
+    # QUERY_STRING is looked at first, so that requests that don't ask
+    # for a profile don't have their query parsed because of this
+    return PROFILE_HEADER in request.META or (
+        PROFILE_PARAMETER in request.META.get("QUERY_STRING", "")
+        and PROFILE_PARAMETER in request.GET
+    )
+
+
+class ProfilerMiddleware:
+    """
+    Run requests of staff that ask for it under cProfile. Has to come after
+    AuthenticationMiddleware. Every other request costs a lookup in its
+    headers and a substring search in its query string.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILES_DIR:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not profiling_requested(request):
+            return self.get_response(request)
+        if not request.user.is_staff or not _profiling.acquire(blocking=False):
+            return self.get_response(request)
+        try:
+            profile = cProfile.Profile()
+            with StackSampler(
+                threading.get_ident(), settings.PROFILES_SAMPLE_INTERVAL
+            ) as sampler:
+                started = time.perf_counter()
+                response = profile.runcall(
+                    _profiled_request, self.get_response, request
+                )
+                duration = time.perf_counter() - started
+        finally:
+            _profiling.release()
+        response["X-Profile-Id"] = save_profile(
+            profile, sampler.stacks, request, response.status_code, duration
+        )
+        return response
+
+
+@method_decorator(staff_member_required, name="dispatch")
+class ProfilesView(View):
+    """
+    The admin page listing the saved profiles.
+    """
+
+    http_method_names = ["get", "options"]
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        return render(
+            request,
+            "rejestrapp/admin/profiles.html",
+            {
+                **admin.site.each_context(request),
+                "title": "Profile zapytań",
+                "profiles": recent_profiles(),
+                "profiles_dir": settings.PROFILES_DIR,
+                "kinds": PROFILE_FILES,
+            },
+        )
+
+
+@method_decorator(staff_member_required, name="dispatch")
+class ProfileDownloadView(View):
+    http_method_names = ["get", "options"]
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        name = kwargs["name"]
+        kind = kwargs["kind"]
+        if not settings.PROFILES_DIR or not PROFILE_NAME.match(name):
+            raise Http404
+        if kind not in PROFILE_FILES:
+            raise Http404
+        path = profile_path(name, kind)
+        if not os.path.exists(path):
+            raise Http404
+        return FileResponse(
+            open(path, "rb"), as_attachment=True, filename=os.path.basename(path)
+        )
@@ -0,0 +1,145 @@
+"""
+A test harness that keeps the number of queries of views in check.
+Every view gets a budget of queries, and it's requested against registers
+of growing size. It fails when a view goes over its budget or when its
+query count grows with the size of a register, which is how N+1 queries
+show up, and prints the SQL of the offending request grouped by statement.
+"""
+
+import collections
+import itertools
+import random
+import re
+import typing
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .benchmarking import add_register, make_history, make_register
+from .caching import form_class_cache, register_pages_cache
+from .models import GroupTransaction, Register
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN \(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    The statement with its literals replaced by ? and its IN lists collapsed,
+    so that the same query made for different rows looks the same.
+    """
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _IN_LIST.sub("IN (...)", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+def group_queries(
+    queries: typing.Iterable[typing.Mapping[str, str]],
+) -> typing.List[typing.Tuple[str, int]]:
+    """
+    The normalized statements of queries captured by CaptureQueriesContext
+    along with how many times each was run, the most frequent first.
+    """
+    counts = collections.Counter(normalize_sql(query["sql"]) for query in queries)
+    return counts.most_common()
+
+
+def format_queries(queries: typing.Iterable[typing.Mapping[str, str]]) -> str:
+    return "\n".join(
+        f"{count:5} x {statement}" for statement, count in group_queries(queries)
+    )
+
+
+class BudgetFixture(typing.NamedTuple):
+    register: Register
+    members: typing.List[User]
+    # a pending transaction of register
+    transaction: GroupTransaction
+    # a register of the same members, none of whom have accepted it yet
+    invitation: Register
+
+    @property
+    def member(self) -> User:
+        return self.members[0]
+
+
+def register_kwargs(fixture: BudgetFixture) -> dict:
+    return {"register_id": fixture.register.pk}
+
+
+class ViewBudget(typing.NamedTuple):
+    url_name: str
+    max_queries: int
+    method: str = "get"
+    kwargs: typing.Callable[[BudgetFixture], dict] = register_kwargs
+    data: typing.Optional[typing.Callable[[BudgetFixture], dict]] = None
+
+    def __str__(self):
+        return f"{self.method.upper()} {self.url_name}"
+
+
+@override_settings(DATABASE_REPLICA=None)
+class QueryBudgetTestCase(TestCase):
+    """
+    Subclasses list their ViewBudgets in budgets and check them
+    with assertWithinBudget. Every request is made by the first member
+    of a fresh fixture of sizes[i] members and transactions,
+    with the caches cleared, so that nothing is counted warm. Every query
+    goes to the primary, where they're counted, even with a replica.
+    """
+
+    sizes: typing.Sequence[int] = (2, 8, 32)
+    budgets: typing.Sequence[ViewBudget] = ()
+
+    def setUp(self):
+        self._fixture_names = itertools.count()
+        self._rng = random.Random(0)
+
+    def make_fixture(self, size: int) -> BudgetFixture:
+        name = f"budget_{next(self._fixture_names)}"
+        register, members = make_register(size, name)
+        make_history(register, size, 0.5, self._rng)
+        return BudgetFixture(
+            register=register,
+            members=members,
+            transaction=GroupTransaction.objects.filter(
+                register=register, is_settled=False
+            ).first(),
+            invitation=add_register(members, f"{name}_invitation", accepted=False),
+        )
+
+    def measure(self, budget: ViewBudget, size: int) -> CaptureQueriesContext:
+        fixture = self.make_fixture(size)
+        path = reverse(f"rejestrapp:{budget.url_name}", kwargs=budget.kwargs(fixture))
+        data = budget.data(fixture) if budget.data is not None else {}
+        self.client.force_login(fixture.member)
+        register_pages_cache().clear()
+        form_class_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, budget.method)(path, data)
+        self.assertLess(
+            response.status_code,
+            400,
+            f"{budget} answered with {response.status_code} on size {size}",
+        )
+        return queries
+
+    def assertWithinBudget(self, budget: ViewBudget):
+        measured = [(size, self.measure(budget, size)) for size in self.sizes]
+        counts = {size: len(queries) for size, queries in measured}
+        worst_size, worst_queries = max(measured, key=lambda m: len(m[1]))
+        if len(worst_queries) > budget.max_queries:
+            problem = f"goes over its budget of {budget.max_queries} queries"
+        elif len(set(counts.values())) > 1:
+            problem = "makes more queries on larger registers"
+        else:
+            return
+        self.fail(
+            f"{budget} {problem}: {counts} queries by size. "
+            f"The queries on size {worst_size}:\n{format_queries(worst_queries)}"
+        )
@@ -0,0 +1,116 @@
+import contextvars
+import time
+import typing
+from django.conf import settings
+from django.http import HttpRequest
+
+PRIMARY_DATABASE = "default"
+# the session holds the stickiness, so it must never be read from a lagging copy
+PRIMARY_ONLY_APPS = frozenset(["sessions"])
+STICKY_SESSION_KEY = "_rejestrapp_primary_until"
+
+_replica_allowed: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "replica_allowed", default=False
+)
+_wrote: contextvars.ContextVar[bool] = contextvars.ContextVar("wrote", default=False)
+
+
+def replica_database() -> typing.Optional[str]:
+    return getattr(settings, "DATABASE_REPLICA", None)
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends the reads of views decorated with reads_from_replica to
+    the replica database and everything else to the primary. Once a request
+    has written anything, its remaining reads go to the primary as well.
+    """
+
+    def db_for_read(self, model, **hints):
+        replica = replica_database()
+        if (
+            replica is None
+            or not _replica_allowed.get()
+            or _wrote.get()
+            or model._meta.app_label in PRIMARY_ONLY_APPS
+        ):
+            return PRIMARY_DATABASE
+        return replica
+
+    def db_for_write(self, model, **hints):
+        _wrote.set(True)
+        return PRIMARY_DATABASE
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # both databases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replica is a copy of the primary, it's never migrated on its own
+        return db == PRIMARY_DATABASE
+
+
+def is_sticky(request: HttpRequest) -> bool:
+    session = getattr(request, "session", None)
+    return session is not None and session.get(STICKY_SESSION_KEY, 0) > time.time()
+
+
+def reads_from_replica(cls):
+    """
+    Let the GET and HEAD requests of a view read from the replica, unless
+    the session has written recently and has to read its own writes.
+    """
+    cls._reads_from_replica__original_dispatch = cls.dispatch
+
+    def new_dispatch(self, request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD") or is_sticky(request):
+            return cls._reads_from_replica__original_dispatch(
+                self, request, *args, **kwargs
+            )
+        replica_token = _replica_allowed.set(True)
+        # writes from outside of a request (e.g. in a shell) don't count
+        wrote_token = _wrote.set(False)
+        try:
+            return cls._reads_from_replica__original_dispatch(
+                self, request, *args, **kwargs
+            )
+        finally:
+            wrote = _wrote.get()
+            _wrote.reset(wrote_token)
+            _replica_allowed.reset(replica_token)
+            if wrote:
+                _wrote.set(True)
+
+    cls.dispatch = new_dispatch
+    return cls
+
+
+class ReplicaStickinessMiddleware:
+    """
+    Send a session's reads to the primary for REPLICA_STICKINESS_SECONDS
+    after any of its requests wrote to the database, so that the replica's
+    lag can't hide what the user has just done. Has to come after
+    SessionMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _wrote.set(False)
+        try:
+            response = self.get_response(request)
+            # every view reading from the replica needs a logged-in user,
+            # so anonymous sessions aren't created just for this
+            if (
+                _wrote.get()
+                and replica_database() is not None
+                and getattr(request, "user", None) is not None
+                and request.user.is_authenticated
+            ):
+                request.session[STICKY_SESSION_KEY] = (
+                    time.time() + settings.REPLICA_STICKINESS_SECONDS
+                )
+            return response
+        finally:
+            _wrote.reset(token)
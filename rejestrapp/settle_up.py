@@ -0,0 +1,142 @@
+import heapq
+import typing
+from django.db import transaction
+from django.db.models import F, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .caching import bump_register_version
+from .errors import BadGroszeException, StalePlanException
+from .models import Debt, GroupTransaction, IndividualsTransaction, Register
+
+
+class Transfer(typing.NamedTuple):
+    payer: int  # user id of someone with a positive balance
+    payee: int  # user id of someone with a negative balance
+    amount: int  # in grosze
+
+
+def plan_transfers(balances: typing.Mapping[int, int]) -> typing.List[Transfer]:
+    """
+    Plan payments that bring every balance (user id -> grosze) to zero.
+    Members whose balances cancel out exactly are paired up first,
+    then the biggest remaining debtor repeatedly pays the biggest remaining
+    creditor. That takes at most one transfer less than there are members
+    with a nonzero balance, and O(n log n) time.
+    """
+    if sum(balances.values()) != 0:
+        raise BadGroszeException("Balances should add up to zero")
+    transfers = []
+    # exact matches, paired in a deterministic order; the lists are built
+    # backwards so that pop() returns the lowest user id
+    creditors_by_amount: typing.Dict[int, typing.List[int]] = {}
+    for user_id, balance in sorted(balances.items(), reverse=True):
+        if balance < 0:
+            creditors_by_amount.setdefault(-balance, []).append(user_id)
+    debtors = []
+    for user_id, balance in sorted(balances.items()):
+        if balance <= 0:
+            continue
+        matching = creditors_by_amount.get(balance)
+        if matching:
+            transfers.append(Transfer(user_id, matching.pop(), balance))
+        else:
+            debtors.append((-balance, user_id))
+    creditors = [
+        (-amount, user_id)
+        for amount, user_ids in creditors_by_amount.items()
+        for user_id in user_ids
+    ]
+    heapq.heapify(debtors)
+    heapq.heapify(creditors)
+    while debtors:
+        debt, payer = heapq.heappop(debtors)
+        credit, payee = heapq.heappop(creditors)
+        amount = min(-debt, -credit)
+        transfers.append(Transfer(payer, payee, amount))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, payer))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, payee))
+    return transfers
+
+
+def register_balances(register: Register) -> typing.Dict[int, int]:
+    """
+    Balances of the members of a register (user id -> grosze), as they will
+    be once the transfers of earlier plans, still waiting to be confirmed,
+    are settled, so that the same transfers aren't planned again.
+    """
+    pending = Q(
+        individualstransaction__group_transaction__settles_up=True,
+        individualstransaction__group_transaction__is_settled=False,
+    )
+    return dict(
+        Debt.objects.filter(register=register)
+        .annotate(
+            pending_balance=F("balance")
+            + Coalesce(Sum("individualstransaction__amount", filter=pending), 0)
+        )
+        .values_list("user_id", "pending_balance")
+    )
+
+
+def record_transfers(
+    register: Register,
+    transfers: typing.List[Transfer],
+    usernames: typing.Mapping[int, str],
+) -> typing.List[GroupTransaction]:
+    """
+    Store every planned transfer as a transaction between its payer and payee,
+    who are the only ones voting on it, with two bulk inserts.
+    """
+    debt_ids = dict(Debt.objects.filter(register=register).values_list("user_id", "pk"))
+    now = timezone.now()
+    with transaction.atomic():
+        group_transactions = GroupTransaction.objects.bulk_create(
+            GroupTransaction(
+                name=f"Spłata: {usernames[t.payer]} → {usernames[t.payee]}"[:128],
+                init_date=now,
+                register=register,
+                member_count=2,
+                settles_up=True,
+            )
+            for t in transfers
+        )
+        IndividualsTransaction.objects.bulk_create(
+            IndividualsTransaction(
+                debt_id=debt_ids[user_id],
+                group_transaction=group_transaction,
+                amount=amount,
+            )
+            for t, group_transaction in zip(transfers, group_transactions)
+            for user_id, amount in ((t.payer, -t.amount), (t.payee, t.amount))
+        )
+        bump_register_version(register)
+    return group_transactions
+
+
+def settle_up(register: Register, version: int) -> typing.List[GroupTransaction]:
+    """
+    Plan the transfers of a register and record them, provided that the
+    register is still at the version whose plan was shown. The version is
+    claimed with a compare-and-swap UPDATE first thing inside the atomic
+    block, which also serializes concurrent settle-ups, and the plan is
+    computed after that. Recording a plan changes the version, so submitting
+    the same plan twice raises a StalePlanException instead of recording
+    it again, and the recorded transfers count towards the balances of
+    later plans until they're settled or rejected.
+    """
+    with transaction.atomic():
+        claimed = Register.objects.filter(pk=register.pk, version=version).update(
+            version=F("version") + 1
+        )
+        if claimed != 1:
+            raise StalePlanException(
+                f"Register {register.pk} changed since version {version}"
+            )
+        usernames = dict(register.users.values_list("pk", "username"))
+        transfers = plan_transfers(register_balances(register))
+        if not transfers:
+            return []
+        return record_transfers(register, transfers, usernames)
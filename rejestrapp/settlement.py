@@ -0,0 +1,249 @@
+import random
+import time
+import typing
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.query import QuerySet
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+
+from .caching import bump_register_version
+from .errors import VoteConflictException
+from .metrics import settlement_duration, votes
+from .models import Debt, GroupTransaction, IndividualsTransaction, Register
+
+VOTE_RECORDED = "recorded"
+VOTE_SETTLED = "settled"
+VOTE_DELETED = "deleted"
+VOTE_ALREADY_SETTLED = "already_settled"
+
+VOTE_MAX_ATTEMPTS = 10
+VOTE_RETRY_BACKOFF = 0.005  # in seconds, doubled after every failed attempt
+
+
+class VoteResult(typing.NamedTuple):
+    outcome: str
+    attempts: int
+    lock_wait: float  # seconds from the first attempt until the lock was held
+
+
+def lock_group_transaction(group_transaction: GroupTransaction) -> None:
+    """
+    Serialize votes on a transaction. Has to be the first thing done
+    inside of an atomic block. Where the database supports it, the row is
+    locked with SELECT ... FOR UPDATE and reloaded. Elsewhere (SQLite)
+    the version read at the beginning of the block is claimed with
+    a compare-and-swap UPDATE, which raises a VoteConflictException if
+    someone else voted in the meantime. That can't happen when SQLite takes
+    the write lock as the block begins (transaction_mode IMMEDIATE), since
+    nobody else can vote between the read and the claim then.
+    """
+    if connection.features.has_select_for_update:
+        group_transaction.refresh_from_db(
+            from_queryset=GroupTransaction.objects.select_for_update()
+        )
+    claimed = GroupTransaction.objects.filter(
+        pk=group_transaction.pk, version=group_transaction.version
+    ).update(version=F("version") + 1)
+    if claimed != 1:
+        raise VoteConflictException(
+            f"Transaction {group_transaction.pk} was changed by a concurrent vote"
+        )
+    group_transaction.version += 1
+
+
+def is_lock_error(error: OperationalError) -> bool:
+    return "locked" in str(error)
+
+
+def cast_vote(
+    register: Register,
+    group_transaction_id: int,
+    user: User,
+    supports: bool,
+    wants_remove: bool,
+) -> VoteResult:
+    """
+    Record a user's vote and, if it was the deciding one, settle or delete
+    the transaction. Conflicting concurrent votes, and votes that waited
+    too long for the database's lock, are retried with a randomized
+    exponential backoff. Once they run out of attempts, they raise
+    a VoteConflictException.
+    """
+    started = time.perf_counter()
+    for attempt in range(1, VOTE_MAX_ATTEMPTS + 1):
+        try:
+            with transaction.atomic():
+                group_transaction = get_object_or_404(
+                    GroupTransaction, pk=group_transaction_id, register=register
+                )
+                lock_group_transaction(group_transaction)
+                lock_wait = time.perf_counter() - started
+                outcome = _apply_vote(
+                    register, group_transaction, user, supports, wants_remove
+                )
+            votes.inc(outcome=outcome)
+            return VoteResult(outcome, attempt, lock_wait)
+        except (VoteConflictException, OperationalError) as error:
+            if isinstance(error, OperationalError) and not is_lock_error(error):
+                raise
+            if attempt == VOTE_MAX_ATTEMPTS:
+                raise VoteConflictException(
+                    f"Gave up voting on transaction {group_transaction_id}"
+                ) from error
+            time.sleep(random.uniform(0, VOTE_RETRY_BACKOFF * 2**attempt))
+    raise AssertionError("unreachable")
+
+
+def _apply_vote(
+    register: Register,
+    group_transaction: GroupTransaction,
+    user: User,
+    supports: bool,
+    wants_remove: bool,
+) -> str:
+    if group_transaction.is_settled:
+        return VOTE_ALREADY_SETTLED
+    this_indiv = get_object_or_404(
+        IndividualsTransaction,
+        group_transaction=group_transaction,
+        debt__user=user,
+    )
+    support_delta = int(supports) - int(this_indiv.supports)
+    remove_delta = int(wants_remove) - int(this_indiv.wants_remove)
+    this_indiv.supports = supports
+    this_indiv.wants_remove = wants_remove
+    this_indiv.save(update_fields=["supports", "wants_remove"])
+    if group_transaction.member_count == 0:
+        # created before the counters were, so its votes were never counted
+        _count_votes(group_transaction)
+    elif support_delta or remove_delta:
+        GroupTransaction.objects.filter(pk=group_transaction.pk).update(
+            support_count=F("support_count") + support_delta,
+            remove_count=F("remove_count") + remove_delta,
+        )
+        # the row is locked, so the values read with it are still current
+        group_transaction.support_count += support_delta
+        group_transaction.remove_count += remove_delta
+    member_count = group_transaction.member_count
+    all_want_remove = group_transaction.remove_count == member_count
+    all_support = group_transaction.support_count == member_count
+
+    if all_want_remove:
+        IndividualsTransaction.objects.filter(
+            group_transaction=group_transaction
+        ).delete()
+        group_transaction.delete()
+        bump_register_version(register)
+        return VOTE_DELETED
+    elif all_support:
+        settle_group_transaction(group_transaction, register)
+        return VOTE_SETTLED
+    return VOTE_RECORDED
+
+
+def _count_votes(group_transaction: GroupTransaction) -> None:
+    counts = IndividualsTransaction.objects.filter(
+        group_transaction=group_transaction
+    ).aggregate(
+        support_count=Count("pk", filter=Q(supports=True)),
+        remove_count=Count("pk", filter=Q(wants_remove=True)),
+        member_count=Count("pk"),
+    )
+    GroupTransaction.objects.filter(pk=group_transaction.pk).update(**counts)
+    for field, count in counts.items():
+        setattr(group_transaction, field, count)
+
+
+def vote_count_mismatches() -> QuerySet[GroupTransaction]:
+    """
+    Transactions whose denormalized vote counters don't match their indivs,
+    annotated with the actual counts.
+    """
+    return GroupTransaction.objects.annotate(
+        actual_support_count=Count(
+            "individualstransaction",
+            filter=Q(individualstransaction__supports=True),
+        ),
+        actual_remove_count=Count(
+            "individualstransaction",
+            filter=Q(individualstransaction__wants_remove=True),
+        ),
+        actual_member_count=Count("individualstransaction"),
+    ).exclude(
+        support_count=F("actual_support_count"),
+        remove_count=F("actual_remove_count"),
+        member_count=F("actual_member_count"),
+    )
+
+
+def recount_votes() -> int:
+    """
+    Overwrite every mismatched vote counter with the actual count.
+    Returns the number of corrected transactions.
+    """
+    with transaction.atomic():
+        mismatched = list(vote_count_mismatches())
+        for group_transaction in mismatched:
+            group_transaction.support_count = group_transaction.actual_support_count
+            group_transaction.remove_count = group_transaction.actual_remove_count
+            group_transaction.member_count = group_transaction.actual_member_count
+        GroupTransaction.objects.bulk_update(
+            mismatched, ["support_count", "remove_count", "member_count"]
+        )
+    return len(mismatched)
+
+
+def settle_group_transaction(
+    group_transaction: GroupTransaction, register: Register
+) -> None:
+    """
+    Apply a fully supported transaction to the balances of its register.
+    Every statement issued here is independent of the number of members:
+    the register's debts are locked with a single SELECT ... FOR UPDATE,
+    every indiv gets its 'balance_before' snapshot in one UPDATE,
+    and every debt gets its amount added in another one.
+    """
+    started = time.perf_counter()
+    with transaction.atomic():
+        list(
+            Debt.objects.select_for_update()
+            .filter(register=register)
+            .values_list("pk", flat=True)
+        )
+        indivs = IndividualsTransaction.objects.filter(
+            group_transaction=group_transaction
+        )
+        indivs.update(
+            balance_before=Subquery(
+                Debt.objects.filter(pk=OuterRef("debt_id")).values("balance")[:1]
+            )
+        )
+        Debt.objects.filter(
+            register=register,
+            individualstransaction__group_transaction=group_transaction,
+        ).update(
+            balance=F("balance")
+            + Subquery(indivs.filter(debt_id=OuterRef("pk")).values("amount")[:1])
+        )
+        group_transaction.is_settled = True
+        group_transaction.settle_date = timezone.now()
+        group_transaction.save(update_fields=["is_settled", "settle_date"])
+        bump_register_version(register)
+    settlement_duration.observe(time.perf_counter() - started)
+
+
+def backfill_transaction_registers() -> int:
+    """
+    Fill in the register of transactions created before GroupTransaction
+    had its own foreign key, based on the debts of their indivs.
+    Returns the number of updated transactions.
+    """
+    return GroupTransaction.objects.filter(register=None).update(
+        register=Subquery(
+            Debt.objects.filter(
+                individualstransaction__group_transaction=OuterRef("pk")
+            ).values("register")[:1]
+        )
+    )
@@ -1,19 +1,99 @@
+import csv
+import datetime
+import json
+import os
+import pstats
+import re
 import secrets
+import signal
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import SimpleTestCase, TestCase
+from django.contrib.sessions.models import Session
+from django.core.management import call_command
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import CommandError
+from django.db import connection, connections, router
+from django.db.models import F
+from django.db.models.signals import post_save
+from django.http import HttpResponse, JsonResponse
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+    skipIfDBFeature,
+)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
+from django.views.generic import View
 
 from rejestrapp.models import (
     Debt,
     GroupTransaction,
     IndividualsTransaction,
+    OutgoingEmail,
     Register,
     SignupToken,
 )
 
-from .errors import BadGroszeException
-from .utils import gr_to_zl
+from .caching import (
+    FormClassCache,
+    form_class_cache,
+    new_easy_transaction_form_class,
+    new_transaction_form_class,
+    register_pages_cache,
+)
+from .cronjobs import CLEANUP_CHUNK_SIZE, delete_unfinished_users, do_cronjobs
+from .email_client import BULK_MAX_MESSAGES, EmailClient, get_email_client
+from .emails import OUTBOX_MAX_ATTEMPTS, drain_outbox, enqueue_email
+from .errors import BadGroszeException, ItemsFormatException, VoteConflictException
+from .instrumentation import RequestInstrumentationMiddleware, record_timing
+from .importing import IMPORT_BATCH_SIZE
+from .itemized import Item, parse_items, split_items
+from .metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE,
+    MetricsMiddleware,
+    MetricsRegistry,
+    email_api_requests,
+    exit_on_sigterm,
+    form_class_cache_lookups,
+    registry as metrics_registry,
+    render,
+)
+from .profiling import (
+    PROFILE_FILES,
+    ProfilerMiddleware,
+    StackSampler,
+    _profiled_request,
+    recent_profiles,
+)
+from .query_budget import QueryBudgetTestCase, ViewBudget, normalize_sql
+from .routing import (
+    STICKY_SESSION_KEY,
+    ReplicaStickinessMiddleware,
+    reads_from_replica,
+)
+from .settle_up import Transfer, plan_transfers
+from .settlement import (
+    VOTE_ALREADY_SETTLED,
+    VOTE_RECORDED,
+    VOTE_SETTLED,
+    backfill_transaction_registers,
+    cast_vote,
+    lock_group_transaction,
+    recount_votes,
+    settle_group_transaction,
+)
+from .utils import generate_new_transaction_form_class, gr_to_zl, zl_to_gr
 
 
 class TestConstants:
@@ -44,6 +124,8 @@ def post_data_to_new_transaction_view(self, data):
 class DontBeLoggedInTests(TestCase):
     """Test the @dont_be_logged_in decorator."""
 
+    databases = {"default", "replica"}
+
     def setUp(self):
         """Create two test users and a token for testing successful signup."""
         self.userA = User.objects.create_user(username="userA", password="passwordA")
@@ -142,10 +224,21 @@ class FunctionUtilsTests(SimpleTestCase):
         self.assertRaises(BadGroszeException, gr_to_zl, gr=123.4)
         self.assertRaises(BadGroszeException, gr_to_zl, gr=-34.0)
 
+    def test_zl_to_gr(self):
+        """Amounts in zloty should be converted exactly, without floats."""
+        pairs = [("12.34", 1234), ("-0.07", -7), (" 5 ", 500), ("1.1", 110)]
+        for zl, gr in pairs:
+            self.assertEqual(zl_to_gr(zl), gr)
+        self.assertEqual(zl_to_gr("-21474836.47"), -(2**31 - 1))
+        for bad in ["1.234", "abc", "", "nan", "inf", "1e30", "-1e30", "21474836.48"]:
+            self.assertRaises(BadGroszeException, zl_to_gr, bad)
+
 
 class CheckIfCanBeViewedTests(TestCase):
     """Test the @check_if_can_be_viewed decorator"""
 
+    databases = {"default", "replica"}
+
     def setUp(self):
         """
         Initialize 3 users and 2 registers.
@@ -167,7 +260,10 @@ class CheckIfCanBeViewedTests(TestCase):
         )
 
         self.group_transactionA = GroupTransaction.objects.create(
-            name="group_transactionA", init_date=timezone.now()
+            name="group_transactionA",
+            init_date=timezone.now(),
+            register=self.registerA,
+            member_count=2,
         )
         for debt in Debt.objects.filter(register=self.registerA.pk):
             self.group_transactionA.debts.add(debt)
@@ -546,6 +642,7 @@ class TransactionVoteViewTests(TestCase):
         IndividualsTransaction.objects.exclude(debt__user=self.users[0].pk).update(
             supports=True
         )
+        recount_votes()
         for indiv in IndividualsTransaction.objects.all():
             self.assertEqual(indiv.debt.balance, 0)
             self.assertEqual(indiv.balance_before, None)
@@ -596,6 +693,7 @@ class TransactionVoteViewTests(TestCase):
         IndividualsTransaction.objects.exclude(debt__user=self.users[0].pk).update(
             wants_remove=True
         )
+        recount_votes()
         self.assertEqual(GroupTransaction.objects.count(), 1)
         self.assertEqual(IndividualsTransaction.objects.count(), 5)
 
@@ -614,6 +712,7 @@ class TransactionVoteViewTests(TestCase):
         IndividualsTransaction.objects.exclude(debt__user=self.users[0].pk).update(
             supports=True, wants_remove=True
         )
+        recount_votes()
         self.assertEqual(GroupTransaction.objects.count(), 1)
         self.assertEqual(IndividualsTransaction.objects.count(), 5)
 
@@ -659,6 +758,8 @@ class NewRegisterViewTests(TestCase):
         self.assertEqual(Register.objects.count(), 1)
         register = Register.objects.first()
         self.assertFalse(register.all_accepted)
+        # bumped by adding the members, not overwritten afterwards
+        self.assertGreater(register.membership_version, 0)
         self.assertEqual(register.users.count(), len(self.users))
         for i, debt in enumerate(register.debt_set.all().order_by("user__username")):
             self.assertEqual(debt.user, self.users[i])
@@ -747,6 +848,35 @@ class InviteTests(TestCase):
         self.assertRedirects(response, reverse("rejestrapp:userspace"))
         self.assertTrue(Register.objects.first().all_accepted)
 
+    def test_invite_accept_keeps_versions(self):
+        """
+        Versions bumped while the last invitation is being accepted
+        mustn't be overwritten by the register's stale copy.
+        """
+        for debt in Debt.objects.exclude(user=self.users[0].pk):
+            debt.accepted = True
+            debt.save()
+
+        def bump(sender, instance, **kwargs):
+            Register.objects.filter(pk=instance.register_id).update(
+                version=F("version") + 10,
+                membership_version=F("membership_version") + 10,
+            )
+
+        post_save.connect(bump, sender=Debt)
+        self.addCleanup(post_save.disconnect, bump, sender=Debt)
+        before = Register.objects.get()
+        self.client.force_login(self.users[0])
+        self.client.post(
+            reverse(
+                "rejestrapp:invite_accept", kwargs={"register_id": self.registerA.pk}
+            )
+        )
+        register = Register.objects.get()
+        self.assertTrue(register.all_accepted)
+        self.assertEqual(register.version, before.version + 10)
+        self.assertEqual(register.membership_version, before.membership_version + 10)
+
     def test_invite_accept_not_invited(self):
         """
         The view should display an error message
@@ -800,3 +930,2159 @@ class InviteTests(TestCase):
         self.assertRedirects(response, reverse("rejestrapp:userspace"))
         self.assertEqual(Debt.objects.count(), 0)
         self.assertEqual(Register.objects.count(), 0)
+
+
+class SettlementTests(TestCase):
+    databases = {"default", "replica"}
+
+    def make_transaction(self, member_count):
+        """
+        Create an accepted register with member_count users and a transaction
+        in it where every member's amount equals their position in the list,
+        except for the last member, who balances out the rest.
+        """
+        users = User.objects.bulk_create(
+            User(username=f"{member_count}_{i}") for i in range(member_count)
+        )
+        register = Register.objects.create(name="register", all_accepted=True)
+        register.users.add(*users, through_defaults={"accepted": True})
+        Debt.objects.filter(register=register).update(balance=100)
+        group_transaction = GroupTransaction.objects.create(
+            name="transaction",
+            init_date=timezone.now(),
+            register=register,
+            member_count=member_count,
+        )
+        amounts = list(range(member_count - 1))
+        amounts.append(-sum(amounts))
+        for debt, amount in zip(
+            Debt.objects.filter(register=register).order_by("user__pk"), amounts
+        ):
+            group_transaction.debts.add(debt, through_defaults={"amount": amount})
+        return register, group_transaction, amounts
+
+    def test_settling_applies_amounts_and_snapshots(self):
+        """
+        Settling should store every member's balance from before the transaction
+        and add the transaction's amount to every debt.
+        """
+        register, group_transaction, amounts = self.make_transaction(6)
+
+        settle_group_transaction(group_transaction, register)
+
+        group_transaction.refresh_from_db()
+        self.assertTrue(group_transaction.is_settled)
+        self.assertNotEqual(group_transaction.settle_date, None)
+        indivs = IndividualsTransaction.objects.filter(
+            group_transaction=group_transaction
+        ).order_by("debt__user__pk")
+        for indiv, amount in zip(indivs, amounts):
+            self.assertEqual(indiv.balance_before, 100)
+            self.assertEqual(indiv.debt.balance, 100 + amount)
+
+    def test_settling_query_count_does_not_depend_on_member_count(self):
+        """
+        The number of queries needed to settle a transaction
+        should be the same for small and big registers.
+        """
+        small_register, small_transaction, _ = self.make_transaction(3)
+        big_register, big_transaction, _ = self.make_transaction(60)
+
+        with CaptureQueriesContext(connection) as small_queries:
+            settle_group_transaction(small_transaction, small_register)
+        with CaptureQueriesContext(connection) as big_queries:
+            settle_group_transaction(big_transaction, big_register)
+
+        self.assertEqual(len(small_queries), len(big_queries))
+
+    def test_backfill_transaction_registers(self):
+        """
+        Transactions without a register should get the one
+        their indivs' debts belong to.
+        """
+        register, group_transaction, _ = self.make_transaction(3)
+        GroupTransaction.objects.update(register=None)
+
+        self.assertEqual(backfill_transaction_registers(), 1)
+
+        group_transaction.refresh_from_db()
+        self.assertEqual(group_transaction.register, register)
+
+    def test_transaction_from_another_register_is_not_found(self):
+        """
+        A transaction can only be viewed and voted on
+        through the register it belongs to.
+        """
+        register, group_transaction, _ = self.make_transaction(3)
+        other_register, _, _ = self.make_transaction(2)
+        user = User.objects.filter(debt__register=other_register).first()
+        self.client.force_login(user)
+        url = reverse(
+            "rejestrapp:transaction_vote",
+            kwargs={
+                "register_id": other_register.pk,
+                "group_transaction_id": group_transaction.pk,
+            },
+        )
+
+        self.assertEqual(self.client.get(url).status_code, 404)
+        response = self.client.post(url, data={"supports": True})
+        self.assertEqual(response.status_code, 404)
+
+    @skipIfDBFeature("has_select_for_update")
+    def test_stale_version_is_rejected(self):
+        """
+        Without row locks, claiming a transaction with a version that
+        a concurrent vote has already bumped should fail.
+        """
+        _, group_transaction, _ = self.make_transaction(3)
+        GroupTransaction.objects.filter(pk=group_transaction.pk).update(
+            version=F("version") + 1
+        )
+
+        with self.assertRaises(VoteConflictException):
+            lock_group_transaction(group_transaction)
+
+    def test_votes_after_settling_change_nothing(self):
+        """
+        A vote that arrives after the transaction was settled should be
+        reported as such and must not apply the amounts a second time.
+        """
+        register, group_transaction, amounts = self.make_transaction(3)
+        users = User.objects.filter(debt__register=register).order_by("pk")
+        for user in users:
+            result = cast_vote(register, group_transaction.pk, user, True, False)
+        self.assertEqual(result.outcome, VOTE_SETTLED)
+
+        result = cast_vote(register, group_transaction.pk, users[0], True, True)
+
+        self.assertEqual(result.outcome, VOTE_ALREADY_SETTLED)
+        for debt, amount in zip(
+            Debt.objects.filter(register=register).order_by("user__pk"), amounts
+        ):
+            self.assertEqual(debt.balance, 100 + amount)
+
+
+class ConcurrentVotesTests(TransactionTestCase):
+    make_transaction = SettlementTests.make_transaction
+
+    def test_concurrent_votes_settle_once(self):
+        """
+        Members voting at the same time, each on their own connection,
+        should have all their votes recorded and settle the transaction once.
+        """
+        register, group_transaction, amounts = self.make_transaction(6)
+        users = list(User.objects.filter(debt__register=register).order_by("pk"))
+        outcomes = []
+        barrier = threading.Barrier(len(users))
+
+        def vote(user):
+            try:
+                barrier.wait()
+                result = cast_vote(register, group_transaction.pk, user, True, False)
+                outcomes.append(result.outcome)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=vote, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(outcomes), [VOTE_RECORDED] * 5 + [VOTE_SETTLED])
+        group_transaction.refresh_from_db()
+        self.assertEqual(group_transaction.support_count, 6)
+        for debt, amount in zip(
+            Debt.objects.filter(register=register).order_by("user__pk"), amounts
+        ):
+            self.assertEqual(debt.balance, 100 + amount)
+
+
+class VoteCountersTests(TestCase):
+    def setUp(self):
+        """
+        3 users in 1 register, 1 transaction created through the view
+        """
+        users = ["A", "B", "C"]
+        self.users = [User.objects.create_user(username=u, password=u) for u in users]
+        self.registerA = Register.objects.create(name="registerA", all_accepted=True)
+        self.registerA.users.add(*self.users, through_defaults={"accepted": True})
+        data = {f"value_for_{user.pk}": "0" for user in self.users}
+        data.update({"transaction_name": "transactionA"})
+        self.client.force_login(self.users[0])
+        post_data_to_new_transaction_view(self, data)
+        self.transaction = GroupTransaction.objects.get()
+        self.url = reverse(
+            "rejestrapp:transaction_vote",
+            kwargs={
+                "register_id": self.registerA.pk,
+                "group_transaction_id": self.transaction.pk,
+            },
+        )
+
+    def test_counters_follow_votes(self):
+        """
+        Changing a vote back and forth should move the counters by one
+        and repeating the same vote shouldn't move them at all.
+        """
+        self.assertEqual(self.transaction.member_count, 3)
+        votes_and_counts = [
+            ({"supports": True, "wants_remove": False}, (1, 0)),
+            ({"supports": True, "wants_remove": False}, (1, 0)),
+            ({"supports": True, "wants_remove": True}, (1, 1)),
+            ({"supports": False, "wants_remove": True}, (0, 1)),
+            ({"supports": False, "wants_remove": False}, (0, 0)),
+        ]
+        for data, (support_count, remove_count) in votes_and_counts:
+            self.client.post(self.url, data=data)
+            self.transaction.refresh_from_db()
+            self.assertEqual(self.transaction.support_count, support_count)
+            self.assertEqual(self.transaction.remove_count, remove_count)
+
+    def test_recount_votes_command(self):
+        """
+        The recount_votes command should report broken counters
+        when checking and fix them otherwise.
+        """
+        GroupTransaction.objects.update(support_count=2, member_count=0)
+
+        with self.assertRaises(CommandError):
+            call_command("recount_votes", "--check", stdout=StringIO())
+        call_command("recount_votes", stdout=StringIO())
+        call_command("recount_votes", "--check", stdout=StringIO())
+
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.support_count, 0)
+        self.assertEqual(self.transaction.member_count, 3)
+
+    def test_votes_on_uncounted_transactions(self):
+        """
+        A transaction created before the counters, with a member count of 0,
+        should have its votes counted by the next vote, which can settle it.
+        """
+        IndividualsTransaction.objects.exclude(debt__user=self.users[0]).update(
+            supports=True
+        )
+        GroupTransaction.objects.update(support_count=0, remove_count=0, member_count=0)
+
+        self.client.post(self.url, data={"supports": True})
+
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.member_count, 3)
+        self.assertEqual(self.transaction.support_count, 3)
+        self.assertTrue(self.transaction.is_settled)
+
+
+class RegisterViewHistoryTests(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        """
+        2 users in 1 register with 10 pending and 35 settled transactions,
+        some of which share their dates.
+        """
+        self.users = [
+            User.objects.create_user(username=u, password=u) for u in ["A", "B"]
+        ]
+        self.registerA = Register.objects.create(name="registerA", all_accepted=True)
+        self.registerA.users.add(*self.users, through_defaults={"accepted": True})
+        debts = list(Debt.objects.filter(register=self.registerA))
+        start = timezone.now()
+        for i in range(45):
+            settled = i >= 10
+            group_transaction = GroupTransaction.objects.create(
+                name=f"transaction{i}",
+                init_date=start + datetime.timedelta(minutes=i // 3),
+                is_settled=settled,
+                settle_date=(
+                    start + datetime.timedelta(hours=i // 4) if settled else None
+                ),
+                register=self.registerA,
+                member_count=2,
+            )
+            group_transaction.debts.add(*debts)
+        self.expected = list(
+            GroupTransaction.objects.order_by(
+                "is_settled", "-settle_date", "-init_date", "-pk"
+            ).values_list("pk", flat=True)
+        )
+        self.url = reverse(
+            "rejestrapp:register", kwargs={"register_id": self.registerA.pk}
+        )
+        self.client.force_login(self.users[0])
+        register_pages_cache().clear()
+
+    def get_page(self, query):
+        response = self.client.get(self.url + query)
+        self.assertEqual(response.status_code, 200)
+        context = response.context
+        return (
+            [transaction.pk for transaction in context["transactions"]],
+            context["older"],
+            context["newer"],
+        )
+
+    def test_paging_through_history(self):
+        """
+        Following the 'older' links from the first page and then the 'newer'
+        links back should visit every transaction once, in the right order.
+        """
+        pages = []
+        page, older, newer = self.get_page("")
+        self.assertIsNone(newer)
+        pages.append(page)
+        while older is not None:
+            page, older, newer = self.get_page(f"?after={older}")
+            pages.append(page)
+        self.assertEqual([len(page) for page in pages], [20, 20, 5])
+        self.assertEqual([pk for page in pages for pk in page], self.expected)
+
+        backwards = [pages[-1]]
+        while newer is not None:
+            page, older, newer = self.get_page(f"?before={newer}")
+            backwards.append(page)
+        self.assertEqual(backwards[::-1], pages)
+
+    def test_history_query_count_does_not_depend_on_page(self):
+        """
+        Fetching a page deep in the history should cost
+        as many queries as fetching the first one.
+        """
+        with CaptureQueriesContext(connection) as first_page_queries:
+            self.get_page(f"?after={self.expected[0]}")
+        with CaptureQueriesContext(connection) as last_page_queries:
+            self.get_page(f"?after={self.expected[-6]}")
+        self.assertEqual(len(first_page_queries), len(last_page_queries))
+
+
+class UserspaceViewTests(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        """
+        4 users; A belongs to an accepted register, to a register where
+        A has accepted the invitation and to one where A hasn't yet.
+        """
+        users = ["A", "B", "C", "D"]
+        self.users = [User.objects.create_user(username=u, password=u) for u in users]
+        self.add_registers()
+        self.client.force_login(self.users[0])
+
+    def add_registers(self, prefix=""):
+        accepted = Register.objects.create(name=prefix + "accepted", all_accepted=True)
+        accepted.users.add(*self.users[:2], through_defaults={"accepted": True})
+        invited = Register.objects.create(name=prefix + "invited")
+        invited.users.add(*self.users[:2], through_defaults={"accepted": True})
+        invited.users.add(*self.users[2:], through_defaults={"accepted": False})
+        pending = Register.objects.create(name=prefix + "pending")
+        pending.users.add(*self.users, through_defaults={"accepted": False})
+        return accepted, invited, pending
+
+    def test_userspace_lists_registers_and_invites(self):
+        """
+        The registers should be split by their state, and the accepted invites
+        should show how many members have accepted so far.
+        """
+        response = self.client.get(reverse("rejestrapp:userspace"))
+
+        self.assertEqual(
+            [r.name for r in response.context["accepted_registers"]], ["accepted"]
+        )
+        self.assertEqual(
+            [(r.name, a, t) for r, a, t in response.context["accepted_invites"]],
+            [("invited", 2, 4)],
+        )
+        self.assertEqual(
+            [r.name for r in response.context["not_accepted_invites"]], ["pending"]
+        )
+
+    @override_settings(DATABASE_REPLICA=None)
+    def test_userspace_query_count(self):
+        """
+        The whole userspace should be loaded with a single query
+        (besides the session and the user), no matter how many registers
+        the user belongs to.
+        """
+        for i in range(10):
+            self.add_registers(prefix=str(i))
+
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse("rejestrapp:userspace"))
+        self.assertEqual(len(response.context["accepted_invites"]), 11)
+
+
+class RegisterPageCacheTests(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        """
+        3 users in 1 register, logged in as 'A'.
+        """
+        users = ["A", "B", "C"]
+        self.users = [User.objects.create_user(username=u, password=u) for u in users]
+        self.registerA = Register.objects.create(name="registerA", all_accepted=True)
+        self.registerA.users.add(*self.users, through_defaults={"accepted": True})
+        self.url = reverse(
+            "rejestrapp:register", kwargs={"register_id": self.registerA.pk}
+        )
+        self.client.force_login(self.users[0])
+        register_pages_cache().clear()
+
+    def vote_url(self, group_transaction):
+        return reverse(
+            "rejestrapp:transaction_vote",
+            kwargs={
+                "register_id": self.registerA.pk,
+                "group_transaction_id": group_transaction.pk,
+            },
+        )
+
+    @override_settings(DATABASE_REPLICA=None)
+    def test_repeat_views_are_cached(self):
+        """
+        Viewing an unchanged register again should only cost the queries
+        of the session, the user and the access check.
+        """
+        with CaptureQueriesContext(connection) as first_queries:
+            self.client.get(self.url)
+        with CaptureQueriesContext(connection) as repeat_queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(len(repeat_queries), len(first_queries))
+        for query in repeat_queries:
+            self.assertNotIn("rejestrapp_grouptransaction", query["sql"])
+
+    def test_writes_invalidate_the_cache(self):
+        """
+        Creating, settling and removing a transaction should
+        all be visible on the register's page right away.
+        """
+        self.assertEqual(len(self.client.get(self.url).context["transactions"]), 0)
+
+        data = {
+            f"value_for_{self.users[i].pk}": value
+            for i, value in enumerate(["1.00", "-0.50", "-0.50"])
+        }
+        data.update({"transaction_name": "transactionA"})
+        post_data_to_new_transaction_view(self, data)
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.context["transactions"]), 1)
+        self.assertInHTML("<td>0.00</td>", response.content.decode(), count=3)
+
+        settled = GroupTransaction.objects.get()
+        for user in self.users:
+            self.client.force_login(user)
+            self.client.post(self.vote_url(settled), data={"supports": True})
+        response = self.client.get(self.url)
+        self.assertTrue(response.context["transactions"][0].is_settled)
+        self.assertInHTML("<td>1.00</td>", response.content.decode())
+
+        post_data_to_new_transaction_view(self, data)
+        self.client.get(self.url)
+        pending = GroupTransaction.objects.get(is_settled=False)
+        for user in self.users:
+            self.client.force_login(user)
+            self.client.post(self.vote_url(pending), data={"wants_remove": True})
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.context["transactions"]), 1)
+
+    def test_username_change_invalidates_the_cache(self):
+        self.client.get(self.url)
+        self.users[1].username = "Bartek"
+        self.users[1].save()
+        response = self.client.get(self.url)
+        self.assertContains(response, "Bartek")
+        self.assertNotContains(response, "<td>B</td>", html=True)
+
+
+class EmailApiStub:
+    """
+    A local HTTP server standing in for the email provider. It answers
+    every POST with the next status code from status_codes (repeating
+    the last one), or the next (status code, JSON body) pair, and keeps
+    the decoded JSON bodies in self.requests, the paths in self.paths
+    and the clients' ports in self.client_ports.
+    """
+
+    def __init__(self, status_codes):
+        self.status_codes = list(status_codes)
+        self.requests = []
+        self.paths = []
+        self.client_ports = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # allows keep-alive
+
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                stub.requests.append(json.loads(self.rfile.read(length)))
+                stub.paths.append(self.path)
+                stub.client_ports.append(self.client_address[1])
+                status_code = (
+                    stub.status_codes.pop(0)
+                    if len(stub.status_codes) > 1
+                    else stub.status_codes[0]
+                )
+                body = {}
+                if isinstance(status_code, tuple):
+                    status_code, body = status_code
+                body = json.dumps(body).encode()
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v1/email"
+        self.bulk_url = f"http://127.0.0.1:{self.server.server_port}/v1/bulk-email"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.email = enqueue_email("a@example.com", "userA", "Temat", "<p>Treść</p>")
+
+    def drain(self, stub, bulk=False):
+        with override_settings(
+            EMAIL_API_URL=stub.url, EMAIL_API_BULK_URL=stub.bulk_url
+        ):
+            return drain_outbox(10, bulk)
+
+    def make_due(self):
+        OutgoingEmail.objects.update(next_attempt_at=timezone.now())
+
+    def test_signup_only_enqueues_the_activation_email(self):
+        """
+        Signing up should put the activation email in the outbox
+        instead of contacting the email provider.
+        """
+        OutgoingEmail.objects.all().delete()
+        response = self.client.post(
+            reverse("rejestrapp:signup"),
+            data={
+                "username": "userB",
+                "email": "B@example.com",
+                "password1": "akeugr!2364t9JVFCTH",
+                "password2": "akeugr!2364t9JVFCTH",
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.to_email, "b@example.com")
+        self.assertEqual(email.status, OutgoingEmail.Status.PENDING)
+        self.assertIn("account-activation", email.html)
+
+    def test_sending(self):
+        """A successfully sent email should be marked as such."""
+        with EmailApiStub([202]) as stub:
+            counts = self.drain(stub)
+        self.assertEqual(counts, {"sent": 1, "retried": 0, "dead": 0})
+        self.assertEqual(stub.requests[0]["to"][0]["email"], "a@example.com")
+        self.email.refresh_from_db()
+        self.assertEqual(self.email.status, OutgoingEmail.Status.SENT)
+        self.assertEqual(self.email.attempts, 1)
+
+    def test_sending_in_bulk(self):
+        """A whole batch should be sent with a single bulk request."""
+        enqueue_email("b@example.com", "userB", "Temat", "<p>Treść</p>")
+        with EmailApiStub([202]) as stub:
+            counts = self.drain(stub, bulk=True)
+        self.assertEqual(counts, {"sent": 2, "retried": 0, "dead": 0})
+        self.assertEqual(len(stub.requests), 1)
+        self.assertEqual(len(stub.requests[0]), 2)
+
+    def test_bulk_outcomes_of_single_messages(self):
+        """
+        Messages rejected by the provider in a bulk request should be
+        dead-lettered on their own, while the rest of the batch is sent,
+        or retried when the whole request was refused because of them.
+        """
+        second = enqueue_email("b@example.com", "userB", "Temat", "<p>Treść</p>")
+        third = enqueue_email("c@example.com", "userC", "Temat", "<p>Treść</p>")
+        OutgoingEmail.objects.filter(pk=third.pk).update(
+            next_attempt_at=timezone.now() + datetime.timedelta(minutes=1)
+        )
+        errors = {"errors": {"1.to.0.email": ["The email is invalid."]}}
+        with EmailApiStub([(422, errors)]) as stub:
+            counts = self.drain(stub, bulk=True)
+        self.assertEqual(counts, {"sent": 0, "retried": 1, "dead": 1})
+        self.email.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(self.email.status, OutgoingEmail.Status.PENDING)
+        self.assertEqual(self.email.attempts, 1)
+        self.assertEqual(second.status, OutgoingEmail.Status.DEAD)
+        self.assertEqual(
+            second.last_error, "HTTP 422: to.0.email: The email is invalid."
+        )
+
+        # the first email is due before the third one
+        for email, seconds in [(self.email, 2), (third, 1)]:
+            OutgoingEmail.objects.filter(pk=email.pk).update(
+                next_attempt_at=timezone.now() - datetime.timedelta(seconds=seconds)
+            )
+        with EmailApiStub([(202, errors)]) as stub:
+            counts = self.drain(stub, bulk=True)
+        self.assertEqual(counts, {"sent": 1, "retried": 0, "dead": 1})
+        self.assertEqual(len(stub.requests[0]), 2)
+        self.email.refresh_from_db()
+        third.refresh_from_db()
+        self.assertEqual(self.email.status, OutgoingEmail.Status.SENT)
+        self.assertEqual(third.status, OutgoingEmail.Status.DEAD)
+
+    def test_retrying_with_backoff(self):
+        """
+        A server error should postpone the email, each time for longer,
+        and it should be sent once the provider recovers.
+        """
+        delays = []
+        with EmailApiStub([500, 502, 202]) as stub:
+            for _ in range(2):
+                before = timezone.now()
+                self.assertEqual(self.drain(stub)["retried"], 1)
+                self.email.refresh_from_db()
+                delays.append(self.email.next_attempt_at - before)
+                self.assertEqual(self.drain(stub)["retried"], 0)  # not due yet
+                self.make_due()
+            self.assertEqual(self.drain(stub)["sent"], 1)
+        self.assertLess(delays[0], delays[1])
+        self.assertEqual(len(stub.requests), 3)
+        self.email.refresh_from_db()
+        self.assertEqual(self.email.last_error, "")
+
+    def test_dead_lettering(self):
+        """
+        An email should be given up on after too many failed attempts,
+        or right away when the provider rejects it.
+        """
+        with EmailApiStub([500]) as stub:
+            for _ in range(OUTBOX_MAX_ATTEMPTS - 1):
+                self.assertEqual(self.drain(stub)["retried"], 1)
+                self.make_due()
+            self.assertEqual(self.drain(stub)["dead"], 1)
+        self.email.refresh_from_db()
+        self.assertEqual(self.email.status, OutgoingEmail.Status.DEAD)
+        self.assertEqual(self.email.last_error, "HTTP 500")
+
+        rejected = enqueue_email("b@example.com", "userB", "Temat", "<p>Treść</p>")
+        with EmailApiStub([422]) as stub:
+            self.assertEqual(self.drain(stub)["dead"], 1)
+        rejected.refresh_from_db()
+        self.assertEqual(rejected.attempts, 1)
+
+
+class EmailClientTests(SimpleTestCase):
+    def make_client(self, stub):
+        return EmailClient(stub.url, stub.bulk_url, "key", backoff_factor=0)
+
+    def test_connections_are_reused(self):
+        """Consecutive messages should be sent over the same connection."""
+        with EmailApiStub([202]) as stub:
+            client = self.make_client(stub)
+            for i in range(5):
+                self.assertEqual(client.send({"subject": str(i)}).status_code, 202)
+            client.close()
+        self.assertEqual(len(stub.requests), 5)
+        self.assertEqual(len(set(stub.client_ports)), 1)
+
+    def test_retrying_and_stats(self):
+        """
+        A 503 response should be retried within a single send, a 500 one
+        shouldn't, and the stats should count each send once.
+        """
+        with EmailApiStub([503, 202, 500]) as stub:
+            client = self.make_client(stub)
+            self.assertEqual(client.send({}).status_code, 202)
+            self.assertEqual(client.send({}).status_code, 500)
+            client.close()
+        self.assertEqual(len(stub.requests), 3)
+        stats = client.stats()
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(stats["errors"], 1)
+        self.assertEqual(sum(stats["latency_buckets"].values()), 2)
+        self.assertGreater(stats["latency_sum"], 0)
+
+    def test_send_bulk(self):
+        """
+        Bulk sending should post a list of messages to the bulk endpoint
+        and refuse more messages than fit in a single request.
+        """
+        with EmailApiStub([202]) as stub:
+            client = self.make_client(stub)
+            response = client.send_bulk([{"subject": "a"}, {"subject": "b"}])
+            with self.assertRaises(ValueError):
+                client.send_bulk([{}] * (BULK_MAX_MESSAGES + 1))
+            client.close()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(stub.paths, ["/v1/bulk-email"])
+        self.assertEqual(stub.requests, [[{"subject": "a"}, {"subject": "b"}]])
+
+
+class CronjobsTests(TestCase):
+    def add_unfinished_user(self, name, expires_in):
+        User.objects.create(username=name, email=f"{name}@example.com", is_active=False)
+        SignupToken.objects.create(
+            secret=name,
+            email=f"{name}@example.com",
+            expires_at=timezone.now() + expires_in,
+        )
+
+    def test_delete_unfinished_users_only_deletes_expired(self):
+        """
+        Expired tokens should be deleted along with their inactive users,
+        while tokens that are still valid should be left alone.
+        """
+        for i in range(CLEANUP_CHUNK_SIZE + 3):
+            self.add_unfinished_user(f"old{i}", -datetime.timedelta(minutes=1))
+        self.add_unfinished_user("fresh", datetime.timedelta(hours=1))
+
+        report = delete_unfinished_users()
+
+        self.assertEqual(report["tokens_deleted"], CLEANUP_CHUNK_SIZE + 3)
+        self.assertEqual(report["users_deleted"], CLEANUP_CHUNK_SIZE + 3)
+        self.assertEqual(
+            list(SignupToken.objects.values_list("secret", flat=True)), ["fresh"]
+        )
+        self.assertEqual(
+            list(User.objects.values_list("username", flat=True)), ["fresh"]
+        )
+
+    def test_do_cronjobs_reports_each_job(self):
+        self.add_unfinished_user("old", -datetime.timedelta(minutes=1))
+
+        reports = do_cronjobs()
+
+        self.assertEqual(reports["delete_unfinished_users"]["tokens_deleted"], 1)
+        self.assertIn("duration_s", reports["delete_unfinished_users"])
+
+    def test_signing_up_replaces_expired_signups(self):
+        """
+        An expired signup that wasn't cleaned up yet shouldn't block its
+        username or email, while one that is still valid should.
+        """
+        self.add_unfinished_user("old", -datetime.timedelta(minutes=1))
+        self.add_unfinished_user("other", -datetime.timedelta(minutes=1))
+        self.add_unfinished_user("fresh", datetime.timedelta(hours=1))
+        password = "akeugr!2364t9JVFCTH"
+        data = {"password1": password, "password2": password}
+
+        response = self.client.post(
+            reverse("rejestrapp:signup"),
+            data={**data, "username": "old", "email": "other@example.com"},
+        )
+
+        self.assertTemplateUsed(response, "rejestrapp/go_to_email.html")
+        new_user = User.objects.get(username="old")
+        self.assertEqual(new_user.email, "other@example.com")
+        self.assertFalse(User.objects.filter(username="other").exists())
+        self.assertEqual(
+            SignupToken.objects.filter(email="other@example.com").count(), 1
+        )
+
+        response = self.client.post(
+            reverse("rejestrapp:signup"),
+            data={**data, "username": "fresh", "email": "new@example.com"},
+        )
+
+        self.assertTemplateNotUsed(response, "rejestrapp/go_to_email.html")
+        self.assertFalse(User.objects.filter(email="new@example.com").exists())
+
+
+class SettleUpTests(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        """
+        4 users in 1 register with balances of 75, -60, 20 and -35 zł.
+        """
+        users = ["A", "B", "C", "D"]
+        self.users = [User.objects.create_user(username=u, password=u) for u in users]
+        self.registerA = Register.objects.create(name="registerA", all_accepted=True)
+        self.registerA.users.add(*self.users, through_defaults={"accepted": True})
+        for user, balance in zip(self.users, [7500, -6000, 2000, -3500]):
+            Debt.objects.filter(user=user).update(balance=balance)
+        self.url = reverse(
+            "rejestrapp:settle_up", kwargs={"register_id": self.registerA.pk}
+        )
+        self.client.force_login(self.users[0])
+
+    def test_plan_transfers(self):
+        """
+        The planned transfers should bring every balance to zero, pair up
+        exact matches first and never take more than n - 1 transfers.
+        """
+        balances = {1: 500, 2: -500, 3: 1200, 4: -300, 5: -900, 6: 0}
+        transfers = plan_transfers(balances)
+
+        self.assertIn(Transfer(1, 2, 500), transfers)
+        self.assertLessEqual(len(transfers), 4)
+        for transfer in transfers:
+            self.assertGreater(transfer.amount, 0)
+            balances[transfer.payer] -= transfer.amount
+            balances[transfer.payee] += transfer.amount
+        self.assertEqual(set(balances.values()), {0})
+
+        self.assertRaises(BadGroszeException, plan_transfers, {1: 1})
+
+    def test_recording_the_plan(self):
+        """
+        Recording the plan should create a transaction per transfer,
+        and once their payers and payees confirm them, everyone is at zero.
+        """
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.context["transfers"]), 3)
+
+        response = self.client.post(self.url, {"version": response.context["version"]})
+
+        self.assertRedirects(
+            response,
+            reverse("rejestrapp:register", kwargs={"register_id": self.registerA.pk}),
+        )
+        self.assertEqual(GroupTransaction.objects.count(), 3)
+        for indiv in IndividualsTransaction.objects.select_related("debt__user"):
+            self.client.force_login(indiv.debt.user)
+            self.client.post(
+                reverse(
+                    "rejestrapp:transaction_vote",
+                    kwargs={
+                        "register_id": self.registerA.pk,
+                        "group_transaction_id": indiv.group_transaction_id,
+                    },
+                ),
+                data={"supports": True},
+            )
+        self.assertEqual(GroupTransaction.objects.filter(is_settled=True).count(), 3)
+        self.assertEqual(set(Debt.objects.values_list("balance", flat=True)), {0})
+
+    def test_recording_a_plan_twice(self):
+        """
+        Submitting the same plan again, or a plan shown before the register
+        changed, shouldn't record anything.
+        """
+        version = self.client.get(self.url).context["version"]
+
+        self.client.post(self.url, {"version": version})
+        response = self.client.post(self.url, {"version": version})
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(GroupTransaction.objects.count(), 3)
+        self.assertEqual(self.client.post(self.url).status_code, 409)
+        self.assertEqual(GroupTransaction.objects.count(), 3)
+
+    def test_planning_while_transfers_are_pending(self):
+        """
+        Transfers recorded earlier, but not confirmed yet, shouldn't be
+        planned again, until they're rejected.
+        """
+        self.client.post(
+            self.url, {"version": self.client.get(self.url).context["version"]}
+        )
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.context["transfers"], [])
+        self.client.post(self.url, {"version": response.context["version"]})
+        self.assertEqual(GroupTransaction.objects.count(), 3)
+
+        rejected = GroupTransaction.objects.first()
+        for indiv in rejected.individualstransaction_set.select_related("debt__user"):
+            self.client.force_login(indiv.debt.user)
+            self.client.post(
+                reverse(
+                    "rejestrapp:transaction_vote",
+                    kwargs={
+                        "register_id": self.registerA.pk,
+                        "group_transaction_id": rejected.pk,
+                    },
+                ),
+                data={"wants_remove": True},
+            )
+        self.assertEqual(GroupTransaction.objects.count(), 2)
+        self.assertEqual(len(self.client.get(self.url).context["transfers"]), 1)
+
+
+class ImportTransactionsTests(TestCase):
+    def setUp(self):
+        """
+        3 users in 1 register, logged in as 'A'.
+        """
+        users = ["A", "B", "C"]
+        self.users = [User.objects.create_user(username=u, password=u) for u in users]
+        self.registerA = Register.objects.create(name="registerA", all_accepted=True)
+        self.registerA.users.add(*self.users, through_defaults={"accepted": True})
+        self.client.force_login(self.users[0])
+
+    def amounts(self, name):
+        return dict(
+            IndividualsTransaction.objects.filter(
+                group_transaction__name=name
+            ).values_list("debt__user__username", "amount")
+        )
+
+    def test_import_command(self):
+        """
+        Valid rows should become pending transactions with an indiv
+        for every member, invalid ones should be skipped and reported.
+        """
+        lines = [
+            "name,A,B,C",
+            "Pizza,-30.00,15,15.00",
+            "Kino,10,-10,",
+            "Zła suma,10,10,10",
+            "Za krótki,1",
+            "Taxi,-1.5,0.75,0.75",
+        ]
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as file:
+            file.write("\n".join(lines))
+        stdout, stderr = StringIO(), StringIO()
+        try:
+            call_command(
+                "import_transactions",
+                str(self.registerA.pk),
+                file.name,
+                "--batch-size=2",
+                stdout=stdout,
+                stderr=stderr,
+            )
+        finally:
+            os.remove(file.name)
+
+        self.assertIn("Imported 3 transactions, skipped 2 rows", stdout.getvalue())
+        self.assertIn("line 4:", stderr.getvalue())
+        self.assertIn("line 5:", stderr.getvalue())
+        self.assertEqual(self.amounts("Kino"), {"A": 1000, "B": -1000, "C": 0})
+        self.assertEqual(self.amounts("Taxi"), {"A": -150, "B": 75, "C": 75})
+        for group_transaction in GroupTransaction.objects.all():
+            self.assertFalse(group_transaction.is_settled)
+            self.assertEqual(group_transaction.member_count, 3)
+            self.assertEqual(group_transaction.register, self.registerA)
+
+    def test_import_command_from_stdin(self):
+        """The standard input, which can't be rewound, should be imported too."""
+        stdin, stdout = sys.stdin, StringIO()
+        sys.stdin = StringIO("name,A,B,C\nPizza,-3,3,\nZła suma,1,1,1\n")
+        try:
+            call_command(
+                "import_transactions", str(self.registerA.pk), "-", stdout=stdout
+            )
+        finally:
+            sys.stdin = stdin
+
+        self.assertIn("Imported 1 transactions, skipped 1 rows", stdout.getvalue())
+        self.assertEqual(self.amounts("Pizza"), {"A": -300, "B": 300, "C": 0})
+
+    def test_import_upload(self):
+        """Uploading a JSON lines file should import it the same way."""
+        content = "\n".join(
+            [
+                json.dumps({"name": "Pizza", "amounts": {"A": "-3", "B": 3}}),
+                json.dumps({"name": "Obcy", "amounts": {"X": "-3", "B": 3}}),
+                "{not json",
+            ]
+        )
+        response = self.client.post(
+            reverse(
+                "rejestrapp:import_transactions",
+                kwargs={"register_id": self.registerA.pk},
+            ),
+            data={
+                "file_format": "jsonl",
+                "file": SimpleUploadedFile("import.jsonl", content.encode()),
+            },
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["report"]["imported"], 1)
+        self.assertEqual(response.context["report"]["skipped"], 2)
+        self.assertEqual(self.amounts("Pizza"), {"A": -300, "B": 300, "C": 0})
+
+    def upload_csv(self, lines):
+        return self.client.post(
+            reverse(
+                "rejestrapp:import_transactions",
+                kwargs={"register_id": self.registerA.pk},
+            ),
+            data={
+                "file_format": "csv",
+                "file": SimpleUploadedFile("import.csv", "\n".join(lines).encode()),
+            },
+        )
+
+    def test_import_upload_with_huge_amounts(self):
+        """Amounts too large to be stored should be reported like other errors."""
+        response = self.upload_csv(["name,A,B,C", "Jacht,-1e30,1e30,", "Pizza,-3,3,"])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["report"]["imported"], 1)
+        self.assertEqual(response.context["report"]["errors"][0][0], 2)
+        self.assertFalse(GroupTransaction.objects.filter(name="Jacht").exists())
+
+    def test_import_upload_is_atomic(self):
+        """
+        A file that turns out to be unreadable after more than a batch
+        of valid rows shouldn't have any of them imported.
+        """
+        lines = ["name,A,B,C"]
+        lines += [f"Pizza {i},-3,3," for i in range(IMPORT_BATCH_SIZE + 1)]
+        lines.append('"' + "x" * (csv.field_size_limit() + 1) + '",-3,3,')
+
+        response = self.upload_csv(lines)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(GroupTransaction.objects.exists())
+
+
+class ExportTransactionsTests(TestCase):
+    def setUp(self):
+        """
+        2 users in 1 register with one settled and one pending transaction.
+        """
+        self.users = [
+            User.objects.create_user(username=u, password=u) for u in ["A", "B"]
+        ]
+        self.registerA = Register.objects.create(name="registerA", all_accepted=True)
+        self.registerA.users.add(*self.users, through_defaults={"accepted": True})
+        debts = list(Debt.objects.filter(register=self.registerA).order_by("user"))
+        for i, name in enumerate(["settled", "pending"]):
+            group_transaction = GroupTransaction.objects.create(
+                name=name,
+                init_date=timezone.now() + datetime.timedelta(minutes=i),
+                register=self.registerA,
+                member_count=2,
+            )
+            for debt, amount in zip(debts, [-1250, 1250]):
+                group_transaction.debts.add(debt, through_defaults={"amount": amount})
+        settle_group_transaction(
+            GroupTransaction.objects.get(name="settled"), self.registerA
+        )
+        self.client.force_login(self.users[0])
+
+    def export(self, file_format):
+        response = self.client.get(
+            reverse(
+                "rejestrapp:export_transactions",
+                kwargs={"register_id": self.registerA.pk},
+            ),
+            {"format": file_format},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode()
+
+    def test_csv_export(self):
+        rows = list(csv.DictReader(StringIO(self.export("csv"))))
+        self.assertEqual(
+            [(r["transaction_name"], r["username"], r["amount"]) for r in rows],
+            [
+                ("settled", "A", "-12.50"),
+                ("settled", "B", "12.50"),
+                ("pending", "A", "-12.50"),
+                ("pending", "B", "12.50"),
+            ],
+        )
+        self.assertEqual([r["balance_before"] for r in rows], ["0.00", "0.00", "", ""])
+
+    def test_jsonl_export(self):
+        rows = [json.loads(line) for line in self.export("jsonl").splitlines()]
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(rows[0]["is_settled"])
+        self.assertIsNone(rows[3]["settle_date"])
+
+
+class ApiTests(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        """
+        3 users in 1 register with one pending transaction,
+        logged in as 'A'.
+        """
+        self.users = [
+            User.objects.create_user(username=u, password=u) for u in ["A", "B", "C"]
+        ]
+        self.registerA = Register.objects.create(name="registerA", all_accepted=True)
+        self.registerA.users.add(*self.users, through_defaults={"accepted": True})
+        self.group_transaction = GroupTransaction.objects.create(
+            name="pizza",
+            init_date=timezone.now(),
+            register=self.registerA,
+            member_count=3,
+        )
+        for debt, amount in zip(
+            Debt.objects.filter(register=self.registerA).order_by("user"),
+            [-2000, 1000, 1000],
+        ):
+            self.group_transaction.debts.add(debt, through_defaults={"amount": amount})
+        self.client.force_login(self.users[0])
+        register_pages_cache().clear()
+
+    def url(self, name, **kwargs):
+        return reverse(
+            f"rejestrapp:{name}", kwargs={"register_id": self.registerA.pk, **kwargs}
+        )
+
+    def post_json(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type="application/json")
+
+    def vote(self, user, supports=True, wants_remove=False):
+        self.client.force_login(user)
+        return self.post_json(
+            self.url("api_votes"),
+            {
+                "votes": [
+                    {
+                        "transaction": self.group_transaction.pk,
+                        "supports": supports,
+                        "wants_remove": wants_remove,
+                    }
+                ]
+            },
+        )
+
+    def test_registers(self):
+        response = self.client.get(reverse("rejestrapp:api_registers"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["registers"],
+            [
+                {
+                    "id": self.registerA.pk,
+                    "name": "registerA",
+                    "all_accepted": True,
+                    "accepted": True,
+                    "accepted_count": 3,
+                    "member_count": 3,
+                }
+            ],
+        )
+
+    def test_register(self):
+        response = self.client.get(self.url("api_register"))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(
+            [debt["balance"] for debt in data["debts"]], ["0.00", "0.00", "0.00"]
+        )
+        self.assertEqual(
+            [t["id"] for t in data["transactions"]], [self.group_transaction.pk]
+        )
+
+    def test_unchanged_register_is_not_modified(self):
+        """
+        Polling an unchanged register should get a 304 with no body
+        and without reading its transactions. A change to the register
+        should make the old ETag stale.
+        """
+        etag = self.client.get(self.url("api_register"))["ETag"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                self.url("api_register"), HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        for query in queries:
+            self.assertNotIn("rejestrapp_grouptransaction", query["sql"])
+
+        for user in self.users:
+            self.vote(user)
+        response = self.client.get(self.url("api_register"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(
+            [debt["balance"] for debt in response.json()["debts"]],
+            ["-20.00", "10.00", "10.00"],
+        )
+
+    def test_transactions_etag_changes_with_votes(self):
+        url = self.url("api_transactions") + f"?ids={self.group_transaction.pk}"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        [details] = response.json()["transactions"]
+        self.assertEqual(
+            [indiv["amount"] for indiv in details["indivs"]],
+            ["-20.00", "10.00", "10.00"],
+        )
+        etag = response["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.vote(self.users[1])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["transactions"][0]["support_count"], 1)
+
+    def test_etags_change_with_usernames(self):
+        register_url = self.url("api_register")
+        transactions_url = (
+            self.url("api_transactions") + f"?ids={self.group_transaction.pk}"
+        )
+        etags = [
+            self.client.get(url)["ETag"] for url in (register_url, transactions_url)
+        ]
+        self.users[1].username = "Bartek"
+        self.users[1].save()
+        for url, etag in zip((register_url, transactions_url), etags):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("Bartek", response.content.decode())
+
+    def test_create_transactions(self):
+        response = self.post_json(
+            self.url("api_transactions"),
+            {
+                "transactions": [
+                    {"name": "kino", "amounts": {"A": "-30", "B": "15", "C": "15"}},
+                    {"name": "bilety", "amounts": {"B": "-5", "C": "5"}},
+                ]
+            },
+        )
+        self.assertEqual(response.status_code, 201)
+        ids = response.json()["ids"]
+        self.assertEqual(
+            list(
+                GroupTransaction.objects.filter(pk__in=ids)
+                .order_by("pk")
+                .values_list("name", "member_count")
+            ),
+            [("kino", 3), ("bilety", 3)],
+        )
+
+    def test_invalid_transactions_create_nothing(self):
+        response = self.post_json(
+            self.url("api_transactions"),
+            {
+                "transactions": [
+                    {"name": "kino", "amounts": {"A": "-30", "B": "30"}},
+                    {"name": "bilety", "amounts": {"B": "-5", "C": "4"}},
+                ]
+            },
+        )
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual([e["index"] for e in response.json()["errors"]], [1])
+        self.assertEqual(GroupTransaction.objects.count(), 1)
+
+    def test_votes(self):
+        for user in self.users[:2]:
+            response = self.vote(user)
+            self.assertEqual(response.json()["results"][0]["outcome"], "recorded")
+        response = self.vote(self.users[2])
+        self.assertEqual(response.json()["results"][0]["outcome"], "settled")
+        response = self.vote(self.users[2])
+        self.assertEqual(response.json()["results"][0]["outcome"], "already_settled")
+
+    def test_access(self):
+        outsider = User.objects.create_user(username="D", password="D")
+        self.client.force_login(outsider)
+        self.assertEqual(self.client.get(self.url("api_register")).status_code, 403)
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url("api_register")).status_code, 401)
+        self.assertEqual(
+            self.client.get(reverse("rejestrapp:api_registers")).status_code, 401
+        )
+
+
+class FormClassCacheTests(TestCase):
+    def setUp(self):
+        """
+        2 users in 1 register, logged in as 'A'.
+        """
+        self.users = [
+            User.objects.create_user(username=u, password=u) for u in ["A", "B"]
+        ]
+        self.registerA = Register.objects.create(name="registerA", all_accepted=True)
+        self.registerA.users.add(*self.users, through_defaults={"accepted": True})
+        self.registerA.refresh_from_db()
+        form_class_cache.clear()
+
+    def test_classes_are_reused(self):
+        first = new_transaction_form_class(self.registerA)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIs(new_transaction_form_class(self.registerA), first)
+        self.assertEqual(len(queries), 0)
+        self.assertIsNot(new_easy_transaction_form_class(self.registerA), first)
+        stats = form_class_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+
+    def test_membership_changes_invalidate(self):
+        """
+        Adding a member or renaming one should give the register
+        a new form class with the right fields.
+        """
+        first = new_transaction_form_class(self.registerA)
+        newcomer = User.objects.create_user(username="C", password="C")
+        self.registerA.users.add(newcomer, through_defaults={"accepted": True})
+        self.registerA.refresh_from_db()
+        second = new_transaction_form_class(self.registerA)
+        self.assertIsNot(second, first)
+        self.assertIn(f"value_for_{newcomer.pk}", second.base_fields)
+
+        newcomer.username = "Cezary"
+        newcomer.save()
+        self.registerA.refresh_from_db()
+        third = new_transaction_form_class(self.registerA)
+        self.assertEqual(
+            third.base_fields[f"value_for_{newcomer.pk}"].label,
+            "Wartość dla Cezary",
+        )
+
+    def test_logging_in_doesnt_invalidate(self):
+        first = new_transaction_form_class(self.registerA)
+        self.client.login(username="A", password="A")
+        self.registerA.refresh_from_db()
+        self.assertIs(new_transaction_form_class(self.registerA), first)
+
+    def test_least_recently_used_are_evicted(self):
+        cache = FormClassCache(maxsize=2)
+        registers = [self.registerA]
+        for name in ["registerB", "registerC"]:
+            register = Register.objects.create(name=name, all_accepted=True)
+            register.users.add(*self.users, through_defaults={"accepted": True})
+            register.refresh_from_db()
+            registers.append(register)
+        generate = generate_new_transaction_form_class
+        first = cache.get(registers[0], "transaction", generate)
+        cache.get(registers[1], "transaction", generate)
+        cache.get(registers[0], "transaction", generate)
+        cache.get(registers[2], "transaction", generate)
+        self.assertIs(cache.get(registers[0], "transaction", generate), first)
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.stats()["size"], 2)
+
+
+class NewEasyTransactionTests(TestCase):
+    def setUp(self):
+        """
+        3 users in 1 register, logged in as 'A'.
+        """
+        users = ["A", "B", "C"]
+        self.users = [User.objects.create_user(username=u, password=u) for u in users]
+        self.registerA = Register.objects.create(name="registerA", all_accepted=True)
+        self.registerA.users.add(*self.users, through_defaults={"accepted": True})
+        self.client.force_login(self.users[0])
+
+    def post(self, expense, contributions):
+        data = {
+            f"value_for_{user.pk}": contribution
+            for user, contribution in zip(self.users, contributions)
+        }
+        data.update({"transaction_name": "obiad", "expense": expense})
+        return self.client.post(
+            reverse(
+                "rejestrapp:new_easy_transaction",
+                kwargs={"register_id": self.registerA.pk},
+            ),
+            data=data,
+        )
+
+    def amounts(self):
+        return [
+            IndividualsTransaction.objects.get(debt__user=user).amount
+            for user in self.users
+        ]
+
+    def test_expense_is_split_evenly(self):
+        self.post("30", ["30", "0", "0"])
+        self.assertEqual(self.amounts(), [-2000, 1000, 1000])
+        group_transaction = GroupTransaction.objects.get()
+        self.assertEqual(group_transaction.member_count, 3)
+        self.assertEqual(group_transaction.register, self.registerA)
+
+    def test_leftover_grosze_are_charged_once_each(self):
+        self.post("0.05", ["0.05", "0", "0"])
+        amounts = self.amounts()
+        self.assertEqual(sum(amounts), 0)
+        # 1 grosz each and the 2 left over go to two different members
+        shares = [amounts[0] + 5] + amounts[1:]
+        self.assertEqual(sorted(shares), [1, 2, 2])
+
+    def test_contributions_must_add_up_to_expense(self):
+        response = self.post("30", ["10", "0", "0"])
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(GroupTransaction.objects.count(), 0)
+
+    def test_query_count_doesnt_depend_on_members(self):
+        """
+        Adding members shouldn't add any INSERTs of indivs.
+        """
+        with CaptureQueriesContext(connection) as few_members:
+            self.post("30", ["30", "0", "0"])
+        more_users = User.objects.bulk_create(
+            User(username=f"extra_{i}") for i in range(20)
+        )
+        self.registerA.users.add(*more_users, through_defaults={"accepted": True})
+        self.users += more_users
+        with CaptureQueriesContext(connection) as many_members:
+            self.post("30", ["30"] + ["0"] * (len(self.users) - 1))
+        self.assertEqual(GroupTransaction.objects.count(), 2)
+        self.assertEqual(len(many_members), len(few_members))
+
+
+class ItemizedSplitTests(SimpleTestCase):
+    def test_soup_and_steak(self):
+        """
+        The example from the README: one member had a 20 zł soup, another
+        a 60 zł steak, and the one who ate the soup paid for both.
+        """
+        items = [Item(2000, frozenset([1])), Item(6000, frozenset([2]))]
+        self.assertEqual(
+            split_items(items, {1: 8000, 2: 0, 3: 0}), {1: -6000, 2: 6000, 3: 0}
+        )
+
+    def test_leftover_grosze_are_deterministic(self):
+        """
+        Grosze that don't divide should go to whoever has been given
+        the fewest of them so far, and the changes should add up to zero.
+        """
+        items = [Item(100, frozenset([1, 2, 3])), Item(101, frozenset([2, 3]))]
+        contributions = {1: 201, 2: 0, 3: 0}
+        changes = split_items(items, contributions)
+        self.assertEqual(changes, {1: 34 - 201, 2: 33 + 51, 3: 33 + 50})
+        self.assertEqual(split_items(reversed(items), contributions), changes)
+        self.assertEqual(sum(changes.values()), 0)
+
+    def test_items_of_the_same_consumers_are_priced_together(self):
+        items = [Item(1, frozenset([1, 2])) for _ in range(4)]
+        self.assertEqual(split_items(items, {1: 4, 2: 0}), {1: -2, 2: 2})
+
+    def test_parse_items(self):
+        user_ids = {"A": 1, "B": 2}
+        self.assertEqual(
+            parse_items("zupa; 20; A\n\nstek; 60.5 ; B, A\npiwo;10", user_ids),
+            [
+                Item(2000, frozenset([1])),
+                Item(6050, frozenset([1, 2])),
+                Item(1000, frozenset([1, 2])),
+            ],
+        )
+        for bad in ["", "zupa", "zupa; x", "zupa; -1", "zupa; 1; C", "a;1;A;B"]:
+            self.assertRaises(ItemsFormatException, parse_items, bad, user_ids)
+
+
+class NewItemizedTransactionTests(TestCase):
+    def setUp(self):
+        """
+        3 users in 1 register, logged in as 'A'.
+        """
+        users = ["A", "B", "C"]
+        self.users = [User.objects.create_user(username=u, password=u) for u in users]
+        self.registerA = Register.objects.create(name="registerA", all_accepted=True)
+        self.registerA.users.add(*self.users, through_defaults={"accepted": True})
+        self.client.force_login(self.users[0])
+
+    def post(self, expense, items, contributions):
+        data = {
+            f"value_for_{user.pk}": contribution
+            for user, contribution in zip(self.users, contributions)
+        }
+        data.update({"transaction_name": "obiad", "expense": expense, "items": items})
+        return self.client.post(
+            reverse(
+                "rejestrapp:new_itemized_transaction",
+                kwargs={"register_id": self.registerA.pk},
+            ),
+            data=data,
+        )
+
+    def test_items_are_split_among_consumers(self):
+        response = self.post("90", "zupa; 20; A\nstek; 60; B\nchleb; 10", [90, 0, 0])
+        group_transaction = GroupTransaction.objects.get()
+        self.assertRedirects(
+            response,
+            reverse(
+                "rejestrapp:transaction_vote",
+                kwargs={
+                    "register_id": self.registerA.pk,
+                    "group_transaction_id": group_transaction.pk,
+                },
+            ),
+        )
+        amounts = [
+            IndividualsTransaction.objects.get(debt__user=user).amount
+            for user in self.users
+        ]
+        self.assertEqual(amounts, [-6666, 6333, 333])
+        self.assertEqual(sum(amounts), 0)
+
+    def test_prices_must_add_up_to_expense(self):
+        response = self.post("90", "zupa; 20; A", [90, 0, 0])
+        self.assertEqual(response.status_code, 422)
+        response = self.post("90", "zupa; 90; D", [90, 0, 0])
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(GroupTransaction.objects.count(), 0)
+
+
+# the queries are counted on the primary, so the replica isn't used
+@override_settings(DATABASE_REPLICA=None)
+class ViewQueryCountTests(TestCase):
+    """
+    Every count includes the 2 queries for the session and the user,
+    and the single query of check_if_can_be_viewed.
+    """
+
+    def setUp(self):
+        """
+        5 users in 1 register with 1 transaction, logged in as 'A'.
+        """
+        users = ["A", "B", "C", "D", "E"]
+        self.users = [User.objects.create_user(username=u, password=u) for u in users]
+        self.registerA = Register.objects.create(name="registerA", all_accepted=True)
+        self.registerA.users.add(*self.users, through_defaults={"accepted": True})
+        self.group_transaction = GroupTransaction.objects.create(
+            name="transactionA",
+            init_date=timezone.now(),
+            register=self.registerA,
+            member_count=5,
+        )
+        for debt in Debt.objects.filter(register=self.registerA):
+            self.group_transaction.debts.add(debt, through_defaults={"amount": 0})
+        self.client.force_login(self.users[0])
+        register_pages_cache().clear()
+        form_class_cache.clear()
+
+    def get(self, name, **kwargs):
+        return self.client.get(
+            reverse(
+                f"rejestrapp:{name}",
+                kwargs={"register_id": self.registerA.pk, **kwargs},
+            )
+        )
+
+    def test_register(self):
+        # + the transactions and the debts
+        with self.assertNumQueries(5):
+            self.get("register")
+        with self.assertNumQueries(3):
+            self.get("register")
+
+    def test_transaction_vote(self):
+        # + the transaction and its indivs with their debts and users
+        with self.assertNumQueries(5):
+            response = self.get(
+                "transaction_vote", group_transaction_id=self.group_transaction.pk
+            )
+        self.assertEqual(len(response.context["vote_table_rows"]), 5)
+
+    def test_new_transaction(self):
+        # + the members for the form class, which is cached afterwards
+        with self.assertNumQueries(4):
+            self.get("new_transaction")
+        with self.assertNumQueries(3):
+            self.get("new_transaction")
+
+    def test_settle_up(self):
+        # + the usernames and the balances
+        with self.assertNumQueries(5):
+            self.get("settle_up")
+
+    def test_denied_access(self):
+        """
+        An EXISTS query should only be added to tell a missing register
+        from one the user isn't a member of.
+        """
+        outsider = User.objects.create_user(username="F", password="F")
+        self.client.force_login(outsider)
+        with self.assertNumQueries(4):
+            self.assertEqual(self.get("register").status_code, 403)
+        response = self.client.get(
+            reverse("rejestrapp:register", kwargs={"register_id": 9999})
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class SqliteTuningTests(SimpleTestCase):
+    databases = {"default"}
+
+    def test_pragmas_are_applied(self):
+        """
+        Every connection should run the pragmas from the settings
+        and begin its transactions with BEGIN IMMEDIATE.
+        """
+        if connection.vendor != "sqlite":
+            self.skipTest("Only applies to SQLite")
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(
+                cursor.fetchone()[0], int(settings.SQLITE_PRAGMAS["busy_timeout"])
+            )
+            cursor.execute("PRAGMA cache_size")
+            self.assertEqual(
+                cursor.fetchone()[0], int(settings.SQLITE_PRAGMAS["cache_size"])
+            )
+        self.assertEqual(
+            connection.transaction_mode,
+            settings.DATABASES["default"]["OPTIONS"]["transaction_mode"],
+        )
+
+
+@reads_from_replica
+class ReplicaProbeView(View):
+    """
+    Reports where its reads would go.
+    """
+
+    def get(self, request):
+        return JsonResponse(
+            {
+                "transactions": router.db_for_read(GroupTransaction),
+                "sessions": router.db_for_read(Session),
+            }
+        )
+
+    def post(self, request):
+        return JsonResponse({"transactions": router.db_for_read(GroupTransaction)})
+
+
+@override_settings(DATABASE_REPLICA="replica")
+class ReplicaRoutingTests(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.session = self.client.session
+
+    def probe(self, method="get"):
+        request = getattr(self.factory, method)("/")
+        request.session = self.session
+        return json.loads(ReplicaProbeView.as_view()(request).content)
+
+    def test_reads_of_decorated_views_go_to_replica(self):
+        self.assertEqual(
+            self.probe(), {"transactions": "replica", "sessions": "default"}
+        )
+        self.assertEqual(self.probe("post"), {"transactions": "default"})
+        # outside of the view
+        self.assertEqual(router.db_for_read(GroupTransaction), "default")
+
+    def test_writes_go_to_primary(self):
+        self.assertEqual(router.db_for_write(GroupTransaction), "default")
+
+    def test_no_replica_configured(self):
+        with self.settings(DATABASE_REPLICA=None):
+            self.assertEqual(self.probe()["transactions"], "default")
+
+    def test_session_sticks_to_primary_after_writing(self):
+        """
+        After a request of a session wrote something, its reads should
+        go to the primary, but only for REPLICA_STICKINESS_SECONDS.
+        """
+
+        def writing_view(request):
+            Register.objects.create(name="registerA")
+            return HttpResponse()
+
+        request = self.factory.post("/")
+        request.session = self.session
+        request.user = User.objects.create_user(username="A", password="A")
+        ReplicaStickinessMiddleware(writing_view)(request)
+        self.assertEqual(self.probe()["transactions"], "default")
+
+        self.session[STICKY_SESSION_KEY] = time.time() - 1
+        self.assertEqual(self.probe()["transactions"], "replica")
+
+    def test_reading_doesnt_stick(self):
+        def reading_view(request):
+            list(Register.objects.all())
+            return HttpResponse()
+
+        request = self.factory.get("/")
+        request.session = self.session
+        request.user = User.objects.create_user(username="A", password="A")
+        ReplicaStickinessMiddleware(reading_view)(request)
+        self.assertNotIn(STICKY_SESSION_KEY, self.session)
+
+    def test_register_page_is_read_from_replica(self):
+        """
+        A register's page should be read from the replica, which in tests
+        mirrors the primary, and show what was just written to the primary.
+        """
+        user = User.objects.create_user(username="A", password="A")
+        register = Register.objects.create(name="registerA", all_accepted=True)
+        register.users.add(user, through_defaults={"accepted": True})
+        self.client.force_login(user)
+        register_pages_cache().clear()
+        url = reverse("rejestrapp:register", kwargs={"register_id": register.pk})
+
+        with CaptureQueriesContext(connections["default"]) as primary_queries:
+            with CaptureQueriesContext(connections["replica"]) as replica_queries:
+                response = self.client.get(url)
+
+        self.assertContains(response, "registerA")
+        self.assertGreater(len(replica_queries), 0)
+        self.assertFalse(
+            any("rejestrapp_" in query["sql"] for query in primary_queries)
+        )
+
+
+def new_transaction_data(fixture):
+    data = {f"value_for_{user.pk}": "0" for user in fixture.members}
+    data.update(
+        {
+            f"value_for_{fixture.members[0].pk}": "-1.50",
+            f"value_for_{fixture.members[1].pk}": "1.50",
+            "transaction_name": "budget",
+        }
+    )
+    return data
+
+
+def new_easy_transaction_data(fixture):
+    data = {f"value_for_{user.pk}": "0" for user in fixture.members}
+    data.update(
+        {
+            f"value_for_{fixture.member.pk}": "3.01",
+            "transaction_name": "budget",
+            "expense": "3.01",
+        }
+    )
+    return data
+
+
+def new_itemized_transaction_data(fixture):
+    return {
+        **new_easy_transaction_data(fixture),
+        "items": f"pizza; 2.00\nnapój; 1.01; {fixture.members[1].username}",
+    }
+
+
+def transaction_kwargs(fixture):
+    return {
+        "register_id": fixture.register.pk,
+        "group_transaction_id": fixture.transaction.pk,
+    }
+
+
+def invitation_kwargs(fixture):
+    return {"register_id": fixture.invitation.pk}
+
+
+class ViewQueryBudgetTests(QueryBudgetTestCase):
+    """
+    Every count includes the 2 queries for the session and the user.
+    """
+
+    budgets = [
+        ViewBudget("userspace", 3, kwargs=lambda fixture: {}),
+        ViewBudget("register", 5),
+        ViewBudget("settle_up", 5),
+        ViewBudget("import_transactions", 3),
+        ViewBudget("transaction_vote", 5, kwargs=transaction_kwargs),
+        ViewBudget(
+            "transaction_vote",
+            11,
+            "post",
+            kwargs=transaction_kwargs,
+            data=lambda fixture: {"supports": "on"},
+        ),
+        ViewBudget("new_transaction", 4),
+        ViewBudget("new_transaction", 10, "post", data=new_transaction_data),
+        ViewBudget("new_easy_transaction", 4),
+        ViewBudget("new_easy_transaction", 10, "post", data=new_easy_transaction_data),
+        ViewBudget("new_itemized_transaction", 4),
+        ViewBudget(
+            "new_itemized_transaction", 11, "post", data=new_itemized_transaction_data
+        ),
+        ViewBudget("invite", 4, kwargs=invitation_kwargs),
+        ViewBudget("invite_accept", 6, "post", kwargs=invitation_kwargs),
+        ViewBudget("invite_reject", 11, "post", kwargs=invitation_kwargs),
+        ViewBudget("api_registers", 3, kwargs=lambda fixture: {}),
+        ViewBudget("api_register", 5),
+        ViewBudget(
+            "api_transactions",
+            6,
+            data=lambda fixture: {"ids": str(fixture.transaction.pk)},
+        ),
+    ]
+
+    def test_views_within_budget(self):
+        for budget in self.budgets:
+            with self.subTest(str(budget)):
+                self.assertWithinBudget(budget)
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            normalize_sql(
+                "SELECT * FROM t WHERE a = 12 AND b = 'x''y'\n"
+                "  AND c IN (1, 2, 3) LIMIT 21"
+            ),
+            "SELECT * FROM t WHERE a = ? AND b = ? AND c IN (...) LIMIT ?",
+        )
+
+
+class InstrumentationTests(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="A", password="A")
+        self.register = Register.objects.create(name="registerA", all_accepted=True)
+        self.register.users.add(self.user, through_defaults={"accepted": True})
+        self.client.force_login(self.user)
+        register_pages_cache().clear()
+
+    @override_settings(REQUEST_INSTRUMENTATION_SAMPLE_RATE=1.0)
+    def test_sampled_request(self):
+        with self.assertLogs("rejestrapp.instrumentation", "INFO") as logs:
+            response = self.client.get(
+                reverse("rejestrapp:register", kwargs={"register_id": self.register.pk})
+            )
+        self.assertRegex(
+            response["Server-Timing"],
+            r'^db;dur=[0-9.]+;desc="5 queries", tpl;dur=[0-9.]+;desc="1 renders", '
+            r"total;dur=[0-9.]+$",
+        )
+        [line] = logs.records
+        record = json.loads(line.getMessage())
+        self.assertEqual(record["view"], "rejestrapp:register")
+        self.assertEqual(record["status"], 200)
+        self.assertEqual(record["db_queries"], 5)
+        self.assertEqual(record["template_renders"], 1)
+        self.assertGreaterEqual(record["total_ms"], record["db_ms"])
+
+    @override_settings(REQUEST_INSTRUMENTATION_SAMPLE_RATE=0.0)
+    def test_unsampled_request(self):
+        with self.assertNoLogs("rejestrapp.instrumentation"):
+            response = self.client.get(reverse("rejestrapp:userspace"))
+        self.assertNotIn("Server-Timing", response)
+
+    @override_settings(REQUEST_INSTRUMENTATION_SAMPLE_RATE=1.0)
+    def test_other_timings(self):
+        """Time recorded with record_timing only counts within a request."""
+        record_timing("email", 1.0)
+
+        def view(request):
+            record_timing("email", 0.25)
+            record_timing("email", 0.25)
+            return HttpResponse()
+
+        with self.assertLogs("rejestrapp.instrumentation", "INFO") as logs:
+            response = RequestInstrumentationMiddleware(view)(RequestFactory().get("/"))
+        self.assertIn("email;dur=500.0", response["Server-Timing"])
+        self.assertEqual(json.loads(logs.records[0].getMessage())["email_ms"], 500.0)
+
+    @override_settings(REQUEST_INSTRUMENTATION_SAMPLE_RATE=1.0)
+    def test_queries_are_wrapped_once(self):
+        """
+        The metrics and the instrumentation should share the wrapper
+        counting the queries, and both should see the same counts.
+        """
+        wrappers = []
+
+        def view(request):
+            wrappers.append(len(connection.execute_wrappers))
+            list(Register.objects.all())
+            return HttpResponse()
+
+        with self.assertLogs("rejestrapp.instrumentation", "INFO") as logs:
+            MetricsMiddleware(RequestInstrumentationMiddleware(view))(
+                RequestFactory().get("/")
+            )
+        self.assertEqual(wrappers, [1])
+        self.assertEqual(json.loads(logs.records[0].getMessage())["db_queries"], 1)
+
+
+class MetricsTests(TestCase):
+    databases = {"default", "replica"}
+
+    def make_registry(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("test_total", "A counter.", ["kind"])
+        histogram = registry.histogram(
+            "test_seconds", "A histogram.", ["kind"], buckets=(0.1, 1.0)
+        )
+        return registry, counter, histogram
+
+    def test_render(self):
+        registry, counter, histogram = self.make_registry()
+        counter.inc(kind='say "hi"')
+        counter.inc(2, kind='say "hi"')
+        for value in [0.05, 0.5, 0.7, 3]:
+            histogram.observe(value, kind="a")
+        text = render(registry.metrics.values(), registry.collect())
+        self.assertEqual(
+            text.splitlines(),
+            [
+                "# HELP test_total A counter.",
+                "# TYPE test_total counter",
+                'test_total{kind="say \\"hi\\""} 3',
+                "# HELP test_seconds A histogram.",
+                "# TYPE test_seconds histogram",
+                'test_seconds_bucket{kind="a",le="0.1"} 1',
+                'test_seconds_bucket{kind="a",le="1.0"} 3',
+                'test_seconds_bucket{kind="a",le="+Inf"} 4',
+                'test_seconds_sum{kind="a"} 4.25',
+                'test_seconds_count{kind="a"} 4',
+            ],
+        )
+
+    def test_threads(self):
+        registry, counter, histogram = self.make_registry()
+
+        def work():
+            for _ in range(1000):
+                counter.inc(kind="a")
+                histogram.observe(0.5, kind="a")
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        values = registry.collect()
+        self.assertEqual(values["test_total", ("a",)], 8000)
+        self.assertEqual(values["test_seconds", ("a",)][:3], [0, 8000, 0])
+
+    def test_processes(self):
+        """
+        A forked process should count from zero, and the counts of every
+        process that wrote them to METRICS_DIR should be added up.
+        """
+        registry, counter, histogram = self.make_registry()
+        counter.inc(kind="a")
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            METRICS_DIR=directory
+        ):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    counter.inc(2, kind="a")
+                    histogram.observe(0.5, kind="a")
+                    registry.flush()
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            values = registry.collect()
+        self.assertEqual(values["test_total", ("a",)], 3)
+        self.assertEqual(values["test_seconds", ("a",)], [0, 1, 0, 0.5])
+
+    def wait_for_child(self, pid):
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+    def test_collectors_are_flushed(self):
+        """
+        A process that has collectors, like a forked worker, should flush
+        them periodically, even if it never counts anything in the registry.
+        """
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            METRICS_DIR=directory, METRICS_FLUSH_SECONDS=0.01
+        ):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    time.sleep(0.5)
+                    os._exit(0 if metrics_registry._flusher is not None else 1)
+                finally:
+                    os._exit(2)
+            self.wait_for_child(pid)
+            with open(os.path.join(directory, f"{pid}.json")) as file:
+                names = {name for name, labels, value in json.load(file)}
+        self.assertIn(email_api_requests.name, names)
+        self.assertIn(form_class_cache_lookups.name, names)
+
+    def test_sigterm_exits(self):
+        """
+        SIGTERM should raise SystemExit, so that the counts get flushed
+        by atexit, instead of killing the process on the spot.
+        """
+        ready_reader, ready_writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                exit_on_sigterm()
+                os.write(ready_writer, b"!")
+                time.sleep(10)
+                os._exit(1)
+            except SystemExit as exit:
+                os._exit(0 if exit.code == 128 + signal.SIGTERM else 2)
+            finally:
+                os._exit(3)
+        os.read(ready_reader, 1)
+        os.close(ready_reader)
+        os.close(ready_writer)
+        os.kill(pid, signal.SIGTERM)
+        self.wait_for_child(pid)
+
+    def test_forked_process_collects_from_zero(self):
+        """
+        A forked process shouldn't report the counts of the form class cache
+        and of the email client that its parent made before the fork.
+        """
+        self.addCleanup(form_class_cache.clear)
+        form_class_cache.hits += 3
+        get_email_client()._record(0.01, False)
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            METRICS_DIR=directory
+        ):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    metrics_registry.flush()
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            with open(os.path.join(directory, f"{pid}.json")) as file:
+                child = json.load(file)
+        child, parent = [
+            {(name, tuple(labels)): value for name, labels, value in snapshot}
+            for snapshot in [child, metrics_registry.snapshot()]
+        ]
+        hits = (form_class_cache_lookups.name, ("hit",))
+        sent = (email_api_requests.name, ("ok",))
+        self.assertEqual((child[hits], child[sent]), (0, 0))
+        self.assertGreaterEqual(parent[hits], 3)
+        self.assertGreaterEqual(parent[sent], 1)
+
+    def test_access(self):
+        url = reverse("rejestrapp:metrics")
+        self.assertEqual(self.client.get(url, REMOTE_ADDR="127.0.0.1").status_code, 403)
+        with self.settings(METRICS_ALLOWED_ADDRESSES=["127.0.0.1"]):
+            response = self.client.get(url, REMOTE_ADDR="127.0.0.1")
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(
+                url, REMOTE_ADDR="127.0.0.1", HTTP_X_FORWARDED_FOR="10.0.0.1"
+            )
+            self.assertEqual(response.status_code, 403)
+            response = self.client.get(url, REMOTE_ADDR="10.0.0.1")
+            self.assertEqual(response.status_code, 403)
+        self.client.force_login(User.objects.create_user(username="A", password="A"))
+        self.assertEqual(self.client.get(url, REMOTE_ADDR="10.0.0.1").status_code, 403)
+        self.client.force_login(
+            User.objects.create_user(username="S", password="S", is_staff=True)
+        )
+        self.assertEqual(self.client.get(url, REMOTE_ADDR="10.0.0.1").status_code, 200)
+
+    def test_endpoint(self):
+        user = User.objects.create_user(username="A", password="A")
+        register = Register.objects.create(name="registerA", all_accepted=True)
+        register.users.add(user, through_defaults={"accepted": True})
+        enqueue_email("a@example.com", "A", "subject", "html")
+        self.client.force_login(user)
+        self.client.get(
+            reverse("rejestrapp:register", kwargs={"register_id": register.pk})
+        )
+        self.client.generic("BREW", reverse("rejestrapp:userspace"))
+        self.client.logout()
+        with self.settings(METRICS_ALLOWED_ADDRESSES=["127.0.0.1"]):
+            response = self.client.get(reverse("rejestrapp:metrics"))
+        self.assertEqual(response["Content-Type"], METRICS_CONTENT_TYPE)
+        text = response.content.decode()
+        self.assertIn('view="userspace",method="other"', text)
+        self.assertNotIn("BREW", text)
+        self.assertRegex(
+            text,
+            r'rejestrapp_request_duration_seconds_count\{view="register",'
+            r'method="GET",status="2xx"\} [1-9]',
+        )
+        self.assertRegex(text, r'rejestrapp_db_queries_total\{view="register"\} [1-9]')
+        self.assertIn('rejestrapp_outbox_emails{status="pending"} 1\n', text)
+        self.assertIn('rejestrapp_outbox_emails{status="dead"} 0\n', text)
+
+
+def profiled_inner():
+    return sum(range(10000))
+
+
+def profiled_outer():
+    return [profiled_inner() for _ in range(5)]
+
+
+class ProfilerTests(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(PROFILES_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.staff = User.objects.create_user(username="S", password="S", is_staff=True)
+        self.user = User.objects.create_user(username="A", password="A")
+
+    def test_profiled_request(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse("rejestrapp:userspace") + "?profile=1")
+        self.assertEqual(response.status_code, 200)
+        name = response["X-Profile-Id"]
+        self.assertRegex(name, r"^[0-9T]+-userspace-[0-9a-f]+$")
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            sorted(name + suffix for suffix in PROFILE_FILES.values()),
+        )
+        stats = pstats.Stats(os.path.join(self.directory, name + ".prof"))
+        self.assertGreater(stats.total_tt, 0)
+        with open(os.path.join(self.directory, name + ".collapsed")) as file:
+            lines = file.read().splitlines()
+        # the request may have been over before the first sample
+        for line in lines:
+            self.assertRegex(line, r"^[^ ]+( [^ ]+)* [0-9]+$")
+            self.assertNotIn(" ", line.rsplit(" ", 1)[0])
+        [summary] = recent_profiles()
+        self.assertEqual(summary["path"], "/?profile=1")
+        self.assertEqual(summary["user"], "S")
+        self.assertEqual(summary["status"], 200)
+
+        response = self.client.get(reverse("admin_profiles"))
+        self.assertContains(response, "/?profile=1")
+        response = self.client.get(
+            reverse("admin_profile_download", kwargs={"name": name, "kind": "stats"})
+        )
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(
+            reverse("admin_profile_download", kwargs={"name": "..", "kind": "stats"})
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_header_triggers(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse("rejestrapp:userspace"), HTTP_X_PROFILE="1")
+        self.assertIn("X-Profile-Id", response)
+
+    def test_not_profiled(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse("rejestrapp:userspace") + "?page=1")
+        self.assertNotIn("X-Profile-Id", response)
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("rejestrapp:userspace") + "?profile=1")
+        self.assertNotIn("X-Profile-Id", response)
+        self.assertEqual(os.listdir(self.directory), [])
+        response = self.client.get(reverse("admin_profiles"))
+        self.assertEqual(response.status_code, 302)
+
+    def test_old_profiles_removed(self):
+        self.client.force_login(self.staff)
+        with override_settings(PROFILES_KEEP=2):
+            names = [self.client.get("/?profile=1")["X-Profile-Id"] for _ in range(3)]
+        self.assertEqual(len(os.listdir(self.directory)), 2 * len(PROFILE_FILES))
+        self.assertEqual(
+            {summary["name"] for summary in recent_profiles()},
+            set(sorted(names)[1:]),
+        )
+
+    def test_disabled(self):
+        with override_settings(PROFILES_DIR=None):
+            with self.assertRaises(MiddlewareNotUsed):
+                ProfilerMiddleware(lambda request: HttpResponse())
+
+    def test_stack_sampler(self):
+        with StackSampler(threading.get_ident(), 0.001) as sampler:
+            deadline = time.perf_counter() + 0.2
+            while time.perf_counter() < deadline:
+                _profiled_request(lambda request: profiled_outer(), None)
+        self.assertTrue(sampler.stacks)
+        for stack in sampler.stacks:
+            self.assertRegex(stack, r"^profiling\.py:[0-9]+\(_profiled_request\);")
+        self.assertTrue(
+            any(
+                re.search(r"\(profiled_outer\);.*\(profiled_inner\)$", stack)
+                for stack in sampler.stacks
+            )
+        )
@@ -1,7 +1,7 @@
 from django.contrib.auth.views import LogoutView
 from django.urls import path
 
-from . import views
+from . import api, metrics, views
 
 app_name = "rejestrapp"
 urlpatterns = [
@@ -25,6 +25,21 @@ urlpatterns = [
     ),
     path("new-register/", views.NewRegisterView.as_view(), name="new_register"),
     path("register/<int:register_id>/", views.RegisterView.as_view(), name="register"),
+    path(
+        "register/<int:register_id>/settle-up/",
+        views.SettleUpView.as_view(),
+        name="settle_up",
+    ),
+    path(
+        "register/<int:register_id>/export/",
+        views.ExportTransactionsView.as_view(),
+        name="export_transactions",
+    ),
+    path(
+        "register/<int:register_id>/import/",
+        views.ImportTransactionsView.as_view(),
+        name="import_transactions",
+    ),
     path(
         "register/<int:register_id>/new-transaction/",
         views.NewTransactionView.as_view(),
@@ -35,11 +50,33 @@ urlpatterns = [
         views.NewEasyTransactionView.as_view(),
         name="new_easy_transaction",
     ),
+    path(
+        "register/<int:register_id>/new-itemized-transaction/",
+        views.NewItemizedTransactionView.as_view(),
+        name="new_itemized_transaction",
+    ),
     path(
         "register/<int:register_id>/transaction/<int:group_transaction_id>/",
         views.TransactionVoteView.as_view(),
         name="transaction_vote",
     ),
+    path("api/registers/", api.ApiRegistersView.as_view(), name="api_registers"),
+    path(
+        "api/registers/<int:register_id>/",
+        api.ApiRegisterView.as_view(),
+        name="api_register",
+    ),
+    path(
+        "api/registers/<int:register_id>/transactions/",
+        api.ApiTransactionsView.as_view(),
+        name="api_transactions",
+    ),
+    path(
+        "api/registers/<int:register_id>/votes/",
+        api.ApiVotesView.as_view(),
+        name="api_votes",
+    ),
+    path("metrics/", metrics.MetricsView.as_view(), name="metrics"),
     path("invite/<int:register_id>/", views.InviteView.as_view(), name="invite"),
     path(
         "invite/<int:register_id>/accept/",
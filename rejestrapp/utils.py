@@ -1,14 +1,21 @@
+import decimal
 import hashlib
 import typing
 from django import forms
 from django.contrib.auth.models import User
+from django.db.models import Q
 from django.db.models.query import QuerySet
-from django.http import HttpRequest, HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpRequest, HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
+from django.utils import timezone
 from .errors import BadGroszeException
-from .forms import NewEasyTransactionFormBase, NewTransactionFormBase
-from .models import Debt, Register, SignupToken
+from .forms import (
+    NewEasyTransactionFormBase,
+    NewItemizedTransactionFormBase,
+    NewTransactionFormBase,
+)
+from .models import Debt, GroupTransaction, Register, SignupToken
 
 
 def gr_to_zl(gr: int) -> str:
@@ -33,6 +40,23 @@ def gr_to_zl(gr: int) -> str:
         return "0.00"
 
 
+# the largest amount, in grosze, that fits in the IntegerFields storing them
+MAX_GROSZE = 2**31 - 1
+
+
+def zl_to_gr(zl: str) -> int:
+    """Convert an amount in zloty written like "-12.5" to grosze."""
+    try:
+        gr = decimal.Decimal(zl.strip()) * 100
+    except (decimal.InvalidOperation, AttributeError):
+        raise BadGroszeException(f"{zl!r} is not an amount of money")
+    if not gr.is_finite() or gr != gr.to_integral_value():
+        raise BadGroszeException(f"{zl!r} is not a whole number of grosze")
+    if abs(gr) > MAX_GROSZE:
+        raise BadGroszeException(f"{zl!r} is too large an amount")
+    return int(gr)
+
+
 def dont_be_logged_in(cls):
     cls._dont_be_logged_in__original_dispatch = cls.dispatch
 
@@ -58,47 +82,185 @@ def render_error_page(
     )
 
 
-def generate_new_transaction_form_class(new_transaction_users: QuerySet[User]) -> type:
+def _generate_form_class(
+    name: str,
+    base: type,
+    new_transaction_users: QuerySet[User],
+    label: str,
+    **field_options,
+) -> type:
+    """
+    A subclass of base with a FloatField for every user, labelled with label
+    formatted with their username, on top of the fields base already has.
+    """
     fields = {
         f"value_for_{new_transaction_user.pk}": forms.FloatField(
-            label=f"Wartość dla {new_transaction_user.username}",
+            label=label.format(new_transaction_user.username),
             step_size=0.01,
             required=True,
+            **field_options,
         )
         for new_transaction_user in new_transaction_users
     }
 
-    return type("NewTransactionForm", (NewTransactionFormBase,), fields)
+    return type(name, (base,), fields)
+
+
+def generate_new_transaction_form_class(new_transaction_users: QuerySet[User]) -> type:
+    return _generate_form_class(
+        "NewTransactionForm",
+        NewTransactionFormBase,
+        new_transaction_users,
+        "Wartość dla {}",
+    )
 
 
 def generate_new_easy_transaction_form_class(
     new_transaction_users: QuerySet[User],
 ) -> type:
-    fields = {
-        f"value_for_{new_transaction_user.pk}": forms.FloatField(
-            label=f"Ile dołożył {new_transaction_user.username}",
-            min_value=0.0,
-            step_size=0.01,
-            required=True,
+    return _generate_form_class(
+        "NewEasyTransactionForm",
+        NewEasyTransactionFormBase,
+        new_transaction_users,
+        "Ile dołożył {}",
+        min_value=0.0,
+    )
+
+
+def generate_new_itemized_transaction_form_class(
+    new_transaction_users: QuerySet[User],
+) -> type:
+    return _generate_form_class(
+        "NewItemizedTransactionForm",
+        NewItemizedTransactionFormBase,
+        new_transaction_users,
+        "Ile dołożył {}",
+        min_value=0.0,
+    )
+
+
+def parse_cursor(value: typing.Optional[str]) -> typing.Optional[int]:
+    if value is None or not value.isdigit():
+        return None
+    return int(value)
+
+
+# the order of a register's transaction history: pending ones first,
+# then the most recently settled ones, with the primary key as a tiebreaker
+TRANSACTION_HISTORY_ORDERING = ("is_settled", "-settle_date", "-init_date", "-pk")
+
+
+def _older_than(boundary: GroupTransaction) -> Q:
+    """Transactions placed after boundary in TRANSACTION_HISTORY_ORDERING."""
+    initiated_earlier = Q(init_date__lt=boundary.init_date) | Q(
+        init_date=boundary.init_date, pk__lt=boundary.pk
+    )
+    if not boundary.is_settled:
+        return Q(is_settled=True) | (Q(is_settled=False) & initiated_earlier)
+    return Q(is_settled=True) & (
+        Q(settle_date__lt=boundary.settle_date)
+        | (Q(settle_date=boundary.settle_date) & initiated_earlier)
+    )
+
+
+def _newer_than(boundary: GroupTransaction) -> Q:
+    """Transactions placed before boundary in TRANSACTION_HISTORY_ORDERING."""
+    initiated_later = Q(init_date__gt=boundary.init_date) | Q(
+        init_date=boundary.init_date, pk__gt=boundary.pk
+    )
+    if not boundary.is_settled:
+        return Q(is_settled=False) & initiated_later
+    return Q(is_settled=False) | (
+        Q(is_settled=True)
+        & (
+            Q(settle_date__gt=boundary.settle_date)
+            | (Q(settle_date=boundary.settle_date) & initiated_later)
         )
-        for new_transaction_user in new_transaction_users
-    }
+    )
+
 
-    return type("NewEasyTransactionForm", (NewEasyTransactionFormBase,), fields)
+def transaction_history_page(
+    transactions: QuerySet[GroupTransaction],
+    after: typing.Optional[int],
+    before: typing.Optional[int],
+    page_size: int,
+) -> typing.Tuple[
+    typing.List[GroupTransaction], typing.Optional[int], typing.Optional[int]
+]:
+    """
+    Keyset pagination over TRANSACTION_HISTORY_ORDERING. The cursors are
+    primary keys of the transactions at the edges of the neighbouring pages,
+    so fetching a page costs the same no matter how deep into the history it is.
+    Returns the page along with the cursors to the older and the newer page
+    (None when there is no such page).
+    """
+    boundary = None
+    if before is not None:
+        boundary = transactions.filter(pk=before).first()
+    elif after is not None:
+        boundary = transactions.filter(pk=after).first()
+    if boundary is None:
+        page = list(
+            transactions.order_by(*TRANSACTION_HISTORY_ORDERING)[: page_size + 1]
+        )
+        older = page[page_size - 1].pk if len(page) > page_size else None
+        return page[:page_size], older, None
+    if before is not None:
+        reversed_ordering = [
+            field[1:] if field.startswith("-") else "-" + field
+            for field in TRANSACTION_HISTORY_ORDERING
+        ]
+        page = list(
+            transactions.filter(_newer_than(boundary)).order_by(*reversed_ordering)[
+                : page_size + 1
+            ]
+        )
+        has_newer = len(page) > page_size
+        page = page[:page_size][::-1]
+        if not page:
+            return page, None, None
+        return page, page[-1].pk, page[0].pk if has_newer else None
+    page = list(
+        transactions.filter(_older_than(boundary)).order_by(
+            *TRANSACTION_HISTORY_ORDERING
+        )[: page_size + 1]
+    )
+    has_older = len(page) > page_size
+    page = page[:page_size]
+    if not page:
+        return page, None, None
+    return page, page[-1].pk if has_older else None, page[0].pk
+
+
+def get_membership(
+    register_id: int, user_id: typing.Optional[int]
+) -> typing.Optional[Debt]:
+    """
+    The debt of a user in a register, with the register itself
+    selected along with it, in a single query.
+    """
+    return (
+        Debt.objects.select_related("register")
+        .filter(register=register_id, user=user_id)
+        .first()
+    )
 
 
 def check_if_can_be_viewed(cls):
     cls._check_if_can_be_viewed__original_dispatch = cls.dispatch
 
     def new_dispatch(self, request, *args, **kwargs):
-        register = get_object_or_404(Register, pk=kwargs["register_id"])
-        if register.users.filter(pk=request.user.pk).count() != 1:
+        debt = get_membership(kwargs["register_id"], request.user.pk)
+        if debt is None:
+            if not Register.objects.filter(pk=kwargs["register_id"]).exists():
+                raise Http404("No Register matches the given query.")
             return render_error_page(
                 request,
                 "Nie jesteś członkiem tego rejestru",
                 403,
                 reverse("rejestrapp:userspace"),
             )
+        register = debt.register
 
         if not register.all_accepted:
             return render_error_page(
@@ -109,7 +271,12 @@ def check_if_can_be_viewed(cls):
                 reverse("rejestrapp:userspace"),
             )
 
-        kwargs.update({"check_if_can_be_viewed__register": register})
+        kwargs.update(
+            {
+                "check_if_can_be_viewed__register": register,
+                "check_if_can_be_viewed__debt": debt,
+            }
+        )
 
         return cls._check_if_can_be_viewed__original_dispatch(
             self, request, *args, **kwargs
@@ -179,7 +346,9 @@ def account_activation_link_validation(func):
                     break
         if token_well_formed:
             hashed_form_token = hashlib.sha256(bytes(url_token, "utf-8")).hexdigest()
-            token_query = SignupToken.objects.filter(pk=hashed_form_token)
+            token_query = SignupToken.objects.filter(
+                pk=hashed_form_token, expires_at__gt=timezone.now()
+            )
             if token_query.count() == 0:
                 return render_error_page(
                     request,
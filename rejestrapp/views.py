@@ -1,48 +1,72 @@
 import datetime
 import hashlib
+import io
 import random
 import secrets
-import requests
 import typing
-from django.conf import settings
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.contrib.auth.views import LoginView
-from django.db.models import F
+from django.db.models import Count, Q
 from django.forms import formset_factory
-from django.http import HttpRequest, HttpResponseRedirect
+from django.http import HttpRequest, HttpResponseRedirect, StreamingHttpResponse
 from django.template import loader
 from django.urls import reverse, reverse_lazy
-from django.utils import timezone
 from django.views.generic import CreateView, View
 from django.shortcuts import get_object_or_404, redirect, render
+from .caching import (
+    deferred_membership_bumps,
+    load_register_page,
+    new_easy_transaction_form_class,
+    new_itemized_transaction_form_class,
+    new_transaction_form_class,
+)
+from .cronjobs import delete_expired_signup
+from .emails import enqueue_email
+from .errors import (
+    ImportFormatException,
+    ItemsFormatException,
+    StalePlanException,
+    VoteConflictException,
+)
+from .exporting import EXPORT_FORMATS, export_rows
 from .forms import (
+    ImportTransactionsForm,
     NewRegisterNameForm,
     RequiredFormSet,
     TransactionVoteForm,
     UserCreationFormWithEmail,
     UserToNewRegisterForm,
 )
+from .importing import (
+    ROW_READERS,
+    create_transactions,
+    import_transactions,
+    rewinding,
+)
+from .itemized import parse_items, split_items
 from .models import (
     Debt,
     GroupTransaction,
-    IndividualsTransaction,
     Register,
     SignupToken,
 )
+from .routing import reads_from_replica
+from .settle_up import plan_transfers, register_balances, settle_up
+from .settlement import VOTE_ALREADY_SETTLED, VOTE_DELETED, cast_vote
 from .utils import (
     account_activation_link_validation,
     check_for_errors_in_invite_view,
     check_if_can_be_viewed,
     dont_be_logged_in,
-    generate_new_easy_transaction_form_class,
-    generate_new_transaction_form_class,
     gr_to_zl,
+    parse_cursor,
     render_error_page,
 )
 
 
+@reads_from_replica
 class UserspaceView(View):
     """
     This is a user's 'main menu'. Here they have a list of their registers
@@ -57,21 +81,29 @@ class UserspaceView(View):
         accepted_registers = []
         accepted_invites = []
         not_accepted_invites = []
-        for register in Register.objects.filter(users=request.user).order_by("name"):
+        # one row per register of this user, along with how many of its
+        # members have accepted their invitations
+        users_debts = (
+            Debt.objects.filter(user=request.user.pk)
+            .select_related("register")
+            .annotate(
+                accepted_count=Count(
+                    "register__debt", filter=Q(register__debt__accepted=True)
+                ),
+                member_count=Count("register__debt"),
+            )
+            .order_by("register__name")
+        )
+        for debt in users_debts:
+            register = debt.register
             if register.all_accepted:
                 accepted_registers.append(register)
+            elif debt.accepted:
+                accepted_invites.append(
+                    (register, debt.accepted_count, debt.member_count)
+                )
             else:
-                debt_set = register.debt_set
-                if debt_set.get(user=request.user.pk).accepted:
-                    accepted_invites.append(
-                        (
-                            register,
-                            debt_set.filter(accepted=True).count(),
-                            debt_set.count(),
-                        )
-                    )
-                else:
-                    not_accepted_invites.append(register)
+                not_accepted_invites.append(register)
         return render(
             request,
             "rejestrapp/userspace.html",
@@ -107,6 +139,9 @@ class SignUpView(CreateView):
 
     def post(self, request, *args, **kwargs):
         self.object = None
+        delete_expired_signup(
+            request.POST.get("username", ""), request.POST.get("email", "")
+        )
         form = self.get_form()
         if form.is_valid():
             email = form.cleaned_data["email"].lower()
@@ -128,42 +163,18 @@ class SignUpView(CreateView):
             token = secrets.token_hex(32)
             hashed_token = hashlib.sha256(bytes(token, "utf-8")).hexdigest()
             SignupToken.objects.create(pk=hashed_token, email=email)
-            email_api_req_headers = {
-                "Content-Type": "application/json",
-                "X-Requested-With": "XMLHttpRequest",
-                "User-Agent": "RejestrSkladek",
-                "Authorization": f"Bearer {settings.EMAIL_API_KEY}",
-            }
             message_template = loader.get_template("rejestrapp/activation_email.html")
             message_html = message_template.render(
                 {"nazwa": new_user.username, "token": token}, request
             )
-            email_api_message = {
-                "from": {
-                    "email": settings.EMAIL_API_EMAIL_ADDRESS,
-                    "name": "Rejestr Składek",
-                },
-                "to": [
-                    {
-                        "email": email,
-                        "name": new_user.username,
-                    }
-                ],
-                "subject": "Dokończ tworzenie konta w Rejestrze Składek",
-                "html": message_html,
-            }
-            email_api_response = requests.post(
-                "https://api.mailersend.com/v1/email",
-                headers=email_api_req_headers,
-                json=email_api_message,
+            # sent by the send_emails command, so that a slow or unavailable
+            # email provider doesn't hold up or break signing up
+            enqueue_email(
+                email,
+                new_user.username,
+                "Dokończ tworzenie konta w Rejestrze Składek",
+                message_html,
             )
-            if not email_api_response.ok:
-                return render_error_page(
-                    request,
-                    "Nie udało się dotrzeć do podanego adresu e-mail",
-                    400,
-                    reverse("rejestrapp:signup"),
-                )
 
             return render(
                 request,
@@ -205,6 +216,7 @@ class AccountActivationCancelView(View):
         return HttpResponseRedirect(reverse("rejestrapp:signup"))
 
 
+@reads_from_replica
 @check_if_can_be_viewed
 class RegisterView(LoginRequiredMixin, View):
     """
@@ -212,30 +224,167 @@ class RegisterView(LoginRequiredMixin, View):
     """
 
     http_method_names = ["get", "options"]
+    transactions_per_page = 20
 
     def get(self, request: HttpRequest, *args, **kwargs):
         register = kwargs["check_if_can_be_viewed__register"]
-        debts_for_display = []
-        for debt in register.debt_set.all().order_by("user__username"):
-            debts_for_display.append(
-                {"name": debt.user.username, "balance": gr_to_zl(debt.balance)}
-            )
+        page = load_register_page(
+            register,
+            parse_cursor(request.GET.get("after")),
+            parse_cursor(request.GET.get("before")),
+            self.transactions_per_page,
+        )
         return render(
             request,
             "rejestrapp/register.html",
             {
-                "debts": debts_for_display,
+                **page,
                 "register": register,
-                "transactions": GroupTransaction.objects.filter(
-                    debts__register__pk=register.pk
-                )
-                .distinct()
-                .order_by("is_settled", "-settle_date", "-init_date"),
                 "back": reverse("rejestrapp:userspace"),
             },
         )
 
 
+@reads_from_replica
+@check_if_can_be_viewed
+class SettleUpView(LoginRequiredMixin, View):
+    """
+    View for planning how members should pay each other to bring
+    every balance in a register back to zero. When accessed by GET,
+    it displays the planned payments. When POSTed to, it records every
+    payment as a transaction to be confirmed by its payer and payee.
+    """
+
+    http_method_names = ["get", "post", "options"]
+
+    def plan(self, register):
+        usernames = dict(register.users.values_list("pk", "username"))
+        return plan_transfers(register_balances(register)), usernames
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        register = kwargs["check_if_can_be_viewed__register"]
+        transfers, usernames = self.plan(register)
+        return render(
+            request,
+            "rejestrapp/settle_up.html",
+            {
+                "register": register,
+                "version": register.version,
+                "transfers": [
+                    {
+                        "payer": usernames[transfer.payer],
+                        "payee": usernames[transfer.payee],
+                        "amount": gr_to_zl(transfer.amount),
+                    }
+                    for transfer in transfers
+                ],
+                "back": reverse(
+                    "rejestrapp:register", kwargs={"register_id": register.pk}
+                ),
+            },
+        )
+
+    def post(self, request: HttpRequest, *args, **kwargs):
+        register = kwargs["check_if_can_be_viewed__register"]
+        try:
+            settle_up(register, int(request.POST.get("version", "")))
+        except (ValueError, StalePlanException):
+            return render_error_page(
+                request,
+                "Stan rejestru zmienił się od wyświetlenia przelewów "
+                "albo zostały one już zapisane. Sprawdź je jeszcze raz.",
+                409,
+                reverse("rejestrapp:settle_up", kwargs={"register_id": register.pk}),
+            )
+        return redirect(
+            reverse("rejestrapp:register", kwargs={"register_id": register.pk})
+        )
+
+
+@check_if_can_be_viewed
+class ExportTransactionsView(LoginRequiredMixin, View):
+    """
+    View for downloading the whole history of a register, with every
+    member's amount and balance before each transaction, as a CSV
+    or JSON lines file. The file is streamed while it's being read
+    from the database.
+    """
+
+    http_method_names = ["get", "options"]
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        register = kwargs["check_if_can_be_viewed__register"]
+        file_format = request.GET.get("format", "csv")
+        if file_format not in EXPORT_FORMATS:
+            return render_error_page(
+                request,
+                "Nieznany format pliku",
+                400,
+                reverse("rejestrapp:register", kwargs={"register_id": register.pk}),
+            )
+        to_lines, content_type = EXPORT_FORMATS[file_format]
+        response = StreamingHttpResponse(
+            to_lines(export_rows(register)), content_type=content_type
+        )
+        response["Content-Disposition"] = (
+            f'attachment; filename="rejestr-{register.pk}.{file_format}"'
+        )
+        return response
+
+
+@check_if_can_be_viewed
+class ImportTransactionsView(LoginRequiredMixin, View):
+    """
+    View for importing many transactions at once from a CSV or JSON lines
+    file, e.g. a spreadsheet from a trip. The file is read line by line,
+    once to check it and once to import it, and every valid line becomes
+    a pending transaction.
+    """
+
+    http_method_names = ["get", "post", "options"]
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        register = kwargs["check_if_can_be_viewed__register"]
+        return self.render_page(request, register, ImportTransactionsForm(), None)
+
+    def post(self, request: HttpRequest, *args, **kwargs):
+        register = kwargs["check_if_can_be_viewed__register"]
+        form = ImportTransactionsForm(request.POST, request.FILES)
+        if not form.is_valid():
+            return self.render_page(request, register, form, None)
+        lines = io.TextIOWrapper(
+            form.cleaned_data["file"].file, encoding="utf-8", newline=""
+        )
+        read_rows = ROW_READERS[form.cleaned_data["file_format"]]
+        try:
+            report = import_transactions(register, rewinding(read_rows, lines))
+        except (ImportFormatException, UnicodeDecodeError):
+            return render_error_page(
+                request,
+                "Nie udało się odczytać pliku",
+                422,
+                reverse(
+                    "rejestrapp:import_transactions",
+                    kwargs={"register_id": register.pk},
+                ),
+            )
+        return self.render_page(request, register, ImportTransactionsForm(), report)
+
+    def render_page(self, request, register, form, report):
+        return render(
+            request,
+            "rejestrapp/import_transactions.html",
+            {
+                "register": register,
+                "form": form,
+                "report": report,
+                "back": reverse(
+                    "rejestrapp:register", kwargs={"register_id": register.pk}
+                ),
+            },
+        )
+
+
 @check_if_can_be_viewed
 class NewTransactionView(LoginRequiredMixin, View):
     """
@@ -250,9 +399,7 @@ class NewTransactionView(LoginRequiredMixin, View):
 
     def get(self, request: HttpRequest, *args, **kwargs):
         register = kwargs["check_if_can_be_viewed__register"]
-        form_class = generate_new_transaction_form_class(
-            register.users.all().order_by("username")
-        )
+        form_class = new_transaction_form_class(register)
         form = form_class()
 
         return render(
@@ -269,9 +416,7 @@ class NewTransactionView(LoginRequiredMixin, View):
 
     def post(self, request: HttpRequest, *args, **kwargs):
         register = kwargs["check_if_can_be_viewed__register"]
-        form_class = generate_new_transaction_form_class(
-            register.users.all().order_by("username")
-        )
+        form_class = new_transaction_form_class(register)
         form = form_class(request.POST)
 
         if form.is_valid():
@@ -290,18 +435,24 @@ class NewTransactionView(LoginRequiredMixin, View):
                         kwargs={"register_id": register.pk},
                     ),
                 )
-            group_transaction = GroupTransaction.objects.create(
-                name=form.cleaned_data["transaction_name"], init_date=timezone.now()
+            debt_ids = dict(
+                Debt.objects.filter(register=register).values_list("user_id", "pk")
+            )
+            [group_transaction] = create_transactions(
+                register,
+                [
+                    (
+                        form.cleaned_data["transaction_name"],
+                        {
+                            debt_id: round(
+                                form.cleaned_data[f"value_for_{user_id}"] * 100
+                            )
+                            for user_id, debt_id in debt_ids.items()
+                        },
+                    )
+                ],
+                debt_ids.values(),
             )
-            for debt in Debt.objects.filter(register=register):
-                group_transaction.debts.add(
-                    debt,
-                    through_defaults={
-                        "amount": round(
-                            form.cleaned_data[f"value_for_{debt.user.pk}"] * 100
-                        )
-                    },
-                )
             return redirect(
                 reverse(
                     "rejestrapp:transaction_vote",
@@ -340,9 +491,7 @@ class NewEasyTransactionView(LoginRequiredMixin, View):
 
     def get(self, request: HttpRequest, *args, **kwargs):
         register = kwargs["check_if_can_be_viewed__register"]
-        form_class = generate_new_easy_transaction_form_class(
-            register.users.all().order_by("username")
-        )
+        form_class = new_easy_transaction_form_class(register)
         form = form_class()
 
         return render(
@@ -359,9 +508,7 @@ class NewEasyTransactionView(LoginRequiredMixin, View):
 
     def post(self, request: HttpRequest, *args, **kwargs):
         register = kwargs["check_if_can_be_viewed__register"]
-        form_class = generate_new_easy_transaction_form_class(
-            register.users.all().order_by("username")
-        )
+        form_class = new_easy_transaction_form_class(register)
         form = form_class(request.POST)
 
         if form.is_valid():
@@ -377,12 +524,12 @@ class NewEasyTransactionView(LoginRequiredMixin, View):
                         kwargs={"register_id": register.pk},
                     ),
                 )
-            # a list with tuples (user_id, their_contribution)
-            users_with_contributions = []
+            # every user's contribution, keyed by their id
+            contributions = {}
             for k, v in form.cleaned_data.items():
                 if k.startswith("value_for_"):
                     value = round(v * 100)
-                    users_with_contributions.append((int(k[10:]), value))
+                    contributions[int(k[10:])] = value
                     sum += value
             if sum != expense:
                 return render_error_page(
@@ -395,31 +542,26 @@ class NewEasyTransactionView(LoginRequiredMixin, View):
                     ),
                 )
             # convert to values with which to update users' balances
-            users_with_changes = []
-            divided_expense = expense // len(users_with_contributions)
-            for u, c in users_with_contributions:
-                users_with_changes.append([u, divided_expense - c])
+            divided_expense = expense // len(contributions)
+            changes = {u: divided_expense - c for u, c in contributions.items()}
             # randomly add the grosze that were left out after the division
-            leftover = expense - divided_expense * len(users_with_contributions)
-            who_to_charge = random.sample(users_with_changes, leftover)
-            for charged in who_to_charge:
-                charged[1] += 1
+            leftover = expense - divided_expense * len(contributions)
+            for charged in random.sample(list(changes), leftover):
+                changes[charged] += 1
 
-            group_transaction = GroupTransaction.objects.create(
-                name=form.cleaned_data["transaction_name"], init_date=timezone.now()
+            debt_ids = dict(
+                Debt.objects.filter(register=register).values_list("user_id", "pk")
+            )
+            [group_transaction] = create_transactions(
+                register,
+                [
+                    (
+                        form.cleaned_data["transaction_name"],
+                        {debt_ids[u]: change for u, change in changes.items()},
+                    )
+                ],
+                debt_ids.values(),
             )
-            for debt in Debt.objects.filter(register=register):
-                group_transaction.debts.add(
-                    debt,
-                    through_defaults={
-                        # set the amount for the user of this debt
-                        # to the value that corresponds to them
-                        # in the users_with_changes list
-                        "amount": next(
-                            uc for uc in users_with_changes if uc[0] == debt.user.pk
-                        )[1]
-                    },
-                )
             return redirect(
                 reverse(
                     "rejestrapp:transaction_vote",
@@ -431,6 +573,97 @@ class NewEasyTransactionView(LoginRequiredMixin, View):
             )
 
 
+@check_if_can_be_viewed
+class NewItemizedTransactionView(LoginRequiredMixin, View):
+    """
+    View for initiating and processing itemized transactions, where
+    members pay for what they consumed. When accessed by GET, it displays
+    a form for the expense, a list of items and a field for every user's
+    contribution. When POSTed to, it checks whether both the contributions
+    and the prices of the items add up to the expense and creates
+    a new GroupTransaction object if they do. Every item's price is split
+    evenly among those who consumed it.
+    """
+
+    http_method_names = ["get", "post", "options"]
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        register = kwargs["check_if_can_be_viewed__register"]
+        form_class = new_itemized_transaction_form_class(register)
+        form = form_class()
+
+        return render(
+            request,
+            "rejestrapp/new_itemized_transaction.html",
+            {
+                "register": register,
+                "form": form,
+                "back": reverse(
+                    "rejestrapp:register", kwargs={"register_id": register.pk}
+                ),
+            },
+        )
+
+    def post(self, request: HttpRequest, *args, **kwargs):
+        register = kwargs["check_if_can_be_viewed__register"]
+        form_class = new_itemized_transaction_form_class(register)
+        form = form_class(request.POST)
+        back = reverse(
+            "rejestrapp:new_itemized_transaction", kwargs={"register_id": register.pk}
+        )
+
+        if not form.is_valid():
+            return render_error_page(
+                request, "Coś się nie zgadzało w Twoim zapytaniu", 400, back
+            )
+        expense = round(form.cleaned_data["expense"] * 100)
+        contributions = {
+            int(k[10:]): round(v * 100)
+            for k, v in form.cleaned_data.items()
+            if k.startswith("value_for_")
+        }
+        if sum(contributions.values()) != expense:
+            return render_error_page(
+                request, "Suma podanych dołożeń nie równa się wydatkowi", 422, back
+            )
+        try:
+            items = parse_items(
+                form.cleaned_data["items"],
+                dict(register.users.values_list("username", "pk")),
+            )
+        except ItemsFormatException as error:
+            return render_error_page(request, str(error), 422, back)
+        if sum(item.price for item in items) != expense:
+            return render_error_page(
+                request, "Suma cen pozycji nie równa się wydatkowi", 422, back
+            )
+
+        changes = split_items(items, contributions)
+        debt_ids = dict(
+            Debt.objects.filter(register=register).values_list("user_id", "pk")
+        )
+        [group_transaction] = create_transactions(
+            register,
+            [
+                (
+                    form.cleaned_data["transaction_name"],
+                    {debt_ids[u]: change for u, change in changes.items()},
+                )
+            ],
+            debt_ids.values(),
+        )
+        return redirect(
+            reverse(
+                "rejestrapp:transaction_vote",
+                kwargs={
+                    "register_id": kwargs["register_id"],
+                    "group_transaction_id": group_transaction.pk,
+                },
+            )
+        )
+
+
+@reads_from_replica
 @check_if_can_be_viewed
 class TransactionVoteView(LoginRequiredMixin, View):
     """
@@ -444,15 +677,19 @@ class TransactionVoteView(LoginRequiredMixin, View):
 
     def get(self, request: HttpRequest, *args, **kwargs):
         group_transaction = get_object_or_404(
-            GroupTransaction, pk=kwargs["group_transaction_id"]
+            GroupTransaction,
+            pk=kwargs["group_transaction_id"],
+            register=kwargs["check_if_can_be_viewed__register"],
         )
         vote_table_rows = []
         supports = False
         wants_remove = False
-        for indiv in group_transaction.individualstransaction_set.all().order_by(
-            "debt__user__username"
+        for indiv in (
+            group_transaction.individualstransaction_set.all()
+            .select_related("debt__user")
+            .order_by("debt__user__username")
         ):
-            if indiv.debt.user == request.user:
+            if indiv.debt_id == kwargs["check_if_can_be_viewed__debt"].pk:
                 supports = indiv.supports
                 wants_remove = indiv.wants_remove
 
@@ -491,58 +728,39 @@ class TransactionVoteView(LoginRequiredMixin, View):
 
     def post(self, request: HttpRequest, *args, **kwargs):
         group_transaction = get_object_or_404(
-            GroupTransaction, pk=kwargs["group_transaction_id"]
+            GroupTransaction,
+            pk=kwargs["group_transaction_id"],
+            register=kwargs["check_if_can_be_viewed__register"],
         )
         if group_transaction.is_settled:
-            return render_error_page(
-                request,
-                "Ta transakcja została już zatwierdzona, nie można zmienić zgód",
-                403,
-                reverse(
-                    "rejestrapp:new_transaction",
-                    kwargs={"register_id": kwargs["register_id"]},
-                ),
-            )
+            return self.already_settled_error(request, kwargs["register_id"])
         form = TransactionVoteForm(request.POST)
         if form.is_valid():
-            this_indiv = get_object_or_404(
-                IndividualsTransaction,
-                group_transaction=group_transaction,
-                debt__user=request.user,
-            )
-            this_indiv.supports = form.cleaned_data["supports"]
-            this_indiv.wants_remove = form.cleaned_data["wants_remove"]
-            this_indiv.save()
-            all_want_remove = True
-            all_support = True
-            all_indivs = IndividualsTransaction.objects.filter(
-                group_transaction=group_transaction
-            )
-            for indiv in all_indivs:
-                if not indiv.supports:
-                    all_support = False
-                if not indiv.wants_remove:
-                    all_want_remove = False
-
-            if all_want_remove:
-                all_indivs.delete()
-                group_transaction.delete()
+            try:
+                vote_result = cast_vote(
+                    kwargs["check_if_can_be_viewed__register"],
+                    group_transaction.pk,
+                    request.user,
+                    form.cleaned_data["supports"],
+                    form.cleaned_data["wants_remove"],
+                )
+            except VoteConflictException:
+                return render_error_page(
+                    request,
+                    "Zbyt wiele osób głosuje teraz naraz, spróbuj ponownie za chwilę",
+                    409,
+                    request.path,
+                )
+            if vote_result.outcome == VOTE_ALREADY_SETTLED:
+                # someone else's vote settled it after the check above
+                return self.already_settled_error(request, kwargs["register_id"])
+            elif vote_result.outcome == VOTE_DELETED:
                 return redirect(
                     reverse(
                         "rejestrapp:register",
                         kwargs={"register_id": kwargs["register_id"]},
                     )
                 )
-            elif all_support:
-                group_transaction.is_settled = True
-                group_transaction.settle_date = timezone.now()
-                group_transaction.save()
-                for indiv in all_indivs:
-                    debt = Debt.objects.get(pk=indiv.debt.pk)
-                    indiv.balance_before = debt.balance
-                    indiv.save()
-                    debt.balance = F("balance") + indiv.amount
-                    debt.save()
             return redirect(
                 reverse(
                     "rejestrapp:transaction_vote",
@@ -553,6 +771,17 @@ class TransactionVoteView(LoginRequiredMixin, View):
                 )
             )
 
+    def already_settled_error(self, request: HttpRequest, register_id: int):
+        return render_error_page(
+            request,
+            "Ta transakcja została już zatwierdzona, nie można zmienić zgód",
+            403,
+            reverse(
+                "rejestrapp:new_transaction",
+                kwargs={"register_id": register_id},
+            ),
+        )
+
 
 class NewRegisterView(LoginRequiredMixin, View):
     """
@@ -617,7 +846,6 @@ class NewRegisterView(LoginRequiredMixin, View):
             added_users_ids.append(typing.cast(int, request.user.pk))
             register = Register.objects.create(name=name_form.cleaned_data["name"])
             register.users.add(*added_users)
-            register.save()
             this_users_debt = Debt.objects.get(
                 register=register.pk, user=request.user.pk
             )
@@ -677,7 +905,7 @@ class InviteAcceptView(LoginRequiredMixin, View):
                 break
         if all_accepted:
             register.all_accepted = True
-            register.save()
+            register.save(update_fields=["all_accepted"])
         return redirect(reverse("rejestrapp:userspace"))
 
 
@@ -695,7 +923,7 @@ class InviteRejectView(LoginRequiredMixin, View):
         )
         if error is not None:
             return error
-        for debt in register.debt_set.all():
-            debt.delete()
+        with deferred_membership_bumps():
+            register.debt_set.all().delete()
         register.delete()
         return redirect(reverse("rejestrapp:userspace"))
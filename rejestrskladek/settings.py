@@ -25,11 +25,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "rejestrapp.metrics.MetricsMiddleware",
+    "rejestrapp.instrumentation.RequestInstrumentationMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
+    "rejestrapp.routing.ReplicaStickinessMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "rejestrapp.profiling.ProfilerMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -38,7 +42,7 @@ ROOT_URLCONF = "rejestrskladek.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        "BACKEND": "rejestrapp.instrumentation.InstrumentedDjangoTemplates",
         "DIRS": [],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -54,14 +58,119 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "rejestrskladek.wsgi.application"
 
+# The share of requests whose query, template and total times are sent back
+# in a Server-Timing header and logged, see rejestrapp/instrumentation.py.
+REQUEST_INSTRUMENTATION_SAMPLE_RATE = float(
+    os.environ.get("REQUEST_INSTRUMENTATION_SAMPLE_RATE", "0")
+)
+
+# A directory shared by every process of the app, where they leave their
+# metrics for the metrics view to add up, see rejestrapp/metrics.py.
+# Should be emptied when the app is deployed. Without it the view only shows
+# the metrics of the process that answers it.
+METRICS_DIR = os.environ.get("METRICS_DIR") or None
+
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", "5"))
+
+# Besides staff, requests straight from these comma separated addresses can
+# read the metrics, e.g. "127.0.0.1,::1" for a scraper on this machine.
+# Nobody else by default: behind a proxy on the same machine that doesn't
+# set X-Forwarded-For, every client would come from 127.0.0.1.
+METRICS_ALLOWED_ADDRESSES = [
+    address.strip()
+    for address in os.environ.get("METRICS_ALLOWED_ADDRESSES", "").split(",")
+    if address.strip()
+]
+
+# Where the requests staff ask to profile are saved, see
+# rejestrapp/profiling.py. Without it nothing gets profiled.
+PROFILES_DIR = os.environ.get("PROFILES_DIR") or None
+
+PROFILES_KEEP = int(os.environ.get("PROFILES_KEEP", "50"))
+
+PROFILES_SAMPLE_INTERVAL = float(os.environ.get("PROFILES_SAMPLE_INTERVAL", "0.001"))
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "rejestrapp.instrumentation": {"handlers": ["console"], "level": "INFO"},
+    },
+}
+
+
+# Run on every new SQLite connection. WAL lets readers go on while
+# someone writes, busy_timeout makes writers wait for the lock instead of
+# failing with "database is locked". An empty value leaves SQLite's default.
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "busy_timeout": os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    # negative values are in KiB
+    "cache_size": os.environ.get("SQLITE_CACHE_SIZE", "-65536"),
+}
 
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "OPTIONS": {
+            "init_command": ";".join(
+                f"PRAGMA {pragma}={value}"
+                for pragma, value in SQLITE_PRAGMAS.items()
+                if value
+            ),
+            # take the write lock when a transaction begins, so that
+            # it never has to be upgraded from a read lock halfway through
+            "transaction_mode": os.environ.get("SQLITE_TRANSACTION_MODE", "IMMEDIATE")
+            or None,
+        },
     }
 }
 
+# An optional read-only copy of the database for the reads of views
+# decorated with reads_from_replica, see rejestrapp/routing.py. Locally it can
+# be another SQLite file kept in sync with the sync_replica command,
+# or the primary's own file. Without DATABASE_REPLICA_NAME the replica
+# database is still defined, but nothing is routed to it.
+DATABASE_REPLICA_NAME = os.environ.get("DATABASE_REPLICA_NAME")
+
+DATABASE_REPLICA = "replica" if DATABASE_REPLICA_NAME else None
+
+DATABASES["replica"] = {
+    "ENGINE": "django.db.backends.sqlite3",
+    "NAME": DATABASE_REPLICA_NAME or DATABASES["default"]["NAME"],
+    "OPTIONS": {
+        # read_uncommitted only matters for the in-memory test database,
+        # whose shared cache lets the mirror read what a test hasn't committed
+        "init_command": DATABASES["default"]["OPTIONS"]["init_command"]
+        + ";PRAGMA query_only=1;PRAGMA read_uncommitted=1",
+    },
+    # in tests the replica is the primary's test database
+    "TEST": {"MIRROR": "default"},
+}
+
+DATABASE_ROUTERS = ["rejestrapp.routing.PrimaryReplicaRouter"]
+
+# how long a session keeps reading from the primary after it wrote something
+REPLICA_STICKINESS_SECONDS = int(os.environ.get("REPLICA_STICKINESS_SECONDS", "30"))
+
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # LocMemCache evicts the least recently used entries above MAX_ENTRIES
+    "register_pages": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "register_pages",
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": 1000},
+    },
+}
+
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -113,3 +222,9 @@ CSRF_TRUSTED_ORIGINS = ["https://frog02-20448.wykr.es"]
 EMAIL_API_EMAIL_ADDRESS = os.environ["EMAIL_API_EMAIL_ADDRESS"]
 
 EMAIL_API_KEY = os.environ["EMAIL_API_KEY"]
+
+EMAIL_API_URL = os.environ.get("EMAIL_API_URL", "https://api.mailersend.com/v1/email")
+
+EMAIL_API_BULK_URL = os.environ.get(
+    "EMAIL_API_BULK_URL", "https://api.mailersend.com/v1/bulk-email"
+)
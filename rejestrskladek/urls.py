@@ -18,7 +18,16 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from rejestrapp import profiling
+
 urlpatterns = [
+    # before the admin's own URLs, which end with a catch-all
+    path("admin/profiles/", profiling.ProfilesView.as_view(), name="admin_profiles"),
+    path(
+        "admin/profiles/<str:name>/<str:kind>/",
+        profiling.ProfileDownloadView.as_view(),
+        name="admin_profile_download",
+    ),
     path("admin/", admin.site.urls),
     path("", include("rejestrapp.urls")),
 ]